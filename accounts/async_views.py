@@ -0,0 +1,412 @@
+"""
+Native async views, served without a thread per request under ASGI
+(``core/asgi.py``, e.g. ``daphne core.asgi:application``). Each is routed
+next to its sync counterpart with an ``async/`` suffix.
+
+DRF's ``APIView`` is sync-only, so these build on Django's ``View`` and
+reuse the accounts serializers for input validation and output. Reads use
+the async ORM and ipinfo is called through ``httpx``, so requests waiting
+on I/O don't hold a thread. Writes that must share a transaction (a user,
+their OTP and its outbox email) run as one ``sync_to_async`` call, since
+transactions aren't available to async code.
+"""
+import json
+import logging
+import math
+
+import requests
+from asgiref.sync import sync_to_async
+from django.contrib.auth.hashers import make_password
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse
+from django.views import View
+from redis.exceptions import RedisError
+from rest_framework import serializers
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.settings import api_settings
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+from core.db_router import primary_reads
+
+from .authentication import USER_CLAIMS, ClaimsJWTAuthentication, ClaimsUser
+from .availability import acheck_availability
+from .emails import queue_otp_email, queue_welcome_email
+from .geolocation import alookup_location, client_ip
+from .hashers import run_in_hash_pool, verify_password
+from .models import User
+from .otp_store import get_otp_store
+from .profile_cache import etag_matches, get_profile
+from .renderers import FastJSONRenderer
+from .revocation import revoke_token
+from .serializers import (
+    AvailabilitySerializer, LoginCredentialsSerializer, LogoutSerializer, RegistrationSerializer,
+    UserSerializer, aconsume_otp, issue_tokens,
+)
+from .throttles import IPTokenBucketThrottle, consume_token, normalize_email_ident
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncAPIView(View):
+    """
+    Base class for async JSON endpoints. Like DRF views these are
+    CSRF-exempt, since clients authenticate with bearer tokens. With
+    ``authentication_required``, ``request.user`` is set from the JWT the
+    way the DRF views' authentication class would.
+    """
+    authentication_required = False
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        view.csrf_exempt = True
+        return view
+
+    async def dispatch(self, request, *args, **kwargs):
+        if self.authentication_required:
+            try:
+                authenticated = await self.authenticate(request)
+            except AuthenticationFailed as exc:
+                detail = exc.detail if isinstance(exc.detail, dict) else {"detail": exc.detail}
+                return self.unauthorized(detail)
+            if authenticated is None:
+                return self.unauthorized({"detail": "Authentication credentials were not provided."})
+            request.user, request.auth = authenticated
+        return await super().dispatch(request, *args, **kwargs)
+
+    async def authenticate(self, request):
+        """
+        Return ``(user, token)`` for the request's bearer token, or ``None``
+        without one. Raises ``AuthenticationFailed`` for a bad or revoked token.
+        """
+        authenticator = next(
+            cls() for cls in api_settings.DEFAULT_AUTHENTICATION_CLASSES if issubclass(cls, JWTAuthentication))
+        header = authenticator.get_header(request)
+        raw_token = authenticator.get_raw_token(header) if header else None
+        if raw_token is None:
+            return None
+        # The revocation check may ask Redis.
+        token = await sync_to_async(authenticator.get_validated_token, thread_sensitive=False)(raw_token)
+        if isinstance(authenticator, ClaimsJWTAuthentication) and all(claim in token for claim in USER_CLAIMS):
+            return authenticator.get_user(token), token
+
+        try:
+            user_id = token[jwt_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken("Token contained no recognizable user identification")
+        try:
+            with primary_reads():
+                user = await User.objects.aget(**{jwt_settings.USER_ID_FIELD: user_id})
+        except User.DoesNotExist:
+            raise AuthenticationFailed("User not found", code="user_not_found")
+        if jwt_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed("User is inactive", code="user_inactive")
+        return user, token
+
+    def unauthorized(self, detail):
+        response = JsonResponse(detail, status=401)
+        response["WWW-Authenticate"] = f'{jwt_settings.AUTH_HEADER_TYPES[0]} realm="api"'
+        return response
+
+    def parse_json(self, request):
+        """ Return the request body as a dict, or ``None`` if it isn't one. """
+        try:
+            data = json.loads(request.body or b"{}")
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+
+    def error(self, detail, status=400):
+        return JsonResponse({"detail": detail}, status=status)
+
+    def invalid(self, exc):
+        """ 400 for a ``ValidationError``, shaped like DRF's. """
+        detail = exc.detail
+        if not isinstance(detail, dict):
+            detail = {api_settings.NON_FIELD_ERRORS_KEY: detail}
+        return JsonResponse(detail, status=400)
+
+    async def check_throttles(self, request, email=None):
+        """
+        Apply the same IP and email token buckets as the DRF views'
+        ``throttle_scope``. Returns a 429 response, or ``None`` if allowed.
+        """
+        idents = {
+            "ip": IPTokenBucketThrottle().get_ident(request),
+            "email": normalize_email_ident(email),
+        }
+        waits = []
+        for kind, ident in idents.items():
+            allowed, wait = await sync_to_async(consume_token, thread_sensitive=False)(
+                self.throttle_scope, kind, ident)
+            if not allowed:
+                waits.append(wait)
+        if not waits:
+            return None
+        wait = math.ceil(max(waits))
+        response = self.error(f"Request was throttled. Expected available in {wait} seconds.", status=429)
+        response["Retry-After"] = str(wait)
+        return response
+
+
+class AsyncLoginView(AsyncAPIView):
+    """
+    Async counterpart of ``LoginView``.
+
+    The user is fetched with the async ORM and the password hash runs in the
+    bounded hashing pool, so a burst of logins neither blocks the event loop
+    nor holds a worker thread per request. Hashes made with an outdated
+    iteration count are upgraded on the way through.
+    """
+    throttle_scope = "login"
+
+    async def post(self, request):
+        data = self.parse_json(request)
+        if data is None:
+            return self.error("Malformed JSON body.")
+
+        throttled = await self.check_throttles(request, data.get("email"))
+        if throttled is not None:
+            return throttled
+
+        credentials = LoginCredentialsSerializer(data=data)
+        if not credentials.is_valid():
+            return JsonResponse(credentials.errors, status=400)
+        email = credentials.validated_data["email"]
+        password = credentials.validated_data["password"]
+
+        user = await User.objects.filter(email=email).afirst()
+        is_correct, needs_rehash = await run_in_hash_pool(
+            verify_password, password, user.password if user else None)
+        # Same rule as ModelBackend: inactive users can't authenticate.
+        if not is_correct or not user.is_active:
+            return JsonResponse({"non_field_errors": ["Invalid credentials."]}, status=400)
+
+        if needs_rehash:
+            user.password = await run_in_hash_pool(make_password, password)
+            await user.asave(update_fields=["password"])
+
+        return JsonResponse({
+            "user": UserSerializer(user).data,
+            **issue_tokens(user),
+        }, status=200)
+
+
+class EmailSerializer(serializers.Serializer):
+    email = serializers.EmailField()
+
+
+class EmailCodeSerializer(EmailSerializer):
+    code = serializers.CharField(max_length=6)
+
+
+class AsyncRegistrationSerializer(RegistrationSerializer):
+    """ Registration rules; uniqueness is checked by the view with the async ORM. """
+
+    def validate_unique_fields(self, data):
+        pass
+
+
+@sync_to_async
+def create_registered_user(data, encoded_password):
+    """ ``RegistrationSerializer.create`` with the password already hashed. """
+    with transaction.atomic():
+        user = User(**data)
+        user.email = User.objects.normalize_email(user.email)
+        user.password = encoded_password
+        user.save()
+        queue_otp_email(user, get_otp_store().issue(user))
+    return user
+
+
+@sync_to_async
+def send_otp(user):
+    with transaction.atomic():
+        queue_otp_email(user, get_otp_store().issue(user))
+
+
+@sync_to_async
+def activate_user(user):
+    with transaction.atomic():
+        if not user.is_active:
+            user.is_active = True
+            user.save(update_fields=["is_active"])
+            queue_welcome_email(user)
+
+
+class AsyncRegisterView(AsyncAPIView):
+    """
+    Async counterpart of ``RegisterView``. The password is hashed in the
+    hashing pool, not on the thread that runs the database writes.
+    """
+
+    async def post(self, request):
+        data = self.parse_json(request)
+        if data is None:
+            return self.error("Malformed JSON body.")
+        serializer = AsyncRegistrationSerializer(data=data)
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=400)
+        data = dict(serializer.validated_data)
+
+        availability = await acheck_availability(email=data["email"], username=data["username"])
+        errors = {field: [f"{field.capitalize()} is already taken."]
+                  for field, available in availability.items() if not available}
+        if errors:
+            return JsonResponse(errors, status=400)
+
+        encoded = await run_in_hash_pool(make_password, data.pop("password"))
+        try:
+            await create_registered_user(data, encoded)
+        except IntegrityError:
+            # Lost a race with a concurrent registration for the same name.
+            return self.invalid(serializers.ValidationError("Email or username is already taken."))
+        return JsonResponse({"message": "User registered successfully. Check your email for OTP."}, status=201)
+
+
+class AsyncAvailabilityView(AsyncAPIView):
+    """ Async counterpart of ``AvailabilityView``. """
+
+    async def get(self, request):
+        serializer = AvailabilitySerializer(data=request.GET)
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=400)
+        return JsonResponse(await acheck_availability(**serializer.validated_data))
+
+
+class AsyncOTPRequestView(AsyncAPIView):
+    """ Async counterpart of ``OTPRequestView``. """
+    throttle_scope = "otp_request"
+
+    async def post(self, request):
+        data = self.parse_json(request)
+        if data is None:
+            return self.error("Malformed JSON body.")
+        throttled = await self.check_throttles(request, data.get("email"))
+        if throttled is not None:
+            return throttled
+        serializer = EmailSerializer(data=data)
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=400)
+
+        try:
+            user = await User.objects.aget(email=serializer.validated_data["email"])
+        except User.DoesNotExist:
+            return self.invalid(serializers.ValidationError("User not found."))
+        await send_otp(user)
+        return JsonResponse({"message": "OTP sent successfully."})
+
+
+class AsyncOTPVerifyView(AsyncAPIView):
+    """ Async counterpart of ``OTPVerifyView``. """
+    throttle_scope = "otp_verify"
+
+    async def post(self, request):
+        data = self.parse_json(request)
+        if data is None:
+            return self.error("Malformed JSON body.")
+        throttled = await self.check_throttles(request, data.get("email"))
+        if throttled is not None:
+            return throttled
+        serializer = EmailCodeSerializer(data=data)
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=400)
+
+        email = serializer.validated_data["email"]
+        try:
+            await aconsume_otp(email, serializer.validated_data["code"])
+            user = await User.objects.aget(email=email)
+        except serializers.ValidationError as exc:
+            return self.invalid(exc)
+        except User.DoesNotExist:
+            return self.invalid(serializers.ValidationError("User not found."))
+        await activate_user(user)
+        return JsonResponse({"message": "Account activated successfully."})
+
+
+class AsyncGeneralOTPVerifyView(AsyncAPIView):
+    """ Async counterpart of ``GeneralOTPVerifyView``. """
+    throttle_scope = "otp_verify"
+
+    async def post(self, request):
+        data = self.parse_json(request)
+        if data is None:
+            return self.error("Malformed JSON body.")
+        throttled = await self.check_throttles(request, data.get("email"))
+        if throttled is not None:
+            return throttled
+        serializer = EmailCodeSerializer(data=data)
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=400)
+        try:
+            await aconsume_otp(serializer.validated_data["email"], serializer.validated_data["code"])
+        except serializers.ValidationError as exc:
+            return self.invalid(exc)
+        return JsonResponse({"message": "OTP verified successfully."})
+
+
+class AsyncLogoutView(AsyncAPIView):
+    """ Async counterpart of ``LogoutView``. """
+    authentication_required = True
+
+    async def post(self, request):
+        data = self.parse_json(request)
+        if data is None:
+            return self.error("Malformed JSON body.")
+        serializer = LogoutSerializer(data=data, context={"request": request})
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=400)
+
+        try:
+            for token in (request.auth, serializer.validated_data["refresh"]):
+                await sync_to_async(revoke_token, thread_sensitive=False)(token)
+        except RedisError:
+            logger.exception("Could not revoke tokens on logout")
+            return self.error("Logout is temporarily unavailable.", status=503)
+        return JsonResponse({"message": "Logout successful."})
+
+
+class AsyncGetLocationView(AsyncAPIView):
+    """
+    Async counterpart of ``GetLocationAPIView``. The ipinfo call is awaited,
+    so a slow upstream ties up no thread.
+    """
+    authentication_required = True
+
+    async def get(self, request):
+        ip = client_ip(request)
+        try:
+            location_data = await alookup_location(ip)
+        except requests.exceptions.RequestException:
+            logger.exception("Error fetching location")
+            return JsonResponse({"error": "Location service unavailable"}, status=500)
+        if location_data is None:
+            return JsonResponse({"error": "Could not retrieve location"}, status=400)
+
+        user = request.user
+        if isinstance(user, ClaimsUser):
+            user = await User.objects.aget(**{jwt_settings.USER_ID_FIELD: user.id})
+        location = f"{location_data['city']}, {location_data['country']}"
+        if user.location != location:
+            user.location = location
+            await user.asave(update_fields=["location"])
+        return JsonResponse(location_data)
+
+
+class AsyncGetUserByUsernameView(AsyncAPIView):
+    """ Async counterpart of ``GetUserByUsernameAPIView``, with the same cache and ETags. """
+    authentication_required = True
+
+    async def get(self, request, username):
+        # Not thread-sensitive: profile fetches mustn't queue on one shared thread.
+        profile = await sync_to_async(get_profile, thread_sensitive=False)(username)
+        if profile["data"] is None:
+            return self.error("Not found.", status=404)
+        if etag_matches(request.headers.get("If-None-Match"), profile["etag"]):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(FastJSONRenderer().render(profile["data"]), content_type="application/json")
+        response["ETag"] = profile["etag"]
+        return response
@@ -0,0 +1,131 @@
+"""
+JWT authentication classes for ``REST_FRAMEWORK['DEFAULT_AUTHENTICATION_CLASSES']``.
+
+``RevocationAwareJWTAuthentication`` loads the user from the database on
+every request. With ``JWT_STATELESS_AUTH`` on, ``ClaimsJWTAuthentication``
+is used instead: the request user is a ``ClaimsUser`` built from claims
+signed into the token at login (id, email, is_active, is_staff), so
+authenticating costs no query. Claims are refreshed whenever the token is,
+so a change (e.g. losing staff) applies within one access-token lifetime.
+"""
+import copy
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.functional import cached_property
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+from core.db_router import primary_reads
+
+from .geolocation import LRUCache
+from .revocation import is_token_revoked
+
+USER_CLAIMS = ("email", "is_active", "is_staff")
+
+
+def add_user_claims(token, user):
+    """ Sign the ``ClaimsUser`` fields into ``token`` (and tokens derived from it). """
+    for claim in USER_CLAIMS:
+        token[claim] = getattr(user, claim)
+    return token
+
+
+class RevocationAwareJWTAuthentication(JWTAuthentication):
+    """ ``JWTAuthentication`` that also rejects revoked tokens (see ``accounts.revocation``). """
+
+    def get_validated_token(self, raw_token):
+        token = super().get_validated_token(raw_token)
+        if is_token_revoked(token):
+            raise InvalidToken({"detail": "Token has been revoked.", "code": "token_revoked"})
+        return token
+
+    def get_user(self, validated_token):
+        # From the primary: the token may belong to a user created or
+        # activated moments ago.
+        with primary_reads():
+            return super().get_user(validated_token)
+
+
+_users = None
+
+
+def _user_cache():
+    global _users
+    if _users is None:
+        _users = LRUCache(settings.JWT_CLAIMS_USER_CACHE_SIZE)
+    return _users
+
+
+@receiver(setting_changed)
+def _reset_user_cache(setting, **kwargs):
+    global _users
+    if setting.startswith("JWT_CLAIMS_USER_CACHE_"):
+        _users = None
+
+
+def forget_cached_user(pk):
+    if _users is not None:
+        _users.delete(pk)
+
+
+class ClaimsUser(TokenUser):
+    """
+    Request user backed by token claims. Call ``get_user()`` for the real
+    ``User`` when a view needs more fields or has to write.
+    """
+
+    @cached_property
+    def email(self):
+        return self.token.get("email", "")
+
+    @cached_property
+    def is_active(self):
+        return self.token.get("is_active", True)
+
+    def get_user(self, fresh=False):
+        """
+        Load the ``User``. Unless ``fresh``, a copy kept for
+        ``JWT_CLAIMS_USER_CACHE_TTL`` seconds may be returned; pass
+        ``fresh=True`` before writing.
+        """
+        from .models import User
+
+        cache = _user_cache()
+        ttl = settings.JWT_CLAIMS_USER_CACHE_TTL
+        user = None if fresh or not ttl else cache.get(self.id)
+        if user is None:
+            with primary_reads():
+                user = User.objects.filter(**{jwt_settings.USER_ID_FIELD: self.id}).first()
+            if user is None:
+                raise AuthenticationFailed("User not found", code="user_not_found")
+            if ttl:
+                cache.set(self.id, user, ttl)
+        return copy.copy(user)
+
+
+def get_model_user(user, fresh=False):
+    """ ``request.user`` as a ``User`` instance, whichever authentication ran. """
+    if isinstance(user, ClaimsUser):
+        return user.get_user(fresh=fresh)
+    return user
+
+
+class ClaimsJWTAuthentication(RevocationAwareJWTAuthentication):
+    """
+    Authenticate from token claims without querying the user table. Tokens
+    issued before the claims existed fall back to the database lookup.
+    """
+
+    def get_user(self, validated_token):
+        if not all(claim in validated_token for claim in USER_CLAIMS):
+            return super().get_user(validated_token)
+        if jwt_settings.USER_ID_CLAIM not in validated_token:
+            raise InvalidToken("Token contained no recognizable user identification")
+        user = ClaimsUser(validated_token)
+        if jwt_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed("User is inactive", code="user_inactive")
+        return user
@@ -0,0 +1,301 @@
+"""
+Username/email availability checks backed by a Bloom filter in Redis.
+
+The filter holds every email and username in the ``User`` table. A negative
+answer is definitive, so most "is this free?" checks never reach the
+database; a positive answer may be a false positive and is confirmed with
+a single query covering both values.
+
+The bitmap lives in Redis so every process sees the same set. It is built
+by ``rebuild_filter`` (beat, deploy, or on demand when missing), extended
+by the ``post_save`` handler in ``accounts.signals``, and rebuilt after
+deletes since a Bloom filter cannot forget. Without Redis every check goes
+straight to the database.
+
+Users saved while a rebuild runs are added to both the live filter and the
+one being built, and adds are also kept in a short-lived sorted set that a
+rebuild replays, so users whose rows it couldn't see yet aren't lost.
+"""
+import hashlib
+import logging
+import math
+import time
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Q
+
+from redis.exceptions import RedisError
+
+from .models import User
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+REBUILD_QUEUED_KEY = "availability:rebuild-queued"
+
+# Sets the bits in the live filter and the one being rebuilt, where they
+# exist, and records the members with their time for rebuilds to replay.
+# KEYS: filter, filter being built, recent members
+# ARGV: now, cutoff for recent members, member count, members..., bit positions...
+ADD_SCRIPT = """
+local count = tonumber(ARGV[3])
+for i = 4, 3 + count do
+    redis.call('ZADD', KEYS[3], ARGV[1], ARGV[i])
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', '(' .. ARGV[2])
+for k = 1, 2 do
+    if redis.call('EXISTS', KEYS[k]) == 1 then
+        for i = 4 + count, #ARGV do
+            redis.call('SETBIT', KEYS[k], ARGV[i], 1)
+        end
+    end
+end
+return count
+"""
+
+
+def bloom_parameters(capacity, error_rate):
+    """ Optimal bit count and hash count for ``capacity`` items. """
+    size = math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+    hashes = max(1, round(size / capacity * math.log(2)))
+    return size, hashes
+
+
+def bloom_positions(value, size, hashes):
+    """ Bit offsets for ``value`` using Kirsch-Mitzenmacher double hashing. """
+    digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], "big")
+    h2 = int.from_bytes(digest[8:], "big") | 1
+    return [(h1 + i * h2) % size for i in range(hashes)]
+
+
+def _members(email=None, username=None):
+    members = []
+    if email is not None:
+        members.append(f"e:{email}")
+    if username is not None:
+        members.append(f"u:{username}")
+    return members
+
+
+def _scan(queryset, batch_size=5000):
+    """
+    ``(email, username)`` for every row, one query per batch in primary-key
+    order: a server-side ``iterator()`` cursor doesn't survive PgBouncer's
+    transaction pooling.
+    """
+    queryset = queryset.order_by("pk").values_list("pk", "email", "username")
+    last_pk = None
+    while True:
+        batch = list((queryset if last_pk is None else queryset.filter(pk__gt=last_pk))[:batch_size])
+        for _, email, username in batch:
+            yield email, username
+        if len(batch) < batch_size:
+            return
+        last_pk = batch[-1][0]
+
+
+class BloomFilter:
+    """
+    Redis-backed Bloom filter. Bits use Redis' SETBIT ordering (most
+    significant bit first within each byte) so a locally built bitmap can
+    be uploaded in a single SET.
+    """
+
+    def __init__(self, redis, capacity, error_rate):
+        self.redis = redis
+        self.size, self.hashes = bloom_parameters(capacity, error_rate)
+        # Changing the parameters changes the key, which forces a rebuild.
+        self.key = f"availability:bloom:{self.size}:{self.hashes}"
+        self.building_key = f"{self.key}:building"
+        self.scan_key = f"{self.key}:scan"
+        self.recent_key = "availability:recent"
+        self._add_script = redis.register_script(ADD_SCRIPT)
+
+    def might_contain(self, members):
+        """
+        Return a list of booleans, one per member, or ``None`` if the filter
+        has not been built yet.
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.exists(self.key)
+        for member in members:
+            for position in bloom_positions(member, self.size, self.hashes):
+                pipe.getbit(self.key, position)
+        exists, *bits = pipe.execute()
+        if not exists:
+            return None
+        return [all(bits[i * self.hashes:(i + 1) * self.hashes]) for i in range(len(members))]
+
+    def add(self, members):
+        """
+        Set the bits for ``members`` in the filter and, during a rebuild, in
+        the one being built; and record them for rebuilds to replay.
+        """
+        # A missing filter stays missing; the next rebuild will include them.
+        if not members:
+            return
+        now = time.time()
+        positions = [position for member in members
+                     for position in bloom_positions(member, self.size, self.hashes)]
+        self._add_script(
+            keys=[self.key, self.building_key, self.recent_key],
+            args=[now, now - settings.AVAILABILITY_BLOOM_RECENT_WINDOW, len(members), *members, *positions],
+        )
+
+    def rebuild(self, queryset):
+        """
+        Replace the filter with one built from ``queryset`` (email, username
+        rows), swapped in atomically with RENAME.
+
+        Users saved during the scan reach the new filter through ``add``;
+        those saved shortly before it, whose rows the scan may not have seen
+        committed, are replayed from the recent members.
+        """
+        started = time.time()
+        # Allocated first, so every add() from now on lands in it too.
+        self.redis.delete(self.building_key)
+        self.redis.setbit(self.building_key, self.size - 1, 0)
+
+        bitmap = bytearray((self.size + 7) // 8)
+        count = 0
+        for email, username in _scan(queryset):
+            for member in _members(email, username):
+                for position in bloom_positions(member, self.size, self.hashes):
+                    bitmap[position >> 3] |= 0x80 >> (position & 7)
+            count += 1
+        pipe = self.redis.pipeline()
+        pipe.set(self.scan_key, bytes(bitmap))
+        # OR rather than SET: keep the bits add() wrote during the scan.
+        pipe.bitop("OR", self.building_key, self.building_key, self.scan_key)
+        pipe.delete(self.scan_key)
+        pipe.execute()
+
+        since = started - settings.AVAILABILITY_BLOOM_RECENT_WINDOW
+        recent = self.redis.zrangebyscore(self.recent_key, since, "+inf")
+        if recent:
+            pipe = self.redis.pipeline(transaction=False)
+            for member in recent:
+                for position in bloom_positions(member.decode(), self.size, self.hashes):
+                    pipe.setbit(self.building_key, position, 1)
+            pipe.execute()
+        self.redis.rename(self.building_key, self.key)
+        return count
+
+
+def get_filter():
+    """ The shared filter, or ``None`` when Redis is not configured. """
+    redis = get_redis()
+    if redis is None:
+        return None
+    return BloomFilter(redis, settings.AVAILABILITY_BLOOM_CAPACITY,
+                       settings.AVAILABILITY_BLOOM_ERROR_RATE)
+
+
+def rebuild_filter():
+    bloom = get_filter()
+    if bloom is None:
+        return 0
+    # From the primary: users missing on a lagging replica would read as available.
+    count = bloom.rebuild(User.objects.using(DEFAULT_DB_ALIAS))
+    cache.delete(REBUILD_QUEUED_KEY)
+    logger.info("Rebuilt availability filter with %s users", count)
+    return count
+
+
+def schedule_rebuild(countdown=0):
+    """ Queue a rebuild unless one is already queued; nothing to do without Redis. """
+    from .tasks import rebuild_availability_filter
+
+    if get_redis() is None:
+        return
+    if not cache.add(REBUILD_QUEUED_KEY, 1, timeout=15 * 60):
+        return
+    try:
+        rebuild_availability_filter.apply_async(countdown=countdown, retry=False)
+    except Exception:
+        cache.delete(REBUILD_QUEUED_KEY)
+        logger.exception("Could not queue availability filter rebuild")
+
+
+def add_user(email, username):
+    add_users([(email, username)])
+
+
+def add_users(pairs):
+    """ Add ``(email, username)`` pairs to the filter in one pipeline. """
+    bloom = get_filter()
+    if bloom is None:
+        return
+    try:
+        bloom.add([member for email, username in pairs for member in _members(email, username)])
+    except RedisError:
+        # Never fail a save over the filter; schedule a full rebuild instead.
+        logger.exception("Could not add user to availability filter")
+        schedule_rebuild()
+
+
+def _candidates(email, username):
+    """
+    The requested values and those of them the filter says might be taken
+    (all of them when the filter can't answer).
+    """
+    values = {"email": email, "username": username}
+    requested = {field: value for field, value in values.items() if value is not None}
+
+    bloom = get_filter()
+    if bloom is not None:
+        try:
+            hits = bloom.might_contain(_members(email, username))
+        except RedisError:
+            logger.exception("Availability filter unavailable; checking the database")
+        else:
+            if hits is None:
+                schedule_rebuild()
+            else:
+                return requested, {field: value for (field, value), hit
+                                   in zip(requested.items(), hits) if hit}
+    return requested, dict(requested)
+
+
+def _taken_query(candidates):
+    query = Q()
+    for field, value in candidates.items():
+        query |= Q(**{field: value})
+    return User.objects.filter(query).values_list("email", "username")
+
+
+def _mark_taken(result, candidates, found_email, found_username):
+    if found_email == candidates.get("email"):
+        result["email"] = False
+    if found_username == candidates.get("username"):
+        result["username"] = False
+
+
+def check_availability(email=None, username=None):
+    """
+    Return ``{"email": bool, "username": bool}`` for the values given, where
+    ``True`` means available. Costs at most one Redis round-trip and one
+    database query.
+    """
+    requested, candidates = _candidates(email, username)
+    result = {field: True for field in requested}
+    if candidates:
+        for found_email, found_username in _taken_query(candidates):
+            _mark_taken(result, candidates, found_email, found_username)
+    return result
+
+
+async def acheck_availability(email=None, username=None):
+    """ ``check_availability`` for async views. """
+    # redis-py is blocking; keep it off the event loop.
+    requested, candidates = await sync_to_async(_candidates, thread_sensitive=False)(email, username)
+    result = {field: True for field in requested}
+    if candidates:
+        async for found_email, found_username in _taken_query(candidates):
+            _mark_taken(result, candidates, found_email, found_username)
+    return result
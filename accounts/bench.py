@@ -0,0 +1,201 @@
+"""
+Helpers for the ``bench_endpoints`` and ``bench_async`` management
+commands: a throwaway database with seeded users, local stand-ins for
+Plunk and ipinfo, and latency/throughput statistics with baseline
+comparison.
+"""
+import json
+import math
+import statistics
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from core.celery import app
+
+from .models import User
+from .search import rebuild_index
+
+PASSWORD = "Bench-pass-123!"
+
+
+class _UpstreamHandler(BaseHTTPRequestHandler):
+    """ Answers like Plunk (``POST /track``) and ipinfo (``GET /<ip>/json``). """
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; without TCP_NODELAY,
+    # delayed ACKs would add ~40ms to every call.
+    disable_nagle_algorithm = True
+
+    def _reply(self, body):
+        time.sleep(self.server.latency)
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.calls["plunk"] += 1
+        self._reply({"success": True})
+
+    def do_GET(self):
+        self.server.calls["ipinfo"] += 1
+        ip = self.path.strip("/").split("/")[0]
+        self._reply({"ip": ip, "city": "Lagos", "region": "Lagos", "country": "NG", "loc": "6.4541,3.3947"})
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeUpstreams:
+    """
+    Run the stand-in server on a free local port for the duration of a
+    ``with`` block. ``settings`` returns an ``UPSTREAM_SERVICES`` value
+    pointing every upstream at it.
+    """
+
+    def __init__(self, latency=0.0):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _UpstreamHandler)
+        self.server.daemon_threads = True
+        self.server.latency = latency
+        self.server.calls = {"plunk": 0, "ipinfo": 0}
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    @property
+    def calls(self):
+        return dict(self.server.calls)
+
+    def settings(self, upstream_services):
+        return {name: {**config, "BASE_URL": self.url} for name, config in upstream_services.items()}
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@contextmanager
+def bench_environment(upstream_latency=0.0):
+    """
+    Run the block against a throwaway test database, with Celery tasks run
+    eagerly, throttling off and every upstream pointed at ``FakeUpstreams``,
+    which is yielded.
+    """
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    eager = app.conf.task_always_eager
+    app.conf.task_always_eager = True
+    try:
+        with FakeUpstreams(upstream_latency) as upstreams, override_settings(
+            UPSTREAM_SERVICES=upstreams.settings(settings.UPSTREAM_SERVICES),
+            # Measure the endpoints, not the rate limits.
+            REST_FRAMEWORK={**settings.REST_FRAMEWORK, "DEFAULT_THROTTLE_RATES": {}},
+            # Revocation needs Redis; benchmark without it on machines that have none.
+            JWT_REVOCATION_ENABLED=settings.JWT_REVOCATION_ENABLED and bool(settings.REDIS_URL),
+        ):
+            yield upstreams
+    finally:
+        app.conf.task_always_eager = eager
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def seed_users(count):
+    """
+    Insert ``count`` users named ``seed<i>`` (all with ``PASSWORD``) and
+    return their usernames.
+    """
+    encoded = make_password(PASSWORD)
+    User.objects.bulk_create([
+        User(
+            email=f"seed{i}@example.com",
+            username=f"seed{i}",
+            first_name="Seed",
+            last_name=f"User{i}",
+            dob="1990-01-01",
+            gender=("male", "female", "not_say")[i % 3],
+            phone_number=f"0801{i:07d}",
+            location=("Lagos, NG", "Accra, GH", "Nairobi, KE")[i % 3],
+            password=encoded,
+        )
+        for i in range(count)
+    ], batch_size=1000)
+    rebuild_index()
+    return [f"seed{i}" for i in range(count)]
+
+
+def create_bench_user(username, is_staff=False):
+    user = User.objects.create_user(
+        email=f"{username}@example.com", username=username, first_name="Bench", last_name="User",
+        dob="1990-01-01", gender="female", phone_number="08012345678", location="Lagos, NG",
+        password=PASSWORD)
+    if is_staff:
+        user.is_staff = True
+        user.save(update_fields=["is_staff"])
+    return user
+
+
+def percentile(samples, pct):
+    """ Nearest-rank percentile of ``samples``. """
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def summarize(latencies, queries, elapsed=None):
+    """
+    Latencies in seconds -> milliseconds stats, plus queries and the rate
+    one client sending requests back to back gets (``sequential_rps``).
+    With ``elapsed``, the wall-clock time of a concurrent run, also the
+    throughput that run achieved (``throughput_rps``).
+    """
+    ms = [latency * 1000 for latency in latencies]
+    summary = {
+        "requests": len(ms),
+        "p50_ms": round(percentile(ms, 50), 3),
+        "p95_ms": round(percentile(ms, 95), 3),
+        "p99_ms": round(percentile(ms, 99), 3),
+        "mean_ms": round(statistics.fmean(ms), 3),
+        "queries_mean": round(statistics.fmean(queries), 2),
+        "queries_max": max(queries),
+        "sequential_rps": round(1000 / statistics.fmean(ms), 1) if any(ms) else 0.0,
+    }
+    if elapsed is not None:
+        summary["throughput_rps"] = round(len(ms) / elapsed, 1) if elapsed else 0.0
+    return summary
+
+
+def find_regressions(results, baseline, tolerance, slack_ms=1.0):
+    """
+    Compare ``results`` with ``baseline`` (both ``{name: summary}``).
+    Latency may grow by ``tolerance`` (0.2 = 20%) plus ``slack_ms``, so
+    sub-millisecond endpoints don't fail on noise; query counts may not
+    grow at all. Returns a list of messages, empty when nothing regressed.
+    """
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        for metric in ("p50_ms", "p95_ms"):
+            if current[metric] > previous[metric] * (1 + tolerance) + slack_ms:
+                regressions.append(
+                    f"{name}: {metric} {current[metric]} > {previous[metric]} (+{tolerance:.0%} allowed)")
+        if current["queries_mean"] > previous["queries_mean"]:
+            regressions.append(
+                f"{name}: queries_mean {current['queries_mean']} > {previous['queries_mean']}")
+    return regressions
@@ -0,0 +1,16 @@
+"""
+System checks for settings that would otherwise fail on every request.
+"""
+from django.conf import settings
+from django.core.checks import Error, register
+
+
+@register()
+def check_revocation_store(app_configs, **kwargs):
+    if settings.JWT_REVOCATION_ENABLED and not settings.REDIS_URL:
+        return [Error(
+            "JWT_REVOCATION_ENABLED is on but REDIS_URL is not set.",
+            hint="Set REDIS_URL, or JWT_REVOCATION_ENABLED=false to run with nothing revoked.",
+            id="accounts.E001",
+        )]
+    return []
@@ -0,0 +1,255 @@
+"""
+Outbound HTTP clients for the upstream services the accounts app depends on
+(Plunk for email, ipinfo for geolocation).
+
+Each upstream gets one pooled ``requests.Session`` per process, default
+connect/read timeouts and a circuit breaker. Base URLs come from
+``settings.UPSTREAM_SERVICES`` so they can point at a local stand-in server.
+
+Async views use ``get_async_client``: an ``httpx.AsyncClient`` per event
+loop with the same settings, sharing the sync client's circuit breaker and
+raising the same ``requests`` exceptions, so callers handle both alike.
+"""
+import asyncio
+import os
+import threading
+import time
+import weakref
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from core.metrics import observe_upstream
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """
+    Raised without touching the network while an upstream's circuit is open.
+
+    Subclasses ``ConnectionError`` so existing ``RequestException`` handlers
+    treat it like any other unreachable upstream.
+    """
+
+
+class CircuitBreaker:
+    """
+    Opens after ``failure_threshold`` consecutive failures and rejects calls
+    for ``reset_timeout`` seconds, then lets a single trial call through.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return
+        raise CircuitOpenError(f"{self.name} circuit is open; failing fast")
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class UpstreamClient:
+    """
+    Thin wrapper around a pooled ``requests.Session`` for a single upstream.
+    """
+
+    def __init__(self, name, base_url, timeout=(3.05, 10), pool_size=10,
+                 failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+
+        # Retries are left to the callers (Celery for email), never urllib3,
+        # so a slow upstream can't multiply the time a worker is blocked.
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method, path, **kwargs):
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError:
+            observe_upstream(self.name, "circuit_open", 0.0)
+            raise
+        kwargs.setdefault("timeout", self.timeout)
+        started = time.perf_counter()
+        failed = True
+        try:
+            response = self.session.request(method, f"{self.base_url}{path}", **kwargs)
+            observe_upstream(self.name, str(response.status_code), time.perf_counter() - started)
+            failed = response.status_code >= 500 or response.status_code == 429
+        except requests.exceptions.RequestException as exc:
+            observe_upstream(self.name, type(exc).__name__, time.perf_counter() - started)
+            raise
+        finally:
+            # Any exception counts as a failure, so a half-open trial that
+            # dies unexpectedly still reopens the breaker.
+            if failed:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncUpstreamClient:
+    """
+    ``UpstreamClient`` for async code, on a pooled ``httpx.AsyncClient``.
+    Transport errors are re-raised as their ``requests`` counterparts.
+    """
+
+    def __init__(self, name, base_url, breaker, timeout=(3.05, 10), pool_size=10):
+        self.name = name
+        self.breaker = breaker
+        connect_timeout, read_timeout = timeout
+        self.session = httpx.AsyncClient(
+            base_url=base_url.rstrip("/"),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+
+    async def request(self, method, path, **kwargs):
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError:
+            observe_upstream(self.name, "circuit_open", 0.0)
+            raise
+        started = time.perf_counter()
+        failed = True
+        try:
+            response = await self.session.request(method, path, **kwargs)
+            observe_upstream(self.name, str(response.status_code), time.perf_counter() - started)
+            failed = response.status_code >= 500 or response.status_code == 429
+        except httpx.RequestError as exc:
+            observe_upstream(self.name, type(exc).__name__, time.perf_counter() - started)
+            if isinstance(exc, httpx.TimeoutException):
+                raise requests.exceptions.Timeout(str(exc)) from exc
+            raise requests.exceptions.ConnectionError(str(exc)) from exc
+        finally:
+            # Cancellation included: the trial call's outcome is always recorded.
+            if failed:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+        return response
+
+    async def get(self, path, **kwargs):
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path, **kwargs):
+        return await self.request("POST", path, **kwargs)
+
+
+def _client_options(name):
+    config = settings.UPSTREAM_SERVICES[name]
+    return {
+        "timeout": (config.get("CONNECT_TIMEOUT", 3.05), config.get("READ_TIMEOUT", 10)),
+        "pool_size": config.get("POOL_SIZE", 10),
+    }
+
+
+_clients = {}
+_clients_pid = None
+_clients_lock = threading.Lock()
+
+
+def get_client(name):
+    """
+    Return the shared client for ``name``, creating it on first use.
+
+    Clients are rebuilt after a fork so pre-forked workers never share the
+    parent's sockets.
+    """
+    global _clients_pid
+    client = _clients.get(name)
+    if client is not None and _clients_pid == os.getpid():
+        return client
+
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            _clients.clear()
+            _clients_pid = os.getpid()
+        client = _clients.get(name)
+        if client is None:
+            config = settings.UPSTREAM_SERVICES[name]
+            client = UpstreamClient(
+                name,
+                config["BASE_URL"],
+                failure_threshold=config.get("FAILURE_THRESHOLD", 5),
+                reset_timeout=config.get("RESET_TIMEOUT", 30),
+                **_client_options(name),
+            )
+            _clients[name] = client
+    return client
+
+
+# Event loop -> {name: AsyncUpstreamClient}. An httpx pool can only be
+# used on the loop it was created on.
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client(name):
+    """ Return the async client for ``name`` on the running event loop. """
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.setdefault(loop, {})
+    client = clients.get(name)
+    if client is None:
+        client = clients[name] = AsyncUpstreamClient(
+            name,
+            settings.UPSTREAM_SERVICES[name]["BASE_URL"],
+            get_client(name).breaker,
+            **_client_options(name),
+        )
+    return client
+
+
+def reset_clients():
+    """ Close every client so the next call picks up fresh settings. """
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+    # Async clients are dropped rather than closed: closing needs their loop.
+    _async_clients.clear()
+
+
+@receiver(setting_changed)
+def _reset_on_settings_change(setting, **kwargs):
+    if setting == "UPSTREAM_SERVICES":
+        reset_clients()
@@ -1,15 +1,31 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
 from celery import shared_task
 import requests
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
 from django.utils import timezone
 
+from .clients import get_client
+from .models import EmailOutbox
+
+logger = logging.getLogger(__name__)
+
 # Your Plunk API Key
 PLUNK_API_KEY = "Bearer sk_cf57ddf4d7b470d469d1cf8c6eabbf66cffb13c6492f4348"
-PLUNK_URL = "https://api.useplunk.com/v1/track"
+PLUNK_TRACK_PATH = "/track"
 
+# Network errors plus 5xx/429 responses are worth retrying; send_email
+# swallows every other HTTP error since resending would fail the same way.
+RETRYABLE_ERRORS = (requests.exceptions.RequestException,)
 
-def send_email(event_name, email, data):
+
+def post_email(event_name, email, data):
     """
-    Generic function to send emails via Plunk API.
+    Post a single event to Plunk, raising on any failure.
     """
     headers = {
         "Authorization": PLUNK_API_KEY,
@@ -23,29 +39,203 @@ def send_email(event_name, email, data):
         "data": data
     }
 
+    response = get_client("plunk").post(PLUNK_TRACK_PATH, json=payload, headers=headers)
+    response.raise_for_status()
+
+
+def is_retryable(error):
+    """ Whether sending again could succeed after ``error``. """
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+def send_email(event_name, email, data):
+    """
+    Generic function to send emails via Plunk API.
+
+    Transient errors are logged and re-raised so the calling task can retry.
+    """
     try:
-        response = requests.post(PLUNK_URL, json=payload, headers=headers)
-        response.raise_for_status()
+        post_email(event_name, email, data)
         print(f"Email sent successfully to {email}!")
     except requests.exceptions.HTTPError as http_err:
         print(f"HTTP error occurred: {http_err}")
+        if is_retryable(http_err):
+            raise
     except requests.exceptions.RequestException as err:
         print(f"Error sending email: {err}")
+        raise
 
 
+@shared_task(
+    autoretry_for=RETRYABLE_ERRORS,
+    retry_backoff=2,
+    retry_backoff_max=30,
+    retry_jitter=True,
+    max_retries=5,
+    # An OTP that arrives after it has been superseded is useless.
+    expires=10 * 60,
+)
 def send_otp_email_task(email, first_name, otp_code):
     """
     Sends an OTP email asynchronously using Celery.
+
+    Request paths queue mail through the outbox (``queue_otp_email``); this
+    task remains for direct sends and messages already on the broker.
+    Routed to the high-priority ``otp`` queue and retried quickly, since the
+    user is waiting on it.
     """
     current_time = timezone.now().strftime("%d-%m-%Y")
     send_email("general_send_otp", email, {
                "timestamp": current_time,   "first_name": first_name, "otp_code": str(otp_code), })
 
 
-
+@shared_task(
+    autoretry_for=RETRYABLE_ERRORS,
+    retry_backoff=60,
+    retry_backoff_max=60 * 60,
+    retry_jitter=True,
+    max_retries=8,
+)
 def send_welcome_email_task(email, first_name):
     """
     Sends a welcome email asynchronously using Celery.
+
+    Request paths use ``queue_welcome_email``; see ``send_otp_email_task``.
+    Routed to the ``bulk`` queue with a slow backoff; nobody is blocked on it.
     """
     current_time = timezone.now().strftime("%d-%m-%Y")
     send_email("welcome_email", email, {"timestamp": current_time, "first_name": first_name})
+
+
+# Outbox
+
+
+def enqueue_email(event_name, email, data, queue=EmailOutbox.QUEUE_BULK):
+    """
+    Store an email in the outbox as part of the current transaction.
+
+    A drain of ``queue`` is kicked off once the transaction commits; if it
+    rolls back, neither the row nor the kick survive.
+    """
+    message = EmailOutbox.objects.create(event=event_name, email=email, data=data, queue=queue)
+    transaction.on_commit(lambda: _kick_drain(queue))
+    return message
+
+
+def _kick_drain(queue):
+    # The row is already committed, so a broker outage mustn't fail the
+    # request (a retry would queue the email again); beat's periodic drain
+    # sends it once the broker is back.
+    try:
+        drain_email_outbox.apply_async(args=[queue], queue=queue)
+    except Exception:
+        logger.exception("Could not queue a drain of the %s outbox; leaving it to the periodic drain", queue)
+
+
+def queue_otp_email(user, otp_code):
+    """ Queue an OTP email for ``user`` on the high-priority queue. """
+    current_time = timezone.now().strftime("%d-%m-%Y")
+    return enqueue_email("general_send_otp", user.email, {
+        "timestamp": current_time, "first_name": user.first_name, "otp_code": str(otp_code),
+    }, queue=EmailOutbox.QUEUE_OTP)
+
+
+def queue_welcome_email(user):
+    """ Queue a welcome email for ``user`` on the bulk queue. """
+    current_time = timezone.now().strftime("%d-%m-%Y")
+    return enqueue_email("welcome_email", user.email, {
+        "timestamp": current_time, "first_name": user.first_name,
+    }, queue=EmailOutbox.QUEUE_BULK)
+
+
+def _claim_batch(queue, batch_size):
+    """
+    Atomically mark up to ``batch_size`` due messages as sending.
+
+    Messages stuck in ``sending`` longer than the claim timeout (a worker
+    died mid-batch) are picked up again.
+    """
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.EMAIL_OUTBOX_CLAIM_TIMEOUT)
+    with transaction.atomic():
+        ids = list(
+            EmailOutbox.objects.select_for_update(skip_locked=True)
+            .filter(queue=queue)
+            .filter(
+                Q(status=EmailOutbox.STATUS_PENDING, next_attempt_at__lte=now)
+                | Q(status=EmailOutbox.STATUS_SENDING, claimed_at__lt=stale)
+            )
+            .order_by("next_attempt_at")
+            .values_list("pk", flat=True)[:batch_size]
+        )
+        if not ids:
+            return []
+        EmailOutbox.objects.filter(pk__in=ids).update(
+            status=EmailOutbox.STATUS_SENDING, claimed_at=now, attempts=F("attempts") + 1,
+        )
+        # Inside the transaction, so it reads the primary: a replica may not
+        # have these rows (or the claim) yet.
+        return list(EmailOutbox.objects.filter(pk__in=ids))
+
+
+def _deliver(message):
+    try:
+        post_email(message.event, message.email, message.data)
+    except requests.exceptions.RequestException as err:
+        return err
+    return None
+
+
+def _record_results(messages, errors):
+    now = timezone.now()
+    sent_ids = []
+    failed = []
+    for message, error in zip(messages, errors):
+        if error is None:
+            sent_ids.append(message.pk)
+            continue
+        message.last_error = str(error)[:1000]
+        if is_retryable(error) and message.attempts < settings.EMAIL_OUTBOX_MAX_ATTEMPTS:
+            message.status = EmailOutbox.STATUS_PENDING
+            backoff = min(2 ** message.attempts, settings.EMAIL_OUTBOX_MAX_BACKOFF)
+            message.next_attempt_at = now + timedelta(seconds=backoff)
+        else:
+            message.status = EmailOutbox.STATUS_FAILED
+        failed.append(message)
+
+    if sent_ids:
+        EmailOutbox.objects.filter(pk__in=sent_ids).update(
+            status=EmailOutbox.STATUS_SENT, sent_at=now, last_error="",
+        )
+    if failed:
+        EmailOutbox.objects.bulk_update(failed, ["status", "last_error", "next_attempt_at"])
+    return len(sent_ids), len(failed)
+
+
+@shared_task(ignore_result=True)
+def drain_email_outbox(queue=EmailOutbox.QUEUE_BULK):
+    """
+    Send due outbox messages for ``queue`` in batches, several at a time.
+
+    Runs after every commit that queues mail and periodically from beat to
+    pick up retries. Returns the number of messages sent and failed.
+    """
+    batch_size = settings.EMAIL_OUTBOX_BATCH_SIZE
+    sent = failed = 0
+    with ThreadPoolExecutor(max_workers=settings.EMAIL_OUTBOX_CONCURRENCY) as pool:
+        for _ in range(settings.EMAIL_OUTBOX_MAX_BATCHES_PER_RUN):
+            messages = _claim_batch(queue, batch_size)
+            if not messages:
+                break
+            errors = list(pool.map(_deliver, messages))
+            batch_sent, batch_failed = _record_results(messages, errors)
+            sent += batch_sent
+            failed += batch_failed
+            if len(messages) < batch_size:
+                break
+        else:
+            # Still backlogged; hand over to a fresh task rather than hog the worker.
+            drain_email_outbox.apply_async(args=[queue], queue=queue)
+    return {"sent": sent, "failed": failed}
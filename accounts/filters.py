@@ -1,17 +1,24 @@
 import django_filters
 from accounts.models import User  # Import your User model
+from accounts.search import search
 
 
 class UserFilter(django_filters.FilterSet):
     """
     Filters users by username, email, gender, location, and phone_number.
+
+    The text filters are case-insensitive substring matches served from an
+    index (see ``accounts.search``) rather than a table scan.
     """
-    username = django_filters.CharFilter(lookup_expr="icontains")
-    email = django_filters.CharFilter(lookup_expr="icontains")
+    username = django_filters.CharFilter(method="filter_contains")
+    email = django_filters.CharFilter(method="filter_contains")
     gender = django_filters.ChoiceFilter(choices=User.GENDER_CHOICES)
-    location = django_filters.CharFilter(lookup_expr="icontains")
-    phone_number = django_filters.CharFilter(lookup_expr="icontains")
+    location = django_filters.CharFilter(method="filter_contains")
+    phone_number = django_filters.CharFilter(method="filter_contains")
 
     class Meta:
         model = User
         fields = ['username', 'email', 'gender', 'location', 'phone_number']
+
+    def filter_contains(self, queryset, name, value):
+        return search(queryset, name, value)
@@ -0,0 +1,261 @@
+"""
+IP geolocation used by ``GetLocationAPIView``.
+
+The backend is chosen by ``settings.GEOLOCATION_BACKEND``:
+
+- ``IPInfoBackend`` asks ipinfo. Lookups go through an in-process LRU cache,
+  then the shared Django cache (Redis in production), and only then to
+  ipinfo. Bogon and unresolvable IPs are cached too, for a shorter time.
+- ``IPRangeDatabaseBackend`` resolves offline from a memory-mapped range
+  file built with ``manage.py build_ip_database``.
+"""
+import ipaddress
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from redis.exceptions import RedisError
+from rest_framework.throttling import BaseThrottle
+
+from .clients import get_async_client, get_client
+from .ipdb import IPRangeDatabase
+
+logger = logging.getLogger(__name__)
+
+CACHE_KEY_PREFIX = "geo:ip:"
+
+# Stored in place of location data for IPs ipinfo could not resolve.
+NEGATIVE = "unresolved"
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    A small thread-safe LRU cache with a per-entry time to live.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                return default
+            value, expires_at = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_local_cache = LRUCache(settings.GEOLOCATION_LOCAL_CACHE_SIZE)
+
+
+def client_ip(request):
+    """
+    The client IP, as the throttles see it: the X-Forwarded-For entry added
+    by the outermost trusted proxy (``REST_FRAMEWORK['NUM_PROXIES']``), else
+    ``REMOTE_ADDR``. ``None`` if that isn't an IP address.
+    """
+    try:
+        return str(ipaddress.ip_address(BaseThrottle().get_ident(request).strip()))
+    except ValueError:
+        return None
+
+
+def fetch_location(ip):
+    """
+    Ask ipinfo about ``ip``.
+
+    Returns the location dict, or ``None`` if ipinfo could not place the IP.
+    Raises ``requests.RequestException`` when ipinfo is unreachable or
+    answers with an error (e.g. 429 once the quota is used up).
+    """
+    response = get_client("ipinfo").get(f"/{ip}/json")
+    response.raise_for_status()
+    return parse_location(response.json(), ip)
+
+
+async def afetch_location(ip):
+    """ ``fetch_location`` on the async client. """
+    response = await get_async_client("ipinfo").get(f"/{ip}/json")
+    if response.is_error:
+        raise requests.exceptions.HTTPError(f"{response.status_code} error from ipinfo for {ip}")
+    try:
+        data = response.json()
+    except ValueError as exc:
+        # What requests raises for an unreadable body.
+        raise requests.exceptions.InvalidJSONError(str(exc)) from exc
+    return parse_location(data, ip)
+
+
+def parse_location(response, ip):
+    """ ipinfo's answer as a location dict, or ``None`` if it couldn't place the IP. """
+    if response.get("bogon", False) or "country" not in response:
+        return None
+
+    # Extract lat/lon from 'loc' field
+    loc = response.get("loc", ",").split(",")
+    latitude, longitude = loc if len(loc) == 2 else ("", "")
+
+    return {
+        "country": response.get("country", ""),
+        "region": response.get("region", ""),
+        "city": response.get("city", ""),
+        "lat": latitude,
+        "lon": longitude,
+        "ip": response.get("ip", ip),
+    }
+
+
+def _cache_get(key):
+    try:
+        return cache.get(key, _MISSING)
+    except RedisError:
+        logger.exception("Geolocation cache unavailable; treating %s as a miss", key)
+        return _MISSING
+
+
+def _cache_set(key, value, ttl):
+    try:
+        cache.set(key, value, ttl)
+    except RedisError:
+        logger.exception("Could not cache %s", key)
+
+
+class IPInfoBackend:
+    """
+    Resolve through ipinfo, with positive and negative caching. A shared
+    cache that can't be reached counts as a miss.
+    """
+
+    def lookup(self, ip):
+        """
+        Cached ``fetch_location``. Upstream errors are raised and never cached.
+        """
+        key = CACHE_KEY_PREFIX + ip
+
+        value = _local_cache.get(key, _MISSING)
+        if value is _MISSING:
+            value = _cache_get(key)
+            if value is _MISSING:
+                location = fetch_location(ip)
+                value = NEGATIVE if location is None else location
+                _cache_set(key, value, self._ttl(location))
+            _local_cache.set(key, value, settings.GEOLOCATION_LOCAL_CACHE_TTL)
+
+        return None if value == NEGATIVE else value
+
+    async def alookup(self, ip):
+        """ ``lookup`` for async views. """
+        key = CACHE_KEY_PREFIX + ip
+
+        value = _local_cache.get(key, _MISSING)
+        if value is _MISSING:
+            value = await sync_to_async(_cache_get, thread_sensitive=False)(key)
+            if value is _MISSING:
+                location = await afetch_location(ip)
+                value = NEGATIVE if location is None else location
+                await sync_to_async(_cache_set, thread_sensitive=False)(key, value, self._ttl(location))
+            _local_cache.set(key, value, settings.GEOLOCATION_LOCAL_CACHE_TTL)
+
+        return None if value == NEGATIVE else value
+
+    def _ttl(self, location):
+        if location is None:
+            return settings.GEOLOCATION_NEGATIVE_CACHE_TTL
+        return settings.GEOLOCATION_CACHE_TTL
+
+
+class IPRangeDatabaseBackend:
+    """ Resolve from the local range file at ``GEOLOCATION_DATABASE_PATH``. """
+
+    def __init__(self):
+        path = settings.GEOLOCATION_DATABASE_PATH
+        if not path:
+            raise ImproperlyConfigured(
+                "GEOLOCATION_DATABASE_PATH must be set to use IPRangeDatabaseBackend.")
+        self.database = IPRangeDatabase(path)
+
+    def lookup(self, ip):
+        try:
+            location = self.database.lookup(ip)
+        except ValueError:
+            return None
+        if location is None:
+            return None
+        return {**location, "ip": ip}
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = import_string(settings.GEOLOCATION_BACKEND)()
+    return _backend
+
+
+@receiver(setting_changed)
+def _reset_backend(setting, **kwargs):
+    global _backend
+    if setting in ("GEOLOCATION_BACKEND", "GEOLOCATION_DATABASE_PATH"):
+        _backend = None
+
+
+def lookup_location(ip):
+    """
+    Resolve ``ip`` with the configured backend.
+
+    Returns the location dict, or ``None`` if the IP cannot be placed (or
+    is ``None``, as ``client_ip`` returns for an invalid address).
+    """
+    if ip is None:
+        return None
+    return get_backend().lookup(ip)
+
+
+async def alookup_location(ip):
+    """
+    ``lookup_location`` for async views. Backends without an ``alookup``
+    resolve locally and are called directly.
+    """
+    if ip is None:
+        return None
+    backend = get_backend()
+    if hasattr(backend, "alookup"):
+        return await backend.alookup(ip)
+    return backend.lookup(ip)
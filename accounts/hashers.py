@@ -0,0 +1,64 @@
+"""
+Password hashing with a per-deployment work factor.
+
+``ConfigurablePBKDF2PasswordHasher`` reads its iteration count from
+``settings.PASSWORD_HASHER_ITERATIONS``. It keeps Django's ``pbkdf2_sha256``
+algorithm name, so existing hashes still verify, and Django's
+``must_update`` check rehashes any password stored with a different count
+the next time its owner logs in.
+"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher, check_password, make_password
+
+
+class ConfigurablePBKDF2PasswordHasher(PBKDF2PasswordHasher):
+
+    @property
+    def iterations(self):
+        return settings.PASSWORD_HASHER_ITERATIONS
+
+
+def verify_password(password, encoded):
+    """
+    Return ``(is_correct, needs_rehash)`` for ``password`` against
+    ``encoded``. Pure CPU: safe to run on any thread.
+
+    With no ``encoded`` hash (unknown user) a throwaway hash is still
+    computed, so response time doesn't reveal whether the account exists.
+    """
+    if encoded is None:
+        make_password(password)
+        return False, False
+
+    needs_rehash = []
+    is_correct = check_password(password, encoded, setter=lambda raw: needs_rehash.append(True))
+    return is_correct, bool(needs_rehash)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_hash_pool():
+    """
+    Bounded pool for password hashing. PBKDF2 releases the GIL, so threads
+    hash in parallel while the event loop keeps serving other requests.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(
+                    max_workers=settings.PASSWORD_HASH_WORKERS,
+                    thread_name_prefix="password-hash",
+                )
+    return _pool
+
+
+async def run_in_hash_pool(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_hash_pool(), func, *args)
@@ -0,0 +1,271 @@
+"""
+``Idempotency-Key`` support for endpoints that clients retry (registration,
+OTP requests).
+
+The first request with a given key runs the view and its response is kept
+in Redis for ``IDEMPOTENCY_KEY_TTL`` seconds; later requests with the same
+key and body get that response back (with ``Idempotent-Replayed: true``)
+without the view running again, so a retry doesn't create another OTP or
+send another email. While the first request is in flight it holds a lock
+on the key for at most ``IDEMPOTENCY_IN_FLIGHT_TIMEOUT`` seconds;
+duplicates wait up to ``IDEMPOTENCY_WAIT_TIMEOUT`` seconds for its response
+and then get a 409. A key reused with a different body gets a 422.
+
+The lock holds a token unique to the request and is only released by the
+request whose token it still holds, so a request that outlived its lock
+can't release one a retry has since taken. Keys must be seen by every
+worker, so this needs ``REDIS_URL``: without it (as when Redis errors) the
+header is ignored and a warning logged, and with
+``IDEMPOTENCY_ENABLED = False`` it is ignored outright.
+
+Requests without the header are handled as before. Sync and async routes
+of an endpoint share a scope, so a retry may land on either.
+"""
+import asyncio
+import base64
+import functools
+import hashlib
+import json
+import logging
+import time
+import uuid
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+from redis.exceptions import RedisError
+
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+WAIT_POLL_INTERVAL = 0.05  # seconds
+
+# Deletes the lock only while it still holds this request's value.
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_release_script = None
+_warned_no_redis = False
+
+
+def _key(scope, idempotency_key):
+    digest = hashlib.sha1(idempotency_key.encode("utf-8")).hexdigest()
+    return f"idempotency:{scope}:{digest}"
+
+
+def _lock_key(scope, idempotency_key):
+    return f"{_key(scope, idempotency_key)}:lock"
+
+
+def _stored(response):
+    """ Whether ``response`` is the outcome to replay; errors worth retrying aren't. """
+    return response.status_code < 500 and response.status_code != 429
+
+
+def _serialize(fingerprint, response):
+    if hasattr(response, "render"):
+        response.render()
+    return json.dumps({
+        "fingerprint": fingerprint,
+        "status": response.status_code,
+        "content": base64.b64encode(response.content).decode("ascii"),
+        "content_type": response["Content-Type"],
+    })
+
+
+def _replay(raw, fingerprint):
+    entry = json.loads(raw)
+    if entry["fingerprint"] != fingerprint:
+        return _mismatch()
+    response = HttpResponse(
+        base64.b64decode(entry["content"]), status=entry["status"], content_type=entry["content_type"])
+    response["Idempotent-Replayed"] = "true"
+    return response
+
+
+def _mismatch():
+    return JsonResponse(
+        {"detail": f"This {HEADER} was already used with a different request."}, status=422)
+
+
+def _still_running():
+    return JsonResponse(
+        {"detail": f"A request with this {HEADER} is still being processed; retry later."}, status=409)
+
+
+class _Claim:
+    """ This request's hold on an idempotency key. """
+
+    def __init__(self, redis, scope, idempotency_key, fingerprint):
+        self.redis = redis
+        self.key = _key(scope, idempotency_key)
+        self.lock_key = _lock_key(scope, idempotency_key)
+        self.fingerprint = fingerprint
+        self.lock_value = f"{uuid.uuid4().hex}:{fingerprint}"
+
+    def attempt(self):
+        """
+        One try at taking the key: ``(True, None)`` once this request holds
+        it and should run the view, ``(False, response)`` when there's a
+        response to send instead and ``(False, None)`` while another request
+        with the same body holds it.
+        """
+        entry = self.redis.get(self.key)
+        if entry is not None:
+            return False, _replay(entry, self.fingerprint)
+        if self.redis.set(self.lock_key, self.lock_value, nx=True, ex=settings.IDEMPOTENCY_IN_FLIGHT_TIMEOUT):
+            # The holder may have finished between the get and the set.
+            entry = self.redis.get(self.key)
+            if entry is None:
+                return True, None
+            self.release()
+            return False, _replay(entry, self.fingerprint)
+        holder = self.redis.get(self.lock_key)
+        if holder is not None and holder.decode().partition(":")[2] != self.fingerprint:
+            return False, _mismatch()
+        return False, None
+
+    def finish(self, response):
+        """ Keep ``response`` for replay if it's final, then release the lock. """
+        try:
+            if _stored(response):
+                self.redis.set(self.key, _serialize(self.fingerprint, response), ex=settings.IDEMPOTENCY_KEY_TTL)
+        finally:
+            self.release()
+
+    def release(self):
+        global _release_script
+        if _release_script is None or _release_script.registered_client is not self.redis:
+            _release_script = self.redis.register_script(RELEASE_SCRIPT)
+        _release_script(keys=[self.lock_key], args=[self.lock_value])
+
+
+def _begin(claim):
+    """
+    ``None`` once ``claim`` holds the key and the view should run; otherwise
+    the response to send instead.
+    """
+    deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT_TIMEOUT
+    while True:
+        acquired, response = claim.attempt()
+        if acquired:
+            return None
+        if response is not None:
+            return response
+        if time.monotonic() >= deadline:
+            return _still_running()
+        time.sleep(WAIT_POLL_INTERVAL)
+
+
+async def _abegin(claim):
+    """ ``_begin`` for async views; Redis calls run off the event loop. """
+    attempt = sync_to_async(claim.attempt, thread_sensitive=False)
+    deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT_TIMEOUT
+    while True:
+        acquired, response = await attempt()
+        if acquired:
+            return None
+        if response is not None:
+            return response
+        if time.monotonic() >= deadline:
+            return _still_running()
+        await asyncio.sleep(WAIT_POLL_INTERVAL)
+
+
+def _finish(claim, response):
+    """ Store ``response`` (``None`` if the view raised) and release the lock. """
+    try:
+        if response is None:
+            claim.release()
+        else:
+            claim.finish(response)
+    except RedisError:
+        # The lock expires on its own; the next retry runs the view again.
+        logger.exception("Idempotency store unavailable; response not kept for replay")
+
+
+async def _afinish(claim, response):
+    await sync_to_async(_finish, thread_sensitive=False)(claim, response)
+
+
+def _prepare(request, scope):
+    """
+    ``(claim, error_response)`` for ``request``; ``claim`` is ``None``
+    without the header, with idempotency disabled or without Redis.
+    """
+    global _warned_no_redis
+    idempotency_key = request.headers.get(HEADER, "").strip()
+    if not idempotency_key or not settings.IDEMPOTENCY_ENABLED:
+        return None, None
+    if len(idempotency_key) > MAX_KEY_LENGTH:
+        return None, JsonResponse(
+            {"detail": f"{HEADER} must be at most {MAX_KEY_LENGTH} characters."}, status=400)
+    redis = get_redis()
+    if redis is None:
+        if not _warned_no_redis:
+            _warned_no_redis = True
+            logger.warning("REDIS_URL is not set; ignoring %s headers. "
+                           "Set IDEMPOTENCY_ENABLED = False to silence this.", HEADER)
+        return None, None
+    return _Claim(redis, scope, idempotency_key, hashlib.sha256(request.body).hexdigest()), None
+
+
+def idempotent(scope):
+    """
+    Decorate a view (sync or async) so requests carrying an
+    ``Idempotency-Key`` header run it at most once per key within ``scope``.
+    """
+
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def wrapped(request, *args, **kwargs):
+                claim, error = _prepare(request, scope)
+                if error is not None:
+                    return error
+                if claim is None:
+                    return await view(request, *args, **kwargs)
+                try:
+                    replay = await _abegin(claim)
+                except RedisError:
+                    logger.exception("Idempotency store unavailable; running the request unguarded")
+                    return await view(request, *args, **kwargs)
+                if replay is not None:
+                    return replay
+                response = None
+                try:
+                    response = await view(request, *args, **kwargs)
+                finally:
+                    await _afinish(claim, response)
+                return response
+        else:
+            @functools.wraps(view)
+            def wrapped(request, *args, **kwargs):
+                claim, error = _prepare(request, scope)
+                if error is not None:
+                    return error
+                if claim is None:
+                    return view(request, *args, **kwargs)
+                try:
+                    replay = _begin(claim)
+                except RedisError:
+                    logger.exception("Idempotency store unavailable; running the request unguarded")
+                    return view(request, *args, **kwargs)
+                if replay is not None:
+                    return replay
+                response = None
+                try:
+                    response = view(request, *args, **kwargs)
+                finally:
+                    _finish(claim, response)
+                return response
+        return wrapped
+
+    return decorator
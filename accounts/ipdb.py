@@ -0,0 +1,139 @@
+"""
+Compact on-disk IP-range database for offline geolocation.
+
+File layout (all integers little-endian unless noted)::
+
+    header   magic(8) v4_count(u32) v6_count(u32) v4_offset(u64) v6_offset(u64)
+    v4 table v4_count x [start(4, big-endian) end(4, big-endian) location(u32)]
+    v6 table v6_count x [start(16, big-endian) end(16, big-endian) location(u32)]
+    strings  length(u16) + UTF-8 "country\\x1fregion\\x1fcity\\x1flat\\x1flon" ...
+
+Tables are sorted by start address and ranges never overlap, so a lookup is
+a binary search over fixed-width records in the memory-mapped file. Addresses
+are stored big-endian so records compare as plain bytes.
+"""
+import ipaddress
+import mmap
+import os
+import struct
+
+MAGIC = b"IPRDB\x00\x01\x00"
+HEADER = struct.Struct("<8sIIQQ")
+LOCATION_REF = struct.Struct("<I")
+STRING_LENGTH = struct.Struct("<H")
+FIELD_SEPARATOR = "\x1f"
+LOCATION_FIELDS = ("country", "region", "city", "lat", "lon")
+
+
+class IPDatabaseError(Exception):
+    pass
+
+
+class IPRangeDatabase:
+    """
+    Read-only view of a database file built by ``write_database``.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, v4_count, v6_count, v4_offset, v6_offset = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise IPDatabaseError(f"{path} is not an IP range database")
+        # (offset, count, address width) per IP version
+        self._tables = {
+            4: (v4_offset, v4_count, 4),
+            6: (v6_offset, v6_count, 16),
+        }
+
+    def close(self):
+        self._mm.close()
+
+    def lookup(self, ip):
+        """
+        Return the location dict for ``ip``, or ``None`` if it is not covered.
+        Raises ``ValueError`` for malformed addresses.
+        """
+        address = ipaddress.ip_address(ip)
+        offset, count, width = self._tables[address.version]
+        key = address.packed
+        record_size = width * 2 + LOCATION_REF.size
+        mm = self._mm
+
+        # Find the last range whose start is <= key.
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = offset + mid * record_size
+            if mm[start:start + width] <= key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return None
+
+        record = offset + (lo - 1) * record_size
+        if key > mm[record + width:record + width * 2]:
+            return None
+        (location_offset,) = LOCATION_REF.unpack_from(mm, record + width * 2)
+        return self._read_location(location_offset)
+
+    def _read_location(self, offset):
+        (length,) = STRING_LENGTH.unpack_from(self._mm, offset)
+        start = offset + STRING_LENGTH.size
+        values = self._mm[start:start + length].decode("utf-8").split(FIELD_SEPARATOR)
+        return dict(zip(LOCATION_FIELDS, values))
+
+
+def write_database(ranges, path):
+    """
+    Write ``ranges`` to ``path`` atomically.
+
+    ``ranges`` yields ``(start_ip, end_ip, location)`` tuples where
+    ``location`` maps the names in ``LOCATION_FIELDS`` to strings. Overlapping
+    ranges are dropped in favour of the one that starts first. Returns
+    ``(written, skipped)`` counts.
+    """
+    tables = {4: [], 6: []}
+    for start_ip, end_ip, location in ranges:
+        start = ipaddress.ip_address(start_ip)
+        end = ipaddress.ip_address(end_ip)
+        if start.version != end.version or start > end:
+            raise IPDatabaseError(f"Invalid range {start_ip} - {end_ip}")
+        encoded = FIELD_SEPARATOR.join(
+            str(location.get(field) or "") for field in LOCATION_FIELDS
+        ).encode("utf-8")
+        tables[start.version].append((start.packed, end.packed, encoded))
+
+    strings = bytearray()
+    string_offsets = {}
+    records = {}
+    skipped = 0
+    for version, rows in tables.items():
+        rows.sort()
+        kept = []
+        for start, end, encoded in rows:
+            if kept and start <= kept[-1][1]:
+                skipped += 1
+                continue
+            kept.append((start, end, encoded))
+            if encoded not in string_offsets:
+                string_offsets[encoded] = len(strings)
+                strings += STRING_LENGTH.pack(len(encoded)) + encoded
+        records[version] = kept
+
+    v4_offset = HEADER.size
+    v6_offset = v4_offset + len(records[4]) * (4 * 2 + LOCATION_REF.size)
+    strings_offset = v6_offset + len(records[6]) * (16 * 2 + LOCATION_REF.size)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(records[4]), len(records[6]), v4_offset, v6_offset))
+        for version in (4, 6):
+            for start, end, encoded in records[version]:
+                f.write(start + end + LOCATION_REF.pack(strings_offset + string_offsets[encoded]))
+        f.write(strings)
+    # Readers keep their mapping of the old file; new readers see the new one.
+    os.replace(tmp_path, path)
+
+    return len(records[4]) + len(records[6]), skipped
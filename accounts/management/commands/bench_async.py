@@ -0,0 +1,105 @@
+import asyncio
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import AsyncClient, Client
+
+from accounts.bench import bench_environment, create_bench_user, seed_users, summarize
+from accounts.serializers import issue_tokens
+
+API = "/api/v1"
+
+
+class Command(BaseCommand):
+    help = "Compare the sync views under WSGI-style workers with the async views on one event loop"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=500, help="Users seeded before the run")
+        parser.add_argument("--requests", type=int, default=200, help="Requests per endpoint and stack")
+        parser.add_argument("--concurrency", type=int, default=50, help="Clients sending requests at once")
+        parser.add_argument("--wsgi-workers", type=int, default=4,
+                            help="Requests the WSGI stack handles at once (gunicorn workers x threads)")
+        parser.add_argument("--upstream-latency", type=float, default=0.05,
+                            help="Seconds the fake ipinfo/Plunk server waits before answering")
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(42)
+        with bench_environment(options["upstream_latency"]) as upstreams:
+            self.usernames = seed_users(options["users"]) or ["bench"]
+            self.token = issue_tokens(create_bench_user("bench"))["access"]
+            self.ips = (f"198.51.{n // 250}.{n % 250}" for n in itertools.count())
+
+            self.stdout.write(
+                f"{options['requests']} requests per endpoint, {options['concurrency']} concurrent clients, "
+                f"{options['wsgi_workers']} WSGI workers, upstream latency {options['upstream_latency'] * 1000:.0f}ms"
+            )
+            self.stdout.write(f"{'endpoint':<16}{'stack':<7}{'p50':>10}{'p95':>10}{'req/s':>9}")
+            for name in ("get_location", "user_detail", "availability"):
+                wsgi = self.run_wsgi(name, options)
+                asgi = asyncio.run(self.run_asgi(name, options))
+                for stack, summary in (("wsgi", wsgi), ("asgi", asgi)):
+                    self.stdout.write(
+                        f"{name:<16}{stack:<7}{summary['p50_ms']:>8.1f}ms{summary['p95_ms']:>8.1f}ms"
+                        f"{summary['throughput_rps']:>9.1f}"
+                    )
+                self.stdout.write(f"{'':<16}async/sync throughput: "
+                                  f"{asgi['throughput_rps'] / wsgi['throughput_rps']:.1f}x")
+            self.stdout.write(f"Upstream calls: {upstreams.calls}")
+        self.stdout.write(self.style.SUCCESS("✅ Done."))
+
+    def request(self, name):
+        """ ``(path, params, headers)`` for one request; every location lookup misses the cache. """
+        auth = {"Authorization": f"Bearer {self.token}"}
+        if name == "get_location":
+            return "/get-location/", {}, {**auth, "X-Forwarded-For": next(self.ips)}
+        if name == "user_detail":
+            return f"/users/{self.rng.choice(self.usernames)}/", {}, auth
+        return "/availability/", {"username": "someone-new"}, {}
+
+    def run_wsgi(self, name, options):
+        """
+        ``--concurrency`` client threads calling the sync views, at most
+        ``--wsgi-workers`` of them inside Django at once.
+        """
+        workers = threading.Semaphore(options["wsgi_workers"])
+        local = threading.local()
+        requests = [self.request(name) for _ in range(options["requests"])]
+
+        def call(request):
+            path, params, headers = request
+            if not hasattr(local, "client"):
+                local.client = Client()
+            started = time.perf_counter()
+            with workers:
+                response = local.client.get(API + path, params, headers=headers)
+            latency = time.perf_counter() - started
+            if response.status_code != 200:
+                raise CommandError(f"{name} (wsgi): {response.status_code} {response.content[:200]!r}")
+            return latency
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as pool:
+            latencies = list(pool.map(call, requests))
+        return summarize(latencies, [0], time.perf_counter() - started)
+
+    async def run_asgi(self, name, options):
+        """ ``--concurrency`` concurrent clients calling the async views on this event loop. """
+        client = AsyncClient()
+        requests = iter([self.request(name) for _ in range(options["requests"])])
+        latencies = []
+
+        async def worker():
+            for path, params, headers in requests:
+                started = time.perf_counter()
+                response = await client.get(f"{API}{path}async/", params, headers=headers)
+                latencies.append(time.perf_counter() - started)
+                if response.status_code != 200:
+                    raise CommandError(f"{name} (asgi): {response.status_code} {response.content[:200]!r}")
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(options["concurrency"])))
+        return summarize(latencies, [0], time.perf_counter() - started)
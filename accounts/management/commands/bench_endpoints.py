@@ -0,0 +1,193 @@
+import itertools
+import json
+import random
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from accounts.bench import (
+    PASSWORD, bench_environment, create_bench_user, find_regressions, seed_users, summarize,
+)
+from accounts.otp_store import get_otp_store
+from accounts.serializers import issue_tokens
+
+API = "/api/v1"
+
+
+class Command(BaseCommand):
+    help = "Benchmark every accounts endpoint against a seeded test database"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000, help="Users seeded before the run")
+        parser.add_argument("--requests", type=int, default=50, help="Requests per endpoint")
+        parser.add_argument("--only", action="append", help="Run only these scenarios (repeatable)")
+        parser.add_argument("--upstream-latency", type=float, default=0.0,
+                            help="Seconds the fake Plunk/ipinfo server waits before answering")
+        parser.add_argument("--baseline", default=str(settings.BASE_DIR / "bench_baseline.json"),
+                            help="Baseline JSON to compare against")
+        parser.add_argument("--save-baseline", action="store_true", help="Write this run as the new baseline")
+        parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed latency growth (0.2 = 20%%)")
+        parser.add_argument("--output", help="Also write the results to this JSON file")
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(42)
+        with bench_environment(options["upstream_latency"]) as upstreams:
+            self.seed(options["users"])
+            results = self.run_scenarios(options["requests"], options["only"])
+            self.stdout.write(f"Upstream calls: {upstreams.calls}")
+
+        report = {
+            "meta": {"users": options["users"], "requests": options["requests"], "database": connection.vendor},
+            "results": results,
+        }
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(report, f, indent=2)
+        if options["save_baseline"]:
+            with open(options["baseline"], "w") as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"✅ Baseline saved to {options['baseline']}"))
+            return
+
+        try:
+            with open(options["baseline"]) as f:
+                baseline = json.load(f)["results"]
+        except FileNotFoundError:
+            raise CommandError(f"No baseline at {options['baseline']}; run with --save-baseline to create one.")
+        regressions = find_regressions(results, baseline, options["tolerance"])
+        if regressions:
+            raise CommandError("Performance regressions:\n" + "\n".join(regressions))
+        self.stdout.write(self.style.SUCCESS("✅ No regressions against the baseline."))
+
+    def seed(self, count):
+        self.stdout.write(f"Seeding {count} users...")
+        self.usernames = seed_users(count) or ["bench"]
+        self.member = create_bench_user("bench")
+        self.staff = create_bench_user("benchstaff", is_staff=True)
+        self.member_auth = self.bearer(self.member)
+
+    def bearer(self, user):
+        return {"HTTP_AUTHORIZATION": f"Bearer {issue_tokens(user)['access']}"}
+
+    def scenarios(self):
+        """ ``name -> (prepare(i) -> (method, path, data, extra), expected status)``. """
+        member = self.member
+
+        registrations = itertools.count()
+
+        def register(i):
+            n = next(registrations)
+            return "post", "/register/", {
+                "email": f"bench-reg-{n}@example.com", "username": f"benchreg{n}",
+                "first_name": "New", "last_name": "User", "dob": "1990-01-01", "gender": "female",
+                "phone_number": "08012345678", "location": "Lagos, NG",
+                "password": PASSWORD, "confirm_password": PASSWORD,
+            }, {}
+
+        def availability(i):
+            username = self.rng.choice(self.usernames) if i % 2 else f"free{i}"
+            return "get", "/availability/", {"username": username, "email": f"{username}@example.com"}, {}
+
+        def otp_request(i):
+            return "post", "/otp/request/", {"email": member.email}, {}
+
+        def otp_verify(i):
+            return "post", "/otp/verify/", {"email": member.email, "code": get_otp_store().issue(member)}, {}
+
+        def otp_general_verify(i):
+            return "post", "/otp/general-verify/", {"email": member.email, "code": get_otp_store().issue(member)}, {}
+
+        def login(i):
+            return "post", "/login/", {"email": member.email, "password": PASSWORD}, {}
+
+        def logout(i):
+            tokens = issue_tokens(member)
+            return "post", "/logout/", {"refresh": tokens["refresh"]}, {
+                "HTTP_AUTHORIZATION": f"Bearer {tokens['access']}"}
+
+        def token_refresh(i):
+            return "post", "/token/refresh/", {"refresh": issue_tokens(member)["refresh"]}, {}
+
+        def get_location(i):
+            return "get", "/get-location/", {}, {**self.member_auth, "REMOTE_ADDR": f"203.0.113.{i % 250}"}
+
+        def user_detail(i):
+            return "get", f"/users/{self.rng.choice(self.usernames)}/", {}, self.member_auth
+
+        # Cycle through pages that exist however many users were seeded.
+        pages = max(1, len(self.usernames) // 50)
+
+        def user_list(i):
+            return "get", "/users/", {"page": i % pages + 1, "page_size": 50}, self.member_auth
+
+        def user_search(i):
+            return "get", "/users/", {"username": f"eed{i % 100}", "pagination": "cursor"}, self.member_auth
+
+        def export(i):
+            return "get", "/export/users/", {"output": "ndjson"}, self.bearer(self.staff)
+
+        scenarios = {
+            "register": (register, 201),
+            "availability": (availability, 200),
+            "otp_request": (otp_request, 200),
+            "otp_verify": (otp_verify, 200),
+            "otp_general_verify": (otp_general_verify, 200),
+            "login": (login, 200),
+            "logout": (logout, 200),
+            "token_refresh": (token_refresh, 200),
+            "get_location": (get_location, 200),
+            "user_detail": (user_detail, 200),
+            "user_list": (user_list, 200),
+            "user_search": (user_search, 200),
+            "export_users": (export, 200),
+        }
+        # The native async views, at the same path plus "async/".
+        for name in ("register", "availability", "otp_request", "otp_verify", "otp_general_verify",
+                     "login", "logout", "get_location", "user_detail"):
+            prepare, expected = scenarios[name]
+            scenarios[f"{name}_async"] = (self.async_route(prepare), expected)
+        return scenarios
+
+    @staticmethod
+    def async_route(prepare):
+        def prepare_async(i):
+            method, path, data, extra = prepare(i)
+            return method, f"{path}async/", data, extra
+        return prepare_async
+
+    def run_scenarios(self, count, only):
+        client = Client()
+        results = {}
+        self.stdout.write(f"{'endpoint':<26}{'p50':>9}{'p95':>9}{'p99':>9}{'queries':>9}{'seq/s':>9}")
+        for name, (prepare, expected) in self.scenarios().items():
+            if only and name not in only:
+                continue
+            latencies, queries = [], []
+            for i in range(count):
+                method, path, data, extra = prepare(i)
+                if method == "post":
+                    call = lambda: client.post(API + path, data=json.dumps(data),
+                                               content_type="application/json", **extra)
+                else:
+                    call = lambda: client.get(API + path, data, **extra)
+                with CaptureQueriesContext(connection) as captured:
+                    started = time.perf_counter()
+                    response = call()
+                    if response.streaming:
+                        b"".join(response.streaming_content)
+                    latency = time.perf_counter() - started
+                if response.status_code != expected:
+                    raise CommandError(
+                        f"{name}: expected {expected}, got {response.status_code}: {response.content[:300]!r}")
+                latencies.append(latency)
+                queries.append(len(captured))
+            results[name] = summary = summarize(latencies, queries)
+            self.stdout.write(
+                f"{name:<26}{summary['p50_ms']:>8.2f}ms{summary['p95_ms']:>7.2f}ms{summary['p99_ms']:>7.2f}ms"
+                f"{summary['queries_mean']:>9.1f}{summary['sequential_rps']:>9.1f}"
+            )
+        return results
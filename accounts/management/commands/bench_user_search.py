@@ -0,0 +1,99 @@
+import random
+import statistics
+import string
+import time
+from datetime import date
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from accounts.models import User
+from accounts.search import index_users, search, uses_trigram_indexes
+
+
+def timed(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return result, samples
+
+
+class Command(BaseCommand):
+    help = "Compare icontains scans with the indexed user search"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--seed", type=int, default=0,
+                            help="Insert this many synthetic users first (rolled back afterwards)")
+        parser.add_argument("--repeat", type=int, default=20, help="Runs per query")
+        parser.add_argument("--term", action="append", dest="terms",
+                            help="field=value to search (repeatable)")
+
+    def handle(self, *args, **options):
+        backend = "pg_trgm GIN indexes" if uses_trigram_indexes() else "n-gram table"
+        self.stdout.write(f"Database: {connection.vendor}, indexed path: {backend}")
+        with transaction.atomic():
+            if options["seed"]:
+                self.seed(options["seed"])
+            self.stdout.write(f"Users: {User.objects.count()}")
+            terms = [term.split("=", 1) for term in options["terms"] or []] or self.default_terms()
+            for field, value in terms:
+                self.compare(field, value, options["repeat"])
+            # Leave the database exactly as we found it.
+            transaction.set_rollback(True)
+
+    def seed(self, count):
+        self.stdout.write(f"Seeding {count} users...")
+        rng = random.Random(42)
+        cities = ["Lagos", "Abuja", "Accra", "Nairobi", "London", "Toronto", "Berlin", "Austin"]
+        tag = "".join(rng.choices(string.ascii_lowercase, k=6))
+        batch = []
+        for i in range(count):
+            name = "".join(rng.choices(string.ascii_lowercase, k=8))
+            batch.append(User(
+                username=f"{name}{i}{tag}",
+                email=f"{name}.{i}.{tag}@example.com",
+                first_name=name.title(),
+                last_name="Bench",
+                dob=date(1990, 1, 1),
+                gender=rng.choice(User.GENDER_CHOICES)[0],
+                location=f"{rng.choice(cities)}, {rng.choice(['NG', 'GH', 'KE', 'GB', 'CA', 'DE', 'US'])}",
+                phone_number=f"+234{rng.randrange(10**9, 10**10)}",
+                password="!",
+            ))
+            if len(batch) == 5000:
+                index_users(User.objects.bulk_create(batch))
+                batch = []
+        if batch:
+            index_users(User.objects.bulk_create(batch))
+
+    def default_terms(self):
+        sample = User.objects.exclude(username="").order_by("?").first()
+        if sample is None:
+            return [("username", "bench"), ("email", "example"), ("location", "lagos")]
+        return [
+            ("username", sample.username[1:6]),
+            ("email", sample.email.split("@")[0][:6]),
+            ("location", (sample.location or "lagos")[:5]),
+            ("phone_number", (sample.phone_number or "234")[-5:]),
+            ("username", sample.username[:2]),
+        ]
+
+    def compare(self, field, value, repeat):
+        queryset = User.objects.order_by("-id")
+        scan = queryset.filter(**{f"{field}__icontains": value})
+        indexed = search(queryset, field, value)
+
+        scan_ids, scan_ms = timed(lambda: list(scan.values_list("pk", flat=True)), repeat)
+        indexed_ids, indexed_ms = timed(lambda: list(indexed.values_list("pk", flat=True)), repeat)
+
+        if scan_ids != indexed_ids:
+            self.stdout.write(self.style.ERROR(f"❌ {field}={value!r}: results differ"))
+        scan_p50, indexed_p50 = statistics.median(scan_ms), statistics.median(indexed_ms)
+        self.stdout.write(
+            f"{field}={value!r} rows={len(scan_ids)} "
+            f"icontains p50={scan_p50:.2f}ms max={max(scan_ms):.2f}ms | "
+            f"indexed p50={indexed_p50:.2f}ms max={max(indexed_ms):.2f}ms "
+            f"({scan_p50 / indexed_p50 if indexed_p50 else 0:.1f}x)"
+        )
@@ -0,0 +1,77 @@
+import statistics
+import time
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from accounts.models import User
+from accounts.renderers import FastJSONRenderer
+from accounts.serializers import UserSerializer, represent_user_rows, user_values
+
+
+def timed(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return result, samples
+
+
+class Command(BaseCommand):
+    help = "Compare UserSerializer + JSONRenderer with the .values() + orjson fast path"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--page-size", type=int, action="append", dest="page_sizes",
+                            help="Rows per page (repeatable, default 10 and 50)")
+        parser.add_argument("--repeat", type=int, default=200, help="Runs per page size")
+
+    def handle(self, *args, **options):
+        page_sizes = options["page_sizes"] or [10, 50]
+        with transaction.atomic():
+            self.seed(max(page_sizes))
+            for page_size in page_sizes:
+                self.compare(page_size, options["repeat"])
+            # Leave the database exactly as we found it.
+            transaction.set_rollback(True)
+
+    def seed(self, count):
+        User.objects.bulk_create([
+            User(
+                username=f"bench-serialize-{i}",
+                email=f"bench-serialize-{i}@example.com",
+                first_name="Zoë",
+                last_name="Bench",
+                dob=date(1990, 1, 1 + i % 28),
+                gender="female",
+                phone_number="+2348000000000",
+                location="Lagos, NG" if i % 2 else None,
+                password="!",
+            )
+            for i in range(count)
+        ])
+
+    def compare(self, page_size, repeat):
+        queryset = User.objects.order_by("-id")
+
+        def serializer_path():
+            users = list(queryset[:page_size])
+            return JSONRenderer().render(UserSerializer(users, many=True).data)
+
+        def fast_path():
+            rows = represent_user_rows(list(user_values(queryset)[:page_size]))
+            return FastJSONRenderer().render(rows)
+
+        expected, slow_ms = timed(serializer_path, repeat)
+        actual, fast_ms = timed(fast_path, repeat)
+        if actual != expected:
+            raise CommandError(f"Fast path output differs at page_size={page_size}")
+
+        slow_p50, fast_p50 = statistics.median(slow_ms), statistics.median(fast_ms)
+        self.stdout.write(
+            f"page_size={page_size}: serializer p50={slow_p50:.3f}ms | "
+            f"fast path p50={fast_p50:.3f}ms ({slow_p50 / fast_p50:.1f}x), "
+            f"{len(actual)} identical bytes"
+        )
@@ -0,0 +1,50 @@
+import csv
+import ipaddress
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.ipdb import IPDatabaseError, write_database
+
+
+class Command(BaseCommand):
+    help = (
+        "Build the offline IP geolocation database from a CSV dump with a header "
+        "row of start_ip,end_ip (or network),country,region,city,lat,lon"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("csv_file", help="Path to the CSV dump")
+        parser.add_argument(
+            "--output", default=settings.GEOLOCATION_DATABASE_PATH,
+            help="Where to write the database (defaults to GEOLOCATION_DATABASE_PATH)",
+        )
+
+    def handle(self, *args, **options):
+        output = options["output"]
+        if not output:
+            raise CommandError("Pass --output or set GEOLOCATION_DATABASE_PATH.")
+
+        started = time.monotonic()
+        with open(options["csv_file"], newline="", encoding="utf-8") as f:
+            reader = csv.DictReader(f)
+            try:
+                written, skipped = write_database(self._ranges(reader), output)
+            except (IPDatabaseError, ValueError, KeyError) as e:
+                raise CommandError(f"Line {reader.line_num}: {e}")
+
+        if skipped:
+            self.stdout.write(self.style.WARNING(
+                f"Skipped {skipped} ranges overlapping an earlier one."))
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ Wrote {written} ranges to {output} in {time.monotonic() - started:.1f}s"))
+
+    def _ranges(self, reader):
+        for row in reader:
+            if row.get("network"):
+                network = ipaddress.ip_network(row["network"].strip(), strict=False)
+                start, end = network[0], network[-1]
+            else:
+                start, end = row["start_ip"].strip(), row["end_ip"].strip()
+            yield start, end, row
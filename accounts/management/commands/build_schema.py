@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.schema import write_schema
+
+
+class Command(BaseCommand):
+    help = "Generate the OpenAPI schema served at /api/schema/ for the current code version"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--path", default=settings.OPENAPI_SCHEMA_PATH, help="Where to write the schema")
+
+    def handle(self, *args, **options):
+        version = write_schema(options["path"])
+        self.stdout.write(self.style.SUCCESS(f"✅ Schema for {version} written to {options['path']}"))
@@ -1,24 +1,153 @@
-from django.core.management.base import BaseCommand
+import time
+
+from django.core.exceptions import FieldError, ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models, transaction
+from redis.exceptions import RedisError
+
+from accounts.availability import rebuild_filter
 from accounts.models import User
+from accounts.profile_cache import forget_usernames
+
+
+def parse_filters(expressions):
+    """ ``["is_active=False", "email__endswith=@test.com"]`` -> filter kwargs. """
+    literals = {"true": True, "false": False, "none": None}
+    filters = {}
+    for expression in expressions or []:
+        lookup, sep, value = expression.partition("=")
+        if not sep or not lookup:
+            raise CommandError(f"--filter expects field=value, got {expression!r}")
+        filters[lookup] = literals.get(value.lower(), value)
+    return filters
+
+
+class RelatedRows:
+    """ Rows in another table that point at users through ``field``. """
+
+    def __init__(self, model, field, action="delete"):
+        self.label = model._meta.label
+        self.manager = model._base_manager
+        self.field = field
+        self.action = action
+
+    def queryset(self, ids):
+        return self.manager.filter(**{f"{self.field}__in": ids})
+
+    def clear(self, ids):
+        queryset = self.queryset(ids)
+        if self.action == "set_null":
+            return queryset.update(**{self.field: None})
+        # A single DELETE: none of these rows have signals or cascades of their own.
+        return queryset.delete()[0]
+
+
+def related_rows():
+    """
+    Everything that must be cleared before users can go with a plain
+    DELETE: reverse foreign keys (OTPs, search trigrams, admin log entries,
+    ...) and the group and permission join tables.
+    """
+    rows = [RelatedRows(field.remote_field.through, field.m2m_field_name())
+            for field in User._meta.many_to_many]
+    for relation in User._meta.related_objects:
+        if relation.many_to_many:
+            rows.append(RelatedRows(relation.through, relation.field.m2m_reverse_field_name()))
+        elif relation.on_delete is models.CASCADE:
+            rows.append(RelatedRows(relation.related_model, relation.field.name))
+        elif relation.on_delete is models.SET_NULL:
+            rows.append(RelatedRows(relation.related_model, relation.field.name, "set_null"))
+        elif relation.on_delete is not models.DO_NOTHING:
+            raise CommandError(
+                f"{relation.related_model._meta.label}.{relation.field.name} uses "
+                f"{relation.on_delete.__name__}; delete or detach those rows first.")
+    return rows
 
 
 class Command(BaseCommand):
-    help = "Delete all users from the database"
-
-    def handle(self, *args, **kwargs):
-        confirm = input(
-            "⚠️ Are you sure you want to delete all users? (yes/no): ")
-        if confirm.lower() != "yes":
-            self.stdout.write(self.style.WARNING(
-                "Aborted! No users were deleted."))
-            return
+    help = "Delete non-superuser users in primary-key batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="Users deleted per transaction")
+        parser.add_argument("--filter", action="append", dest="filters", metavar="FIELD=VALUE",
+                            help="Only delete users matching this ORM lookup, e.g. is_active=False (repeatable)")
+        parser.add_argument("--dry-run", action="store_true", help="Report what would be deleted and stop")
+        parser.add_argument("--yes", action="store_true", help="Don't ask for confirmation")
+
+    def handle(self, *args, **options):
+        filters = parse_filters(options["filters"])
+        try:
+            users = User.objects.filter(is_superuser=False, **filters)
+            total = users.count()
+        except (FieldError, ValidationError, ValueError) as exc:
+            raise CommandError(f"Invalid --filter: {exc}")
+        related = related_rows()
 
-        user_count = User.objects.count()
-        if user_count == 0:
+        if total == 0:
             self.stdout.write(self.style.WARNING("No users found."))
             return
 
-        User.objects.filter(is_superuser=False).delete()
+        if options["dry_run"]:
+            self.dry_run(users, total, related)
+            return
+
+        if not options["yes"]:
+            try:
+                confirm = input(f"⚠️ Are you sure you want to delete {total} users? (yes/no): ")
+            except EOFError:
+                confirm = ""
+            if confirm.lower() != "yes":
+                self.stdout.write(self.style.WARNING(
+                    "Aborted! No users were deleted."))
+                return
+
+        deleted, cleared = self.purge(users, related, options["batch_size"], total)
+
+        try:
+            rebuild_filter()
+        except RedisError:
+            self.stderr.write("Could not rebuild the availability filter; the scheduled rebuild will catch up.")
 
         self.stdout.write(self.style.SUCCESS(
-            f"✅ Successfully deleted {user_count} users!"))
+            f"✅ Successfully deleted {deleted} users!"))
+        for label, count in cleared.items():
+            if count:
+                self.stdout.write(f"{label}: {count} rows")
+
+    def purge(self, users, related, batch_size, total):
+        deleted = 0
+        cleared = dict.fromkeys((rows.label for rows in related), 0)
+        started = time.monotonic()
+        last_pk = 0
+        while True:
+            batch = list(users.filter(pk__gt=last_pk).order_by("pk")
+                         .values_list("pk", "username")[:batch_size])
+            if not batch:
+                break
+            ids = [pk for pk, _ in batch]
+            last_pk = ids[-1]
+            with transaction.atomic():
+                for rows in related:
+                    cleared[rows.label] += rows.clear(ids)
+                # Plain DELETE without loading users or sending signals; the
+                # signal handlers' work is done in bulk around it.
+                query = User.objects.filter(pk__in=ids)
+                deleted += query._raw_delete(query.db)
+            forget_usernames([username for _, username in batch])
+
+            elapsed = time.monotonic() - started
+            self.stdout.write(
+                f"\r{deleted}/{total} users deleted ({deleted * 100 // total}%, "
+                f"{deleted / elapsed if elapsed else 0:.0f}/s)",
+                ending="",
+            )
+            self.stdout.flush()
+        self.stdout.write("")
+        return deleted, cleared
+
+    def dry_run(self, users, total, related):
+        self.stdout.write(f"Would delete {total} users.")
+        ids = users.values("pk")
+        for rows in related:
+            verb = "set to NULL" if rows.action == "set_null" else "deleted"
+            self.stdout.write(f"{rows.label}: {rows.queryset(ids).count()} rows {verb}")
@@ -0,0 +1,245 @@
+import csv
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q
+
+from accounts.availability import add_users
+from accounts.models import User
+from accounts.profile_cache import forget_usernames
+from accounts.search import index_users
+from accounts.serializers import RegistrationSerializer
+
+
+class ImportUserSerializer(RegistrationSerializer):
+    """ Registration rules; uniqueness is checked per chunk by the command. """
+
+    def validate_unique_fields(self, data):
+        pass
+
+
+def read_rows(path, fmt):
+    """ Yield ``(line_number, row_dict)`` from a CSV or JSON Lines file. """
+    with open(path, newline="", encoding="utf-8") as f:
+        if fmt == "csv":
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, row
+            return
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as exc:
+                row = {"__error__": f"Invalid JSON: {exc}"}
+            if not isinstance(row, dict):
+                row = {"__error__": "Expected a JSON object."}
+            yield line_number, row
+
+
+def copy_value(value):
+    """ A value in PostgreSQL's COPY text format. """
+    if value is None:
+        return r"\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+class Command(BaseCommand):
+    help = "Import users from a CSV or JSON Lines file, validated like registration"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="CSV with a header row, or JSON Lines (one object per line)")
+        parser.add_argument("--format", choices=["csv", "jsonl"], help="Defaults to the file extension")
+        parser.add_argument("--chunk-size", type=int, default=1000, help="Rows validated and written together")
+        parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Password hashing processes")
+        parser.add_argument("--no-copy", action="store_true", help="Use bulk_create even on PostgreSQL")
+        parser.add_argument("--dry-run", action="store_true", help="Validate and report without writing")
+        parser.add_argument("--report", help="Write every rejected row to this file as JSON Lines")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        if not os.path.exists(path):
+            raise CommandError(f"{path} does not exist")
+        fmt = options["format"] or ("jsonl" if path.endswith((".jsonl", ".ndjson")) else "csv")
+        self.use_copy = connection.vendor == "postgresql" and not options["no_copy"]
+        self.dry_run = options["dry_run"]
+        self.report = open(options["report"], "w", encoding="utf-8") if options["report"] else None
+        self.stats = {"read": 0, "imported": 0, "invalid": 0, "duplicate": 0}
+        self.seen_emails, self.seen_usernames = set(), set()
+        self.hash_seconds = 0.0
+
+        started = time.monotonic()
+        rows = read_rows(path, fmt)
+        # Forked hashing workers mustn't inherit a live database connection.
+        connection.close()
+        try:
+            with ProcessPoolExecutor(max_workers=options["workers"], initializer=django.setup) as pool:
+                # With fork, the first task starts every worker; do it before
+                # the database is touched again.
+                pool.submit(int).result()
+                pending = None
+                while chunk := list(islice(rows, options["chunk_size"])):
+                    users = self.prepare(chunk)
+                    # Hash this chunk in the pool while the previous one is written.
+                    hashes = None
+                    if users and not self.dry_run:
+                        hashes = pool.map(make_password, [user.password for _, user in users],
+                                          chunksize=max(1, len(users) // (options["workers"] * 4)))
+                    if pending:
+                        self.write(*pending)
+                    pending = (users, hashes)
+                    self.progress(started)
+                if pending:
+                    self.write(*pending)
+            self.stdout.write("")
+        finally:
+            if self.report:
+                self.report.close()
+
+        elapsed = time.monotonic() - started
+        stats = self.stats
+        verb = "Validated" if self.dry_run else "Imported"
+        count = stats["read"] - stats["invalid"] - stats["duplicate"] if self.dry_run else stats["imported"]
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ {verb} {count} of {stats['read']} rows in {elapsed:.1f}s "
+            f"({stats['read'] / elapsed if elapsed else 0:.0f} rows/s)."
+        ))
+        self.stdout.write(
+            f"duplicates: {stats['duplicate']}, invalid: {stats['invalid']}, "
+            f"waiting on hashing: {self.hash_seconds:.1f}s, writer: {'COPY' if self.use_copy else 'bulk_create'}"
+        )
+
+    def reject(self, line_number, reason, errors):
+        self.stats[reason] += 1
+        entry = {"line": line_number, "reason": reason, "errors": errors}
+        if self.report:
+            self.report.write(json.dumps(entry) + "\n")
+        elif self.stats["invalid"] + self.stats["duplicate"] <= 20:
+            self.stderr.write(f"line {line_number}: {reason} {errors}")
+
+    def prepare(self, chunk):
+        """
+        Validate a chunk and drop duplicates, within the file and against the
+        database (one query per chunk). Returns ``[(line_number, user)]`` with
+        the raw password still on ``user.password``.
+        """
+        valid = []
+        for line_number, row in chunk:
+            self.stats["read"] += 1
+            if "__error__" in row:
+                self.reject(line_number, "invalid", {"non_field_errors": [row["__error__"]]})
+                continue
+            row.setdefault("confirm_password", row.get("password"))
+            serializer = ImportUserSerializer(data=row)
+            if not serializer.is_valid():
+                self.reject(line_number, "invalid", serializer.errors)
+                continue
+            data = serializer.validated_data
+            data["email"] = User.objects.normalize_email(data["email"])
+            valid.append((line_number, data))
+
+        existing = User.objects.filter(
+            Q(email__in=[data["email"] for _, data in valid])
+            | Q(username__in=[data["username"] for _, data in valid])
+        ).values_list("email", "username") if valid else []
+        taken_emails, taken_usernames = set(), set()
+        for email, username in existing:
+            taken_emails.add(email)
+            taken_usernames.add(username)
+
+        users = []
+        for line_number, data in valid:
+            errors = {}
+            if data["email"] in taken_emails or data["email"] in self.seen_emails:
+                errors["email"] = ["Email is already taken."]
+            if data["username"] in taken_usernames or data["username"] in self.seen_usernames:
+                errors["username"] = ["Username is already taken."]
+            if errors:
+                self.reject(line_number, "duplicate", errors)
+                continue
+            self.seen_emails.add(data["email"])
+            self.seen_usernames.add(data["username"])
+            users.append((line_number, User(**data)))
+        return users
+
+    def write(self, users, hashes):
+        if not users or self.dry_run:
+            return
+        started = time.monotonic()
+        for (_, user), encoded in zip(users, hashes):
+            user.password = encoded
+        self.hash_seconds += time.monotonic() - started
+
+        try:
+            with transaction.atomic():
+                self.insert([user for _, user in users])
+        except IntegrityError:
+            # Someone registered one of these since the chunk was checked.
+            users = self.drop_taken(users)
+            with transaction.atomic():
+                self.insert([user for _, user in users])
+        self.stats["imported"] += len(users)
+
+        # Bulk inserts send no post_save, so do the signal handlers' work here.
+        created = [user for _, user in users]
+        add_users([(user.email, user.username) for user in created])
+        forget_usernames([user.username for user in created])
+        if not self.use_copy:
+            if created and created[0].pk is None:
+                created = list(User.objects.filter(email__in=[user.email for user in created]))
+            index_users(created)
+
+    def drop_taken(self, users):
+        taken = set(User.objects.filter(
+            Q(email__in=[user.email for _, user in users])
+            | Q(username__in=[user.username for _, user in users])
+        ).values_list("email", "username"))
+        taken_emails = {email for email, _ in taken}
+        taken_usernames = {username for _, username in taken}
+        kept = []
+        for line_number, user in users:
+            if user.email in taken_emails or user.username in taken_usernames:
+                self.reject(line_number, "duplicate", {"non_field_errors": ["Email or username was taken during the import."]})
+            else:
+                kept.append((line_number, user))
+        return kept
+
+    def insert(self, users):
+        if not self.use_copy:
+            User.objects.bulk_create(users, batch_size=1000)
+            return
+        fields = [field for field in User._meta.concrete_fields if not field.primary_key]
+        buffer = io.StringIO()
+        for user in users:
+            buffer.write("\t".join(copy_value(getattr(user, field.attname)) for field in fields) + "\n")
+        buffer.seek(0)
+        columns = ", ".join(connection.ops.quote_name(field.column) for field in fields)
+        # copy_expert is psycopg2's own method; map its errors to Django's.
+        with connection.cursor() as cursor, connection.wrap_database_errors:
+            cursor.copy_expert(
+                f"COPY {connection.ops.quote_name(User._meta.db_table)} ({columns}) FROM STDIN",
+                buffer,
+            )
+
+    def progress(self, started):
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            f"\r{self.stats['read']} rows read, {self.stats['imported']} imported "
+            f"({self.stats['read'] / elapsed if elapsed else 0:.0f} rows/s)",
+            ending="",
+        )
+        self.stdout.flush()
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from accounts.tasks import get_purge_stats, purge_expired_otps
+
+
+class Command(BaseCommand):
+    help = "Delete expired OTPs in batches (normally run by celery beat)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, help="Rows per primary-key window")
+        parser.add_argument("--max-batches", type=int, help="Stop after this many windows")
+
+    def handle(self, *args, **options):
+        purged = purge_expired_otps(options["batch_size"], options["max_batches"])
+        self.stdout.write(self.style.SUCCESS(f"✅ Purged {purged} expired OTPs."))
+        for name, value in get_purge_stats().items():
+            self.stdout.write(f"{name}: {value}")
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from accounts.search import rebuild_index, uses_trigram_indexes
+
+
+class Command(BaseCommand):
+    help = "Rebuild the user search trigram table (not needed on PostgreSQL)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000, help="Users indexed per transaction")
+
+    def handle(self, *args, **options):
+        if uses_trigram_indexes():
+            self.stdout.write("PostgreSQL searches through pg_trgm indexes; nothing to rebuild.")
+            return
+        count = rebuild_index(options["chunk_size"])
+        self.stdout.write(self.style.SUCCESS(f"✅ Indexed {count} users for search."))
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.20 on 2026-10-16 23:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_otp_user_code_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='otp',
+            index=models.Index(fields=['user', 'created_at'], name='otp_user_created_idx'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 4.2.20 on 2026-10-17 00:00
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+SEARCH_FIELDS = ('username', 'email', 'location', 'phone_number')
+
+
+def trigrams(value):
+    value = (value or '').lower()
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+def backfill_search_grams(apps, schema_editor):
+    # PostgreSQL searches through pg_trgm indexes instead (0006).
+    if schema_editor.connection.vendor == 'postgresql':
+        return
+    User = apps.get_model('accounts', 'User')
+    UserSearchGram = apps.get_model('accounts', 'UserSearchGram')
+    db = schema_editor.connection.alias
+    grams = []
+    for row in User.objects.using(db).values_list('pk', *SEARCH_FIELDS).iterator(chunk_size=2000):
+        pk, values = row[0], row[1:]
+        for field, value in zip(SEARCH_FIELDS, values):
+            grams.extend(UserSearchGram(user_id=pk, field=field, gram=gram) for gram in trigrams(value))
+        if len(grams) >= 10000:
+            UserSearchGram.objects.using(db).bulk_create(grams, batch_size=1000)
+            grams = []
+    UserSearchGram.objects.using(db).bulk_create(grams, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0004_otp_user_created_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserSearchGram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field', models.CharField(max_length=20)),
+                ('gram', models.CharField(max_length=3)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_grams', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['field', 'gram', 'user'], name='user_search_gram_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='usersearchgram',
+            constraint=models.UniqueConstraint(fields=('user', 'field', 'gram'), name='user_search_gram_unique'),
+        ),
+        migrations.RunPython(backfill_search_grams, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+from django.db import migrations
+
+SEARCH_COLUMNS = ('username', 'email', 'location', 'phone_number')
+
+
+def create_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for column in SEARCH_COLUMNS:
+        schema_editor.execute(
+            f'CREATE INDEX CONCURRENTLY IF NOT EXISTS accounts_user_{column}_trgm '
+            f'ON accounts_user USING gin ({column} gin_trgm_ops)'
+        )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for column in SEARCH_COLUMNS:
+        schema_editor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS accounts_user_{column}_trgm')
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction, and builds
+    # the indexes without blocking writes to the user table.
+    atomic = False
+
+    dependencies = [
+        ('accounts', '0005_usersearchgram'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
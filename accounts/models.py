@@ -1,5 +1,6 @@
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
 from django.db import models
+from django.utils import timezone
 import random
 
 
@@ -70,6 +71,12 @@ class OTP(models.Model):
     code = models.CharField(max_length=6)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'code'], name='otp_user_code_idx'),
+            models.Index(fields=['user', 'created_at'], name='otp_user_created_idx'),
+        ]
+
     def save(self, *args, **kwargs):
         if not self.code:
             self.code = ''.join(random.choices('0123456789', k=6))
@@ -77,3 +84,74 @@ class OTP(models.Model):
 
     def __str__(self):
         return f"OTP {self.code} for {self.user.email}"
+
+
+class UserSearchGram(models.Model):
+    """
+    One lowercase trigram of a searchable ``User`` field.
+
+    Lets ``UserFilter`` answer substring searches from an index on databases
+    without pg_trgm; see ``accounts.search``. Unused on PostgreSQL.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='search_grams')
+    field = models.CharField(max_length=20)
+    gram = models.CharField(max_length=3)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'field', 'gram'], name='user_search_gram_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['field', 'gram', 'user'], name='user_search_gram_idx'),
+        ]
+
+
+# Email outbox
+
+
+class EmailOutbox(models.Model):
+    """
+    An email waiting to be delivered through Plunk.
+
+    Rows are written in the same transaction as the change that triggers the
+    email, so a rolled-back registration never sends anything, and are
+    drained in batches by ``accounts.emails.drain_email_outbox``.
+    """
+    QUEUE_OTP = 'otp'
+    QUEUE_BULK = 'bulk'
+    QUEUE_CHOICES = [
+        (QUEUE_OTP, 'OTP'),
+        (QUEUE_BULK, 'Bulk'),
+    ]
+
+    STATUS_PENDING = 'pending'
+    STATUS_SENDING = 'sending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_SENDING, 'Sending'),
+        (STATUS_SENT, 'Sent'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    event = models.CharField(max_length=100)
+    email = models.EmailField()
+    data = models.JSONField(default=dict)
+    queue = models.CharField(max_length=10, choices=QUEUE_CHOICES, default=QUEUE_BULK)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    claimed_at = models.DateTimeField(blank=True, null=True)
+    sent_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['queue', 'status', 'next_attempt_at'],
+                         name='outbox_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.event} to {self.email} ({self.status})"
@@ -0,0 +1,137 @@
+"""
+Where one-time passwords live between being issued and being verified.
+
+The store is chosen by ``settings.OTP_STORE``:
+
+- ``DatabaseOTPStore`` keeps codes in the ``OTP`` table and verifies and
+  consumes them with a single conditional ``DELETE``.
+- ``RedisOTPStore`` keeps one key per code with a native TTL and consumes
+  it with an atomic ``GETDEL``.
+- ``InMemoryOTPStore`` is a per-process store for tests and local runs.
+
+Every store expires codes after ``settings.OTP_TTL`` seconds.
+"""
+import secrets
+import threading
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import OTP
+from .redis_client import get_redis
+
+
+def generate_code(length=6):
+    return ''.join(secrets.choice('0123456789') for _ in range(length))
+
+
+class BaseOTPStore:
+
+    @property
+    def ttl(self):
+        return settings.OTP_TTL
+
+    def issue(self, user):
+        """ Create and store a new code for ``user`` and return it. """
+        raise NotImplementedError
+
+    def consume(self, email, code):
+        """
+        Return whether ``code`` is a live code for ``email``, deleting it in
+        the same step so it can never be used twice.
+        """
+        raise NotImplementedError
+
+    async def aconsume(self, email, code):
+        """ ``consume`` for async views. """
+        return await sync_to_async(self.consume, thread_sensitive=False)(email, code)
+
+
+class DatabaseOTPStore(BaseOTPStore):
+
+    def issue(self, user):
+        return OTP.objects.create(user=user, code=generate_code()).code
+
+    def _live(self, email, code):
+        cutoff = timezone.now() - timedelta(seconds=self.ttl)
+        return OTP.objects.filter(user__email=email, code=code, created_at__gte=cutoff)
+
+    def consume(self, email, code):
+        deleted, _ = self._live(email, code).delete()
+        return deleted > 0
+
+    async def aconsume(self, email, code):
+        deleted, _ = await self._live(email, code).adelete()
+        return deleted > 0
+
+
+class RedisOTPStore(BaseOTPStore):
+    key_prefix = "otp:"
+
+    def __init__(self):
+        self.redis = get_redis()
+        if self.redis is None:
+            raise ImproperlyConfigured("REDIS_URL must be set to use RedisOTPStore.")
+
+    def _key(self, email, code):
+        return f"{self.key_prefix}{email}:{code}"
+
+    def issue(self, user):
+        code = generate_code()
+        self.redis.set(self._key(user.email, code), 1, ex=self.ttl)
+        return code
+
+    def consume(self, email, code):
+        return self.redis.getdel(self._key(email, code)) is not None
+
+    async def aconsume(self, email, code):
+        return await sync_to_async(self.consume, thread_sensitive=False)(email, code)
+
+
+class InMemoryOTPStore(BaseOTPStore):
+
+    def __init__(self):
+        self._codes = {}
+        self._lock = threading.Lock()
+
+    def issue(self, user):
+        code = generate_code()
+        with self._lock:
+            self._codes[(user.email, code)] = time.monotonic() + self.ttl
+        return code
+
+    def consume(self, email, code):
+        with self._lock:
+            expires_at = self._codes.pop((email, code), None)
+        return expires_at is not None and expires_at > time.monotonic()
+
+    async def aconsume(self, email, code):
+        return self.consume(email, code)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_otp_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = import_string(settings.OTP_STORE)()
+    return _store
+
+
+@receiver(setting_changed)
+def _reset_store(setting, **kwargs):
+    global _store
+    if setting in ("OTP_STORE", "REDIS_URL"):
+        _store = None
@@ -0,0 +1,187 @@
+"""
+Cached serialized profiles for ``GetUserByUsernameAPIView``.
+
+Each username maps to one cache entry holding the serialized user (or
+``None`` for an unknown username) and its ETag, so a hit costs one cache
+round-trip and no query or serialization. ``accounts.signals`` invalidates
+entries when a user is saved or deleted.
+
+Every username also has a generation counter, bumped on invalidation and
+stored in each entry. An entry whose generation is behind is ignored, so a
+fill that read the database just before a save can't cache stale data.
+
+Concurrent misses for one username are coalesced: threads in a process
+queue on a lock and processes race on ``cache.add``; the losers wait for
+the winner's entry instead of querying the database themselves.
+
+Invalidation has to reach every worker, so caching needs Redis
+(``REDIS_URL``); without it each request reads the database.
+"""
+import hashlib
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.utils.http import parse_etags
+
+from .models import User
+from .serializers import represent_user_rows, user_values
+
+FILL_POLL_INTERVAL = 0.02  # seconds
+
+
+def _key(username):
+    digest = hashlib.sha1(username.encode("utf-8")).hexdigest()
+    return f"user:profile:{digest}"
+
+
+def _generation_key(username):
+    return f"{_key(username)}:gen"
+
+
+def _fill_lock_key(username):
+    return f"{_key(username)}:fill"
+
+
+def _username_key(pk):
+    # The username last cached for a user id, so a rename can evict it.
+    return f"user:profile-name:{pk}"
+
+
+def make_etag(data):
+    body = json.dumps(data, sort_keys=True, separators=(",", ":"), cls=DjangoJSONEncoder)
+    return '"%s"' % hashlib.sha1(body.encode("utf-8")).hexdigest()
+
+
+def etag_matches(if_none_match, etag):
+    """ Weak comparison of an ``If-None-Match`` header against ``etag``. """
+    if not if_none_match or not etag:
+        return False
+    tags = parse_etags(if_none_match)
+    return "*" in tags or etag in [tag.removeprefix("W/") for tag in tags]
+
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+@contextmanager
+def _local_lock(key):
+    """ Per-key lock, dropped from the registry once nobody holds it. """
+    with _locks_guard:
+        lock, holders = _locks.get(key, (None, 0))
+        lock = lock or threading.Lock()
+        _locks[key] = (lock, holders + 1)
+    try:
+        with lock:
+            yield
+    finally:
+        with _locks_guard:
+            lock, holders = _locks[key]
+            if holders == 1:
+                del _locks[key]
+            else:
+                _locks[key] = (lock, holders - 1)
+
+
+def _cached(username):
+    values = cache.get_many([_key(username), _generation_key(username)])
+    entry = values.get(_key(username))
+    if entry is None or entry["gen"] != values.get(_generation_key(username), 0):
+        return None
+    return entry
+
+
+def _load(username, generation=0):
+    # From the primary: a row read from a lagging replica would be cached
+    # for the whole TTL.
+    data = user_values(User.objects.using(DEFAULT_DB_ALIAS).filter(username=username)).first()
+    if data is not None:
+        represent_user_rows([data])
+    return {"gen": generation, "data": data, "etag": make_etag(data) if data else None}
+
+
+def _fill(username):
+    # Read the generation before the query: a save landing in between bumps
+    # it, and this entry is then ignored rather than served stale.
+    entry = _load(username, cache.get(_generation_key(username), 0))
+    data = entry["data"]
+    ttl = settings.USER_PROFILE_CACHE_TTL
+    cache.set(_key(username), entry, ttl)
+    if data is not None:
+        cache.set(_username_key(data["id"]), username, ttl)
+    return entry
+
+
+def get_profile(username):
+    """
+    Return ``{"data": ..., "etag": ...}`` for ``username``; ``data`` is
+    ``None`` if no such user exists.
+    """
+    if not settings.REDIS_URL:
+        return _load(username)
+    entry = _cached(username)
+    if entry is not None:
+        return entry
+
+    with _local_lock(_key(username)):
+        entry = _cached(username)
+        if entry is not None:
+            return entry
+
+        lock_key = _fill_lock_key(username)
+        timeout = settings.USER_PROFILE_FILL_TIMEOUT
+        if cache.add(lock_key, 1, timeout):
+            try:
+                return _fill(username)
+            finally:
+                cache.delete(lock_key)
+
+        # Another process is filling it; wait for its entry.
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            time.sleep(FILL_POLL_INTERVAL)
+            entry = _cached(username)
+            if entry is not None:
+                return entry
+            if cache.get(lock_key) is None:
+                break
+        return _fill(username)
+
+
+def _invalidate_usernames(usernames):
+    for username in usernames:
+        generation_key = _generation_key(username)
+        # Outlives any entry filled before this bump; after that a missing
+        # counter reads as 0, which no live entry filled since carries.
+        cache.add(generation_key, 0, 2 * settings.USER_PROFILE_CACHE_TTL)
+        cache.incr(generation_key)
+        cache.delete(_key(username))
+
+
+def invalidate_user(user):
+    """
+    Drop the cached profile of ``user`` under its current and previously
+    cached username. Runs again after commit, so a request that read the
+    old row before the commit can't leave it cached.
+    """
+    if not settings.REDIS_URL:
+        return
+    usernames = {user.username, cache.get(_username_key(user.pk))} - {None}
+    _invalidate_usernames(usernames)
+    transaction.on_commit(lambda: _invalidate_usernames(usernames))
+
+
+def forget_usernames(usernames):
+    """
+    Drop the cached entries for ``usernames``; for users created or deleted
+    in bulk, where no model signals fire.
+    """
+    if not settings.REDIS_URL:
+        return
+    cache.delete_many([_key(username) for username in usernames])
@@ -0,0 +1,40 @@
+"""
+Shared redis-py client for features that need Redis primitives the Django
+cache API doesn't expose (GETDEL, Lua scripts, bit operations).
+"""
+import threading
+
+import redis
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_redis():
+    """
+    Return the client for ``settings.REDIS_URL``, or ``None`` when Redis is
+    not configured. The underlying pool is thread- and fork-safe.
+    """
+    global _client
+    if not settings.REDIS_URL:
+        return None
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = redis.Redis.from_url(
+                    settings.REDIS_URL,
+                    socket_connect_timeout=1,
+                    socket_timeout=1,
+                    health_check_interval=30,
+                )
+    return _client
+
+
+@receiver(setting_changed)
+def _reset_client(setting, **kwargs):
+    global _client
+    if setting == "REDIS_URL":
+        _client = None
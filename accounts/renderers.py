@@ -0,0 +1,40 @@
+"""
+JSON rendering through orjson, byte-for-byte identical to DRF's
+``JSONRenderer`` with the default settings (compact separators, UTF-8
+output, no NaN, U+2028/U+2029 escaped).
+
+Anything orjson can't reproduce exactly (``Accept`` indent requests,
+non-string keys, non-default DRF JSON settings) or cannot encode goes
+through DRF's renderer. Floats are the exception: orjson writes ``1e16``
+where ``json`` writes ``1e+16``, so only use this on endpoints without
+float fields. orjson is optional; without it this is just ``JSONRenderer``.
+"""
+from rest_framework.renderers import JSONRenderer
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS if orjson else 0
+
+
+class FastJSONRenderer(JSONRenderer):
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if (
+            orjson is None
+            or data is None
+            or not self.compact
+            or self.ensure_ascii
+            or not self.strict
+            or self.get_indent(accepted_media_type or "", renderer_context or {}) is not None
+        ):
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            # Dates, decimals and the like are encoded by DRF's encoder, so
+            # they come out exactly as JSONRenderer would write them.
+            body = orjson.dumps(data, default=self.encoder_class().default, option=ORJSON_OPTIONS)
+        except TypeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        return body.replace(b"\xe2\x80\xa8", b"\\u2028").replace(b"\xe2\x80\xa9", b"\\u2029")
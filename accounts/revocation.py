@@ -0,0 +1,216 @@
+"""
+JWT revocation list, keyed by ``jti``.
+
+A revoked token gets a Redis key ``jwt:revoked:<jti>`` that expires when
+the token would have, so the list only ever holds live tokens. Each
+revocation is also appended to a Redis stream.
+
+Every process keeps an in-memory Bloom filter of the revoked ids, loaded
+from the stream and topped up from it at most every
+``JWT_REVOCATION_SYNC_INTERVAL`` seconds. Authenticating a request checks
+the filter first; only ids it might contain (real revocations and a
+``JWT_REVOCATION_BLOOM_ERROR_RATE`` share of false positives) cost a Redis
+lookup. A revocation made by another process is seen within one sync
+interval.
+
+The filter counts the live ids it holds; once ids that have since expired
+make up half of it and it has gone past ``JWT_REVOCATION_BLOOM_CAPACITY``,
+it is rebuilt from the stream without them.
+
+Revocation needs Redis: a per-process store would only reject a revoked
+token in the worker that revoked it. ``JWT_REVOCATION_ENABLED`` defaults to
+off without ``REDIS_URL``, and nothing is ever revoked (logout then only
+ends the session client-side); turning it on without Redis fails the
+``accounts.E001`` system check at startup.
+"""
+import heapq
+import logging
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from redis.exceptions import RedisError
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+from .availability import bloom_parameters, bloom_positions
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+REVOKED_KEY = "jwt:revoked:{}"
+STREAM_KEY = "jwt:revocations"
+STREAM_PAGE_SIZE = 1000
+
+
+def _remaining(exp):
+    return math.ceil(exp - time.time())
+
+
+def _max_lifetime():
+    return max(jwt_settings.ACCESS_TOKEN_LIFETIME, jwt_settings.REFRESH_TOKEN_LIFETIME).total_seconds()
+
+
+class DisabledRevocationList:
+    """ ``JWT_REVOCATION_ENABLED = False``: nothing is revoked. """
+
+    def revoke(self, jti, exp, only_once=False):
+        return True
+
+    def is_revoked(self, jti):
+        return False
+
+
+class RedisRevocationList:
+
+    def __init__(self, redis, capacity, error_rate, sync_interval):
+        self.redis = redis
+        self.capacity = capacity
+        self.size, self.hashes = bloom_parameters(capacity, error_rate)
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        self._bits = bytearray((self.size + 7) // 8)
+        self._count = 0
+        self._expiries = []  # heap of the ``exp`` of every id counted
+        self._last_id = None  # stream position; None until first loaded
+        self._synced_at = 0.0
+        self._warned = False
+
+    def _add_local(self, jti, exp):
+        positions = bloom_positions(jti, self.size, self.hashes)
+        if all(self._bits[position >> 3] & (0x80 >> (position & 7)) for position in positions):
+            # Already in: revoked by this process and now read back from the
+            # stream, or revoked twice. Count each id once.
+            return
+        for position in positions:
+            self._bits[position >> 3] |= 0x80 >> (position & 7)
+        self._count += 1
+        heapq.heappush(self._expiries, exp)
+
+    def _might_contain(self, jti):
+        return all(self._bits[position >> 3] & (0x80 >> (position & 7))
+                   for position in bloom_positions(jti, self.size, self.hashes))
+
+    def _live(self, now):
+        while self._expiries and self._expiries[0] <= now:
+            heapq.heappop(self._expiries)
+        return len(self._expiries)
+
+    def _rebuild_due(self, now):
+        """ Whether dropping expired ids would at least halve an over-capacity filter. """
+        if self._count <= self.capacity:
+            return False
+        live = self._live(now)
+        if live > self.capacity and not self._warned:
+            self._warned = True
+            logger.warning("%d live revoked tokens exceed JWT_REVOCATION_BLOOM_CAPACITY (%d); "
+                           "more of them will cost a Redis lookup", live, self.capacity)
+        return live <= self._count // 2
+
+    def _pull(self, now):
+        """ Apply the stream entries after ``_last_id``, a page at a time. """
+        while True:
+            entries = self.redis.xrange(STREAM_KEY, min=f"({self._last_id.decode()}", count=STREAM_PAGE_SIZE)
+            for entry_id, fields in entries:
+                self._last_id = entry_id
+                exp = float(fields[b"exp"])
+                if exp > now:
+                    self._add_local(fields[b"jti"].decode(), exp)
+            if len(entries) < STREAM_PAGE_SIZE:
+                break
+
+    def sync(self):
+        """ Pull new revocations from the stream, rebuilding when due. """
+        if time.monotonic() - self._synced_at < self.sync_interval:
+            return
+        with self._lock:
+            if time.monotonic() - self._synced_at < self.sync_interval:
+                return
+            now = time.time()
+            if self._last_id is None or self._rebuild_due(now):
+                # (Re)load from scratch: expired ids drop out, so a filter
+                # filled past capacity regains its false-positive rate.
+                self._bits = bytearray(len(self._bits))
+                self._count = 0
+                self._expiries = []
+                self._last_id = b"0-0"
+            self._pull(now)
+            self._synced_at = time.monotonic()
+
+    def revoke(self, jti, exp, only_once=False):
+        """
+        Revoke ``jti`` until ``exp``. With ``only_once``, return ``False``
+        if it was already revoked (e.g. a refresh token being reused).
+        """
+        ttl = _remaining(exp)
+        if ttl <= 0:
+            return True
+        # Stream ids are millisecond timestamps; anything older than the
+        # longest token lifetime can no longer matter.
+        min_id = int((time.time() - _max_lifetime()) * 1000)
+        pipe = self.redis.pipeline()
+        pipe.set(REVOKED_KEY.format(jti), 1, ex=ttl, nx=only_once)
+        pipe.xadd(STREAM_KEY, {"jti": jti, "exp": exp}, minid=min_id, approximate=True)
+        newly_revoked, _ = pipe.execute()
+        with self._lock:
+            self._add_local(jti, exp)
+        return bool(newly_revoked) or not only_once
+
+    def is_revoked(self, jti):
+        try:
+            self.sync()
+        except RedisError:
+            logger.exception("Could not sync the token revocation list")
+        if not self._might_contain(jti):
+            return False
+        try:
+            return bool(self.redis.exists(REVOKED_KEY.format(jti)))
+        except RedisError:
+            # Fail closed: only ids the filter flagged get here.
+            logger.exception("Token revocation store unavailable; rejecting token")
+            return True
+
+
+_revocation_list = None
+_revocation_list_lock = threading.Lock()
+
+
+def get_revocation_list():
+    global _revocation_list
+    if _revocation_list is None:
+        with _revocation_list_lock:
+            if _revocation_list is None:
+                if not settings.JWT_REVOCATION_ENABLED:
+                    _revocation_list = DisabledRevocationList()
+                else:
+                    redis = get_redis()
+                    if redis is None:
+                        raise ImproperlyConfigured(
+                            "REDIS_URL must be set for token revocation; "
+                            "set JWT_REVOCATION_ENABLED = False to run without it.")
+                    _revocation_list = RedisRevocationList(
+                        redis,
+                        settings.JWT_REVOCATION_BLOOM_CAPACITY,
+                        settings.JWT_REVOCATION_BLOOM_ERROR_RATE,
+                        settings.JWT_REVOCATION_SYNC_INTERVAL,
+                    )
+    return _revocation_list
+
+
+@receiver(setting_changed)
+def _reset_revocation_list(setting, **kwargs):
+    global _revocation_list
+    if setting == "REDIS_URL" or setting.startswith("JWT_REVOCATION_"):
+        _revocation_list = None
+
+
+def revoke_token(token, only_once=False):
+    """ Revoke a simplejwt token for the rest of its lifetime. """
+    return get_revocation_list().revoke(token[jwt_settings.JTI_CLAIM], token["exp"], only_once)
+
+
+def is_token_revoked(token):
+    return get_revocation_list().is_revoked(token[jwt_settings.JTI_CLAIM])
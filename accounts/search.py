@@ -0,0 +1,122 @@
+"""
+Indexed substring search over ``User`` fields for ``UserFilter``.
+
+A plain ``icontains`` filter compiles to ``UPPER(col) LIKE '%x%'``, which
+no B-tree index can serve, so every search scans the user table. Instead:
+
+* On PostgreSQL the ``trgm_icontains`` lookup emits ``col ILIKE '%x%'``,
+  which the pg_trgm GIN indexes from migration ``0006`` answer directly.
+* Elsewhere the trigrams of each searchable field are kept in
+  ``UserSearchGram`` (updated by ``accounts.signals``). A search first picks
+  the users holding every trigram of the term through that table's index,
+  then confirms the candidates with ``icontains``.
+
+Terms shorter than three characters have no trigrams and fall back to
+``icontains`` on both paths.
+"""
+from django.db import connections, router, transaction
+from django.db.models import CharField, Count
+from django.db.models.lookups import PatternLookup
+
+from .models import User, UserSearchGram
+
+SEARCH_FIELDS = ("username", "email", "location", "phone_number")
+GRAM_SIZE = 3
+
+
+@CharField.register_lookup
+class TrigramIContains(PatternLookup):
+    """ Case-insensitive substring match as ``ILIKE``, for pg_trgm indexes. """
+    lookup_name = "trgm_icontains"
+
+    def get_rhs_op(self, connection, rhs):
+        if self.rhs_is_direct_value() and not self.bilateral_transforms:
+            return f"ILIKE {rhs}"
+        return f"ILIKE '%%' || {rhs} || '%%'"
+
+
+def trigrams(value):
+    """ Distinct lowercase trigrams of ``value``. """
+    value = (value or "").lower()
+    return {value[i:i + GRAM_SIZE] for i in range(len(value) - GRAM_SIZE + 1)}
+
+
+def uses_trigram_indexes(using=None):
+    using = using or router.db_for_write(User)
+    return connections[using].vendor == "postgresql"
+
+
+class TrigramIndexSearch:
+    """ PostgreSQL: ILIKE served by the pg_trgm GIN indexes. """
+
+    def filter(self, queryset, field, value):
+        if len(value) < GRAM_SIZE:
+            return queryset.filter(**{f"{field}__icontains": value})
+        return queryset.filter(**{f"{field}__trgm_icontains": value})
+
+
+class NGramTableSearch:
+    """ Other databases: candidates from ``UserSearchGram``, then ``icontains``. """
+
+    def filter(self, queryset, field, value):
+        grams = trigrams(value)
+        if not grams:
+            return queryset.filter(**{f"{field}__icontains": value})
+        candidates = (
+            UserSearchGram.objects
+            .filter(field=field, gram__in=grams)
+            .values("user_id")
+            .annotate(hits=Count("gram"))
+            .filter(hits=len(grams))
+            .values("user_id")
+        )
+        return queryset.filter(pk__in=candidates, **{f"{field}__icontains": value})
+
+
+def get_search_backend(queryset):
+    if uses_trigram_indexes(queryset.db):
+        return TrigramIndexSearch()
+    return NGramTableSearch()
+
+
+def search(queryset, field, value):
+    """ ``queryset`` filtered to rows whose ``field`` contains ``value``. """
+    return get_search_backend(queryset).filter(queryset, field, value)
+
+
+def index_users(users, fields=SEARCH_FIELDS):
+    """
+    Replace the ``UserSearchGram`` rows of ``users`` for ``fields``.
+    A no-op on PostgreSQL, where the GIN indexes maintain themselves.
+    """
+    fields = [field for field in fields if field in SEARCH_FIELDS]
+    if not fields or uses_trigram_indexes():
+        return
+    users = list(users)
+    grams = [
+        UserSearchGram(user_id=user.pk, field=field, gram=gram)
+        for user in users
+        for field in fields
+        for gram in trigrams(getattr(user, field))
+    ]
+    with transaction.atomic():
+        UserSearchGram.objects.filter(user__in=[user.pk for user in users], field__in=fields).delete()
+        UserSearchGram.objects.bulk_create(grams, batch_size=1000)
+
+
+def rebuild_index(chunk_size=1000):
+    """ Rebuild ``UserSearchGram`` for every user. Returns the user count. """
+    if uses_trigram_indexes():
+        return 0
+    count = 0
+    chunk = []
+    for user in User.objects.only("pk", *SEARCH_FIELDS).order_by("pk").iterator(chunk_size=chunk_size):
+        chunk.append(user)
+        if len(chunk) == chunk_size:
+            index_users(chunk)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        index_users(chunk)
+        count += len(chunk)
+    return count
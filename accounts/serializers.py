@@ -1,12 +1,21 @@
 from rest_framework import serializers
 from django.utils.timezone import now
 from django.contrib.auth import authenticate
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
 from rest_framework_simplejwt.tokens import RefreshToken
-from .models import User, OTP
-from .emails import send_otp_email_task, send_welcome_email_task
+from .models import User
+from .emails import queue_otp_email
+from .otp_store import get_otp_store
+from .availability import check_availability
+from .revocation import is_token_revoked, revoke_token
+from .authentication import add_user_claims
 import datetime
 from django.utils.timezone import now
 from django.contrib.auth.password_validation import validate_password
+from django.db import IntegrityError, transaction
 
 
 class RegistrationSerializer(serializers.ModelSerializer):
@@ -26,18 +35,11 @@ class RegistrationSerializer(serializers.ModelSerializer):
             'dob', 'gender', 'phone_number', 'location',
             'password', 'confirm_password'
         ]
-
-    def validate_email(self, value):
-        """ Ensure email is unique """
-        if User.objects.filter(email=value).exists():
-            raise serializers.ValidationError("Email is already taken.")
-        return value
-
-    def validate_username(self, value):
-        """ Ensure username is unique """
-        if User.objects.filter(username=value).exists():
-            raise serializers.ValidationError("Username is already taken.")
-        return value
+        # Uniqueness is checked once for both fields in validate().
+        extra_kwargs = {
+            'email': {'validators': []},
+            'username': {'validators': []},
+        }
 
     def validate_phone_number(self, value):
         """ Validate phone number format """
@@ -54,7 +56,9 @@ class RegistrationSerializer(serializers.ModelSerializer):
         return value
 
     def validate(self, data):
-        """ Ensure passwords match and meet validation requirements """
+        """ Ensure email/username are free and passwords match and are valid """
+        self.validate_unique_fields(data)
+
         password = data.get('password')
         confirm_password = data.pop('confirm_password')
 
@@ -65,11 +69,26 @@ class RegistrationSerializer(serializers.ModelSerializer):
         validate_password(password)  # Django's built-in password validation
         return data
 
+    def validate_unique_fields(self, data):
+        availability = check_availability(email=data['email'], username=data['username'])
+        errors = {}
+        if not availability['email']:
+            errors['email'] = ["Email is already taken."]
+        if not availability['username']:
+            errors['username'] = ["Username is already taken."]
+        if errors:
+            raise serializers.ValidationError(errors)
+
     def create(self, validated_data):
         """ Create user and send OTP """
-        user = User.objects.create_user(**validated_data)
-        otp = OTP.objects.create(user=user)
-        send_otp_email_task(user.email, user.first_name, otp.code)
+        try:
+            with transaction.atomic():
+                user = User.objects.create_user(**validated_data)
+                code = get_otp_store().issue(user)
+                queue_otp_email(user, code)
+        except IntegrityError:
+            # Lost a race with a concurrent registration for the same name.
+            raise serializers.ValidationError("Email or username is already taken.")
         return user
 
 
@@ -86,32 +105,45 @@ class OTPRequestSerializer(serializers.Serializer):
 
     def create(self, validated_data):
         user = User.objects.get(email=validated_data['email'])
-        otp = OTP.objects.create(user=user)
-        send_otp_email_task(user.email, user.first_name, otp.code)
+        with transaction.atomic():
+            code = get_otp_store().issue(user)
+            queue_otp_email(user, code)
         return {'message': 'OTP sent successfully'}
 
 
+def consume_otp(email, code):
+    """
+    Verify and consume ``code`` for ``email`` in one store round-trip.
+
+    The user lookup only happens on failure, to pick the error message.
+    """
+    if get_otp_store().consume(email, code):
+        return
+    if not User.objects.filter(email=email).exists():
+        raise serializers.ValidationError("User not found.")
+    raise serializers.ValidationError("Invalid OTP.")
+
+
+async def aconsume_otp(email, code):
+    """ ``consume_otp`` for async views. """
+    if await get_otp_store().aconsume(email, code):
+        return
+    if not await User.objects.filter(email=email).aexists():
+        raise serializers.ValidationError("User not found.")
+    raise serializers.ValidationError("Invalid OTP.")
+
+
 class OTPVerificationSerializer(serializers.Serializer):
     email = serializers.EmailField()
     code = serializers.CharField(max_length=6)
 
     def validate(self, data):
+        consume_otp(data['email'], data['code'])
         user = User.objects.filter(email=data['email']).first()
         if not user:
             raise serializers.ValidationError("User not found.")
 
-        otp = OTP.objects.filter(user=user, code=data['code']).order_by(
-            '-created_at').first()
-        if not otp:
-            raise serializers.ValidationError("Invalid OTP.")
-
-        user.is_active = True
-        user.save()
-        send_welcome_email_task(user.email, user.first_name)
-
-        data['user'] = user  
-
-        otp.delete()
+        data['user'] = user
         return data
 
 
@@ -120,24 +152,26 @@ class GeneralOTPVerificationSerializer(serializers.Serializer):
     code = serializers.CharField(max_length=6)
 
     def validate(self, data):
-        user = User.objects.filter(email=data['email']).first()
-        if not user:
-            raise serializers.ValidationError("User not found.")
-
-        otp = OTP.objects.filter(user=user, code=data['code']).order_by(
-            '-created_at').first()
-        if not otp:
-            raise serializers.ValidationError("Invalid OTP.")
+        consume_otp(data['email'], data['code'])
+        return {'message': 'OTP verified successfully'}
 
-        otp.delete()
 
-        return {'message': 'OTP verified successfully'}
+def issue_tokens(user):
+    """ Mint a refresh/access token pair for ``user``. """
+    refresh = add_user_claims(RefreshToken.for_user(user), user)
+    return {
+        'refresh': str(refresh),
+        'access': str(refresh.access_token),
+    }
 
 
-class LoginSerializer(serializers.Serializer):
+class LoginCredentialsSerializer(serializers.Serializer):
     email = serializers.EmailField()
     password = serializers.CharField(write_only=True)
 
+
+class LoginSerializer(LoginCredentialsSerializer):
+
     def validate(self, data):
         user = authenticate(email=data['email'], password=data['password'])
         if not user:
@@ -146,30 +180,60 @@ class LoginSerializer(serializers.Serializer):
         if not user.is_active:
             raise serializers.ValidationError("Account is not activated.")
 
-        refresh = RefreshToken.for_user(user)
-        return {
-            'user': user,
-            'refresh': str(refresh),
-            'access': str(refresh.access_token),
-        }
+        return {'user': user, **issue_tokens(user)}
 
 
 class LogoutSerializer(serializers.Serializer):
-    email = serializers.EmailField()
-    code = serializers.CharField(max_length=6)
+    """ The session's refresh token, revoked with the access token so the session can't be renewed. """
+    refresh = serializers.CharField()
+
+    def validate_refresh(self, value):
+        try:
+            token = RefreshToken(value)
+        except TokenError as exc:
+            raise serializers.ValidationError(str(exc))
+        user = self.context['request'].user
+        if str(token.get(jwt_settings.USER_ID_CLAIM)) != str(getattr(user, jwt_settings.USER_ID_FIELD)):
+            raise serializers.ValidationError("Token does not belong to this user.")
+        return token
 
-    def validate(self, data):
-        user = User.objects.filter(email=data['email']).first()
-        if not user:
-            raise serializers.ValidationError("User not found.")
 
-        otp = OTP.objects.filter(user=user, code=data['code']).order_by(
-            '-created_at').first()
-        if not otp:
-            raise serializers.ValidationError("Invalid OTP.")
+class RevocableTokenRefreshSerializer(TokenRefreshSerializer):
+    """
+    ``TokenRefreshSerializer`` that refuses revoked refresh tokens and, with
+    ``ROTATE_REFRESH_TOKENS`` and ``BLACKLIST_AFTER_ROTATION``, revokes the
+    old token so each refresh token works exactly once.
+
+    Reimplemented rather than extended: the parent records rotated tokens
+    in the ``token_blacklist`` app, which isn't installed.
+    """
 
-        otp.delete()
-        return {'message': 'Logged out successfully'}
+    def validate(self, attrs):
+        try:
+            refresh = self.token_class(attrs['refresh'])
+        except TokenError as exc:
+            raise InvalidToken(exc.args[0])
+        rotate = jwt_settings.ROTATE_REFRESH_TOKENS
+        if rotate and jwt_settings.BLACKLIST_AFTER_ROTATION:
+            # Claimed atomically, so two concurrent refreshes can't both win.
+            if not revoke_token(refresh, only_once=True):
+                raise InvalidToken("Token has been revoked.")
+        elif is_token_revoked(refresh):
+            raise InvalidToken("Token has been revoked.")
+
+        user = User.objects.filter(
+            **{jwt_settings.USER_ID_FIELD: refresh.get(jwt_settings.USER_ID_CLAIM)}).first()
+        if user is None or not jwt_settings.USER_AUTHENTICATION_RULE(user):
+            raise AuthenticationFailed(self.error_messages['no_active_account'], 'no_active_account')
+
+        add_user_claims(refresh, user)
+        data = {'access': str(refresh.access_token)}
+        if rotate:
+            refresh.set_jti()
+            refresh.set_exp()
+            refresh.set_iat()
+            data['refresh'] = str(refresh)
+        return data
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -182,3 +246,30 @@ class UserSerializer(serializers.ModelSerializer):
         model = User
         fields = ['id', 'username', 'email', 'first_name', 'last_name',
                   'dob', 'gender', 'phone_number', 'location', 'is_active']
+
+
+def user_values(queryset):
+    """
+    Read-only fast path for ``UserSerializer``: ``queryset.values()`` over
+    the serialized columns, turned into ``UserSerializer`` output by
+    ``represent_user_rows`` without building model instances.
+    """
+    return queryset.values(*UserSerializer.Meta.fields)
+
+
+def represent_user_rows(rows):
+    """ Format ``user_values`` rows in place exactly as ``UserSerializer`` would. """
+    for row in rows:
+        if row['dob'] is not None:
+            row['dob'] = row['dob'].isoformat()
+    return rows
+
+
+class AvailabilitySerializer(serializers.Serializer):
+    email = serializers.EmailField(required=False)
+    username = serializers.CharField(max_length=50, required=False)
+
+    def validate(self, data):
+        if not data:
+            raise serializers.ValidationError("Provide an email and/or a username.")
+        return data
@@ -0,0 +1,48 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .authentication import forget_cached_user
+from .availability import add_user, schedule_rebuild
+from .models import User
+from .profile_cache import invalidate_user
+from .search import SEARCH_FIELDS, index_users
+from .serializers import UserSerializer
+
+
+@receiver(post_save, sender=User)
+def add_to_availability_filter(sender, instance, created, update_fields=None, **kwargs):
+    """ Keep the availability filter in step with new or renamed users. """
+    if update_fields is not None and not {"email", "username"} & set(update_fields):
+        return
+    add_user(instance.email, instance.username)
+
+
+@receiver(post_delete, sender=User)
+def rebuild_availability_filter_after_delete(sender, instance, **kwargs):
+    """ Bloom filters can't remove entries, so rebuild (debounced). """
+    schedule_rebuild(countdown=60)
+
+
+@receiver(post_save, sender=User)
+def update_search_index(sender, instance, created, update_fields=None, **kwargs):
+    """ Refresh the user's search trigrams for the fields that were saved. """
+    fields = SEARCH_FIELDS
+    if update_fields is not None:
+        fields = [field for field in SEARCH_FIELDS if field in update_fields]
+    if fields:
+        index_users([instance], fields)
+
+
+@receiver(post_save, sender=User)
+def invalidate_cached_profile(sender, instance, update_fields=None, **kwargs):
+    """ Drop the cached profile unless the save skipped every serialized field. """
+    forget_cached_user(instance.pk)
+    if update_fields is not None and not set(UserSerializer.Meta.fields) & set(update_fields):
+        return
+    invalidate_user(instance)
+
+
+@receiver(post_delete, sender=User)
+def invalidate_cached_profile_after_delete(sender, instance, **kwargs):
+    forget_cached_user(instance.pk)
+    invalidate_user(instance)
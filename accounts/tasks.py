@@ -0,0 +1,85 @@
+"""
+Periodic maintenance tasks, scheduled through ``CELERY_BEAT_SCHEDULE``.
+"""
+import logging
+import time
+from datetime import timedelta
+
+from celery import shared_task
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from . import availability
+from .models import OTP
+
+logger = logging.getLogger(__name__)
+
+PURGE_STATS_KEYS = {
+    "rows_total": "otp_purge:rows_total",
+    "runs_total": "otp_purge:runs_total",
+    "last_run_rows": "otp_purge:last_run_rows",
+    "last_run_at": "otp_purge:last_run_at",
+}
+
+
+def _incr(key, delta):
+    cache.add(key, 0, timeout=None)
+    return cache.incr(key, delta)
+
+
+def get_purge_stats():
+    """ Cumulative and last-run counters for ``purge_expired_otps``. """
+    values = cache.get_many(PURGE_STATS_KEYS.values())
+    return {name: values.get(key, 0) for name, key in PURGE_STATS_KEYS.items()}
+
+
+def _next_pk(start):
+    return OTP.objects.filter(pk__gte=start).order_by("pk").values_list("pk", flat=True).first()
+
+
+@shared_task(ignore_result=True)
+def purge_expired_otps(batch_size=None, max_batches=None):
+    """
+    Delete OTPs older than ``OTP_TTL`` in primary-key windows of
+    ``batch_size`` rows.
+
+    Each window is its own short DELETE, so the purge never holds long locks
+    or writes one huge WAL record, and runs stop after ``max_batches``
+    windows. Returns the number of rows deleted.
+    """
+    batch_size = batch_size or settings.OTP_PURGE_BATCH_SIZE
+    max_batches = max_batches or settings.OTP_PURGE_MAX_BATCHES
+    cutoff = timezone.now() - timedelta(seconds=settings.OTP_TTL)
+
+    # Ids grow with created_at, so everything expired sits at or below the
+    # newest expired id; scanning back to it only crosses unexpired rows.
+    upper = (OTP.objects.filter(created_at__lt=cutoff)
+             .order_by("-pk").values_list("pk", flat=True).first())
+    start = _next_pk(0) if upper is not None else None
+
+    purged = batches = 0
+    while start is not None and start <= upper and batches < max_batches:
+        end = start + batch_size
+        deleted, _ = OTP.objects.filter(
+            pk__gte=start, pk__lt=end, created_at__lt=cutoff).delete()
+        purged += deleted
+        batches += 1
+        start = end if deleted else _next_pk(end)
+        if settings.OTP_PURGE_BATCH_PAUSE:
+            time.sleep(settings.OTP_PURGE_BATCH_PAUSE)
+
+    _incr(PURGE_STATS_KEYS["rows_total"], purged)
+    _incr(PURGE_STATS_KEYS["runs_total"], 1)
+    cache.set_many({
+        PURGE_STATS_KEYS["last_run_rows"]: purged,
+        PURGE_STATS_KEYS["last_run_at"]: timezone.now().isoformat(),
+    }, timeout=None)
+    logger.info("Purged %s expired OTPs in %s batches", purged, batches)
+    return purged
+
+
+@shared_task(ignore_result=True)
+def rebuild_availability_filter():
+    """ Rebuild the username/email Bloom filter from the ``User`` table. """
+    return availability.rebuild_filter()
@@ -1,3 +1,988 @@
-from django.test import TestCase
+import asyncio
+import csv
+import hashlib
+import io
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from datetime import date, datetime, timedelta
+from datetime import timezone as dt_timezone
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import fakeredis
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.backends.postgresql.base import DatabaseWrapper as PostgresDatabaseWrapper
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from kombu.exceptions import OperationalError
+from rest_framework.renderers import JSONRenderer
+from rest_framework_simplejwt.tokens import AccessToken
+
+from core import metrics
+from core.db_router import STICKY_KEY, ReplicaRouter, ReplicaStickinessMiddleware, use_primary
+
+from . import idempotency, profile_cache, redis_client
+from .checks import check_revocation_store
+from .clients import AsyncUpstreamClient, CircuitBreaker, CircuitOpenError, UpstreamClient
+from .emails import drain_email_outbox
+from .filters import UserFilter
+from .models import OTP, EmailOutbox, User
+from .otp_store import DatabaseOTPStore, InMemoryOTPStore, RedisOTPStore
+from .profile_cache import get_profile
+from .renderers import FastJSONRenderer
+from .revocation import DisabledRevocationList, RedisRevocationList, get_revocation_list
+from .serializers import UserSerializer, issue_tokens, represent_user_rows, user_values
+from .throttles import IPTokenBucketThrottle, LocalBuckets, consume_token
+
+API = "/api/v1"
+PASSWORD = "Sup3r-secret!"
+
+
+def create_user(username, **fields):
+    user = User.objects.create_user(
+        email=f"{username}@example.com", username=username, first_name="Ada", last_name="Lovelace",
+        dob="1990-01-01", gender="female", phone_number="08012345678", location="Lagos, NG",
+        password=PASSWORD)
+    if fields:
+        User.objects.filter(pk=user.pk).update(**fields)
+        user.refresh_from_db()
+    return user
+
+
+def bearer(user):
+    return {"HTTP_AUTHORIZATION": f"Bearer {issue_tokens(user)['access']}"}
+
+
+class FakeRedisMixin:
+    """ Points ``get_redis()`` at an empty in-memory Redis for each test. """
+
+    def setUp(self):
+        super().setUp()
+        redis_url = override_settings(REDIS_URL="redis://fakeredis")
+        redis_url.enable()
+        self.addCleanup(redis_url.disable)
+        self.redis = redis_client._client = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+        cache.clear()
+
+    def post(self, path, data, **extra):
+        return self.client.post(API + path, data=json.dumps(data), content_type="application/json", **extra)
+
+
+class OTPStoreTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_user("ada")
+
+    def stores(self):
+        return [DatabaseOTPStore(), RedisOTPStore(), InMemoryOTPStore()]
+
+    def test_code_is_consumed_once(self):
+        for store in self.stores():
+            with self.subTest(store=type(store).__name__):
+                code = store.issue(self.user)
+                self.assertTrue(store.consume(self.user.email, code))
+                self.assertFalse(store.consume(self.user.email, code))
+
+    def test_wrong_code_or_email_is_refused(self):
+        for store in self.stores():
+            with self.subTest(store=type(store).__name__):
+                code = store.issue(self.user)
+                wrong = "000000" if code != "000000" else "111111"
+                self.assertFalse(store.consume(self.user.email, wrong))
+                self.assertFalse(store.consume("someone@example.com", code))
+                self.assertTrue(store.consume(self.user.email, code))
+
+    def test_expired_code_is_refused(self):
+        store = DatabaseOTPStore()
+        code = store.issue(self.user)
+        OTP.objects.update(created_at=timezone.now() - timedelta(seconds=store.ttl + 1))
+        self.assertFalse(store.consume(self.user.email, code))
+
+    def test_redis_store_requires_redis(self):
+        with override_settings(REDIS_URL=""):
+            with self.assertRaises(ImproperlyConfigured):
+                RedisOTPStore()
+
+
+class OTPViewTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_user("ada", is_active=False)
+
+    def request_code(self):
+        response = self.post("/otp/request/", {"email": self.user.email})
+        self.assertEqual(response.status_code, 200)
+        return OTP.objects.filter(user=self.user).latest("id").code
+
+    def welcome_emails(self):
+        return EmailOutbox.objects.filter(email=self.user.email, event="welcome_email").count()
+
+    def test_verify_activates_once_and_code_is_single_use(self):
+        code = self.request_code()
+        self.assertEqual(self.post("/otp/verify/", {"email": self.user.email, "code": code}).status_code, 200)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.is_active)
+        self.assertEqual(self.welcome_emails(), 1)
+
+        replayed = self.post("/otp/verify/", {"email": self.user.email, "code": code})
+        self.assertEqual(replayed.status_code, 400)
+
+    def test_verifying_an_active_account_sends_no_welcome_email(self):
+        self.post("/otp/verify/", {"email": self.user.email, "code": self.request_code()})
+        self.post("/otp/verify/", {"email": self.user.email, "code": self.request_code()})
+        self.assertEqual(self.welcome_emails(), 1)
+
+    def test_general_verify_consumes_the_code(self):
+        code = self.request_code()
+        self.assertEqual(self.post("/otp/general-verify/", {"email": self.user.email, "code": code}).status_code, 200)
+        self.assertEqual(self.post("/otp/general-verify/", {"email": self.user.email, "code": code}).status_code, 400)
+
+
+class TokenBucketTests(FakeRedisMixin, TestCase):
+
+    def test_bucket_allows_a_burst_then_refuses(self):
+        # otp_request_email is 3/min: a burst of 3, then one token every 20s.
+        for _ in range(3):
+            self.assertEqual(consume_token("otp_request", "email", "ada@example.com"), (True, 0.0))
+        allowed, wait = consume_token("otp_request", "email", "ada@example.com")
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(wait, 20, delta=1)
+        self.assertTrue(consume_token("otp_request", "email", "bo@example.com")[0])
+
+    def test_unconfigured_scope_is_unthrottled(self):
+        for _ in range(100):
+            self.assertTrue(consume_token("nothing", "ip", "203.0.113.1")[0])
+
+    def test_local_buckets_refill(self):
+        buckets = LocalBuckets()
+        with mock.patch("accounts.throttles.time.monotonic", return_value=100.0):
+            self.assertTrue(buckets.consume("key", 2, 0.5)[0])
+            self.assertTrue(buckets.consume("key", 2, 0.5)[0])
+            self.assertEqual(buckets.consume("key", 2, 0.5), (False, 2.0))
+        with mock.patch("accounts.throttles.time.monotonic", return_value=102.0):
+            self.assertTrue(buckets.consume("key", 2, 0.5)[0])
+            self.assertFalse(buckets.consume("key", 2, 0.5)[0])
+
+    def test_local_buckets_are_bounded(self):
+        buckets = LocalBuckets(maxsize=2)
+        for key in ("a", "b", "c"):
+            buckets.consume(key, 1, 1)
+        self.assertEqual(list(buckets._buckets), ["b", "c"])
+
+    def test_falls_back_to_process_memory_without_redis(self):
+        with override_settings(REDIS_URL=""), \
+                mock.patch("accounts.throttles._local_buckets", LocalBuckets()):
+            results = [consume_token("otp_request", "email", "ada@example.com")[0] for _ in range(4)]
+        self.assertEqual(results, [True, True, True, False])
+
+    def test_view_answers_429_when_the_email_bucket_is_empty(self):
+        user = create_user("ada")
+        for _ in range(3):
+            self.assertEqual(self.post("/otp/request/", {"email": user.email}).status_code, 200)
+        response = self.post("/otp/request/", {"email": user.email})
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Retry-After", response)
+
+    def test_ip_bucket_ignores_client_supplied_forwarded_for_entries(self):
+        # NUM_PROXIES = 1: only the entry our proxy appended counts.
+        factory = RequestFactory()
+        idents = {
+            IPTokenBucketThrottle().get_ident_value(factory.get(
+                "/", HTTP_X_FORWARDED_FOR=f"198.51.100.{n}, 203.0.113.7", REMOTE_ADDR="10.0.0.1"))
+            for n in range(5)
+        }
+        self.assertEqual(idents, {"203.0.113.7"})
+
+
+@override_settings(JWT_REVOCATION_ENABLED=True, JWT_REVOCATION_SYNC_INTERVAL=0)
+class RevocationTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_user("ada")
+
+    def login(self):
+        response = self.post("/login/", {"email": self.user.email, "password": PASSWORD})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_logout_revokes_access_and_refresh_tokens(self):
+        tokens = self.login()
+        auth = {"HTTP_AUTHORIZATION": f"Bearer {tokens['access']}"}
+        self.assertEqual(self.client.get(f"{API}/users/", **auth).status_code, 200)
+
+        self.assertEqual(self.post("/logout/", {"refresh": tokens["refresh"]}, **auth).status_code, 200)
+        self.assertEqual(self.client.get(f"{API}/users/", **auth).status_code, 401)
+        self.assertEqual(self.post("/token/refresh/", {"refresh": tokens["refresh"]}).status_code, 401)
+
+    def test_logout_requires_the_refresh_token(self):
+        tokens = self.login()
+        response = self.post("/logout/", {}, HTTP_AUTHORIZATION=f"Bearer {tokens['access']}")
+        self.assertEqual(response.status_code, 400)
+
+    def test_refresh_token_works_once(self):
+        tokens = self.login()
+        rotated = self.post("/token/refresh/", {"refresh": tokens["refresh"]})
+        self.assertEqual(rotated.status_code, 200)
+        self.assertEqual(self.post("/token/refresh/", {"refresh": tokens["refresh"]}).status_code, 401)
+        self.assertEqual(self.post("/token/refresh/", {"refresh": rotated.json()["refresh"]}).status_code, 200)
+
+    def test_other_processes_see_revocations(self):
+        here = get_revocation_list()
+        elsewhere = RedisRevocationList(self.redis, 1000, 0.001, sync_interval=0)
+        exp = time.time() + 60
+        self.assertFalse(elsewhere.is_revoked("jti-1"))
+        here.revoke("jti-1", exp)
+        self.assertTrue(elsewhere.is_revoked("jti-1"))
+        self.assertFalse(elsewhere.is_revoked("jti-2"))
+
+    def test_rebuild_drops_expired_ids(self):
+        revocations = RedisRevocationList(self.redis, 10, 0.001, sync_interval=0)
+        for n in range(20):
+            revocations.revoke(f"old-{n}", time.time() + 1)
+        revocations.revoke("live", time.time() + 60)
+        self.assertEqual(revocations._count, 21)
+        with mock.patch("accounts.revocation.time.time", return_value=time.time() + 2):
+            revocations.sync()
+        self.assertEqual(revocations._count, 1)
+        self.assertTrue(revocations.is_revoked("live"))
+
+    def test_requires_redis_unless_disabled(self):
+        with override_settings(REDIS_URL=""):
+            with self.assertRaises(ImproperlyConfigured):
+                get_revocation_list()
+            with override_settings(JWT_REVOCATION_ENABLED=False):
+                self.assertIsInstance(get_revocation_list(), DisabledRevocationList)
+
+    def test_system_check_flags_revocation_without_redis(self):
+        self.assertEqual(check_revocation_store(None), [])
+        with override_settings(REDIS_URL=""):
+            self.assertEqual([error.id for error in check_revocation_store(None)], ["accounts.E001"])
+            with override_settings(JWT_REVOCATION_ENABLED=False):
+                self.assertEqual(check_revocation_store(None), [])
+
+
+class NoRedisTests(TestCase):
+    """ The default settings without ``REDIS_URL``. """
+
+    def test_authenticated_requests_work(self):
+        user = create_user("ada")
+        self.assertEqual(self.client.get(f"{API}/users/", **bearer(user)).status_code, 200)
+
+
+class IdempotencyTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_user("ada")
+        self.body = {"email": self.user.email}
+
+    def request_otp(self, key="key-1", body=None):
+        return self.post("/otp/request/", body or self.body, HTTP_IDEMPOTENCY_KEY=key)
+
+    def lock_key(self, key="key-1"):
+        return idempotency._lock_key("otp-request", key)
+
+    def fingerprint(self, body=None):
+        return hashlib.sha256(json.dumps(body or self.body).encode()).hexdigest()
+
+    def test_retry_replays_the_first_response(self):
+        first = self.request_otp()
+        retry = self.request_otp()
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+        self.assertEqual(retry.content, first.content)
+        self.assertEqual(OTP.objects.count(), 1)
+        self.assertEqual(EmailOutbox.objects.count(), 1)
+        self.assertIsNone(self.redis.get(self.lock_key()))
+
+    def test_key_reused_with_another_body_is_refused(self):
+        self.request_otp()
+        response = self.request_otp(body={"email": "someone@example.com"})
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(OTP.objects.count(), 1)
+
+    def test_requests_without_the_header_always_run(self):
+        self.post("/otp/request/", self.body)
+        self.post("/otp/request/", self.body)
+        self.assertEqual(OTP.objects.count(), 2)
+
+    @override_settings(IDEMPOTENCY_WAIT_TIMEOUT=0.2)
+    def test_duplicate_gets_409_while_the_first_is_still_running(self):
+        self.redis.set(self.lock_key(), f"other:{self.fingerprint()}")
+        started = time.monotonic()
+        response = self.request_otp()
+        self.assertEqual(response.status_code, 409)
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(OTP.objects.count(), 0)
+        # Not ours to release.
+        self.assertIsNotNone(self.redis.get(self.lock_key()))
+
+    def test_duplicate_waits_for_the_first_response(self):
+        first = self.request_otp()
+        entry_key = idempotency._key("otp-request", "key-1")
+        entry = self.redis.get(entry_key)
+        self.redis.delete(entry_key)
+        self.redis.set(self.lock_key(), f"other:{self.fingerprint()}")
+
+        def finish_first():
+            time.sleep(0.2)
+            self.redis.set(entry_key, entry)
+            self.redis.delete(self.lock_key())
+
+        finisher = threading.Thread(target=finish_first)
+        finisher.start()
+        try:
+            retry = self.request_otp()
+        finally:
+            finisher.join()
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+        self.assertEqual(retry.content, first.content)
+        self.assertEqual(OTP.objects.count(), 1)
+
+    def test_duplicate_with_another_body_is_refused_while_running(self):
+        self.redis.set(self.lock_key(), f"other:{self.fingerprint()}")
+        self.assertEqual(self.request_otp(body={"email": "someone@example.com"}).status_code, 422)
+
+    def test_release_leaves_a_lock_taken_by_another_request(self):
+        claim = idempotency._Claim(self.redis, "otp-request", "key-1", self.fingerprint())
+        self.assertEqual(claim.attempt(), (True, None))
+        self.redis.set(self.lock_key(), f"other:{self.fingerprint()}")
+        claim.release()
+        self.assertEqual(self.redis.get(self.lock_key()).decode(), f"other:{self.fingerprint()}")
+
+    def test_header_is_ignored_without_redis(self):
+        with override_settings(REDIS_URL=""), self.assertLogs("accounts.idempotency", "WARNING"), \
+                mock.patch("accounts.idempotency._warned_no_redis", False):
+            self.assertEqual(self.request_otp().status_code, 200)
+            self.assertEqual(self.request_otp().status_code, 200)
+        self.assertEqual(OTP.objects.count(), 2)
+
+    @override_settings(IDEMPOTENCY_ENABLED=False)
+    def test_header_is_ignored_when_disabled(self):
+        self.request_otp()
+        self.request_otp()
+        self.assertEqual(OTP.objects.count(), 2)
+
+
+class FakeReplicaHealth:
+    aliases = healthy = ["replica_1"]
+
+    def ensure_running(self):
+        pass
+
+
+@override_settings(REDIS_URL="redis://fakeredis")
+class ReplicaRoutingTests(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch("core.db_router.get_replica_health", return_value=FakeReplicaHealth())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cache.clear()
+        self.router = ReplicaRouter()
+        self.factory = RequestFactory()
+
+    def handle(self, user_id=None, write=False, view=None):
+        """ Run a request through the middleware; returns where its reads went. """
+        reads = []
+
+        def default_view(request):
+            reads.append(self.router.db_for_read(User))
+            if write:
+                self.router.db_for_write(User)
+                reads.append(self.router.db_for_read(User))
+            return HttpResponse()
+
+        extra = {}
+        if user_id is not None:
+            token = AccessToken()
+            token["user_id"] = user_id
+            extra["HTTP_AUTHORIZATION"] = f"Bearer {token}"
+        ReplicaStickinessMiddleware(view or default_view)(self.factory.get("/", **extra))
+        return reads
+
+    def test_reads_go_to_a_replica(self):
+        self.assertEqual(self.handle(), ["replica_1"])
+        self.assertEqual(self.handle(user_id=1), ["replica_1"])
+
+    def test_reads_outside_a_request_go_to_the_primary(self):
+        self.assertEqual(self.router.db_for_read(User), DEFAULT_DB_ALIAS)
+
+    def test_writer_reads_the_primary_until_the_window_closes(self):
+        self.assertEqual(self.handle(user_id=1, write=True), ["replica_1", DEFAULT_DB_ALIAS])
+        self.assertEqual(self.handle(user_id=1), [DEFAULT_DB_ALIAS])
+        self.assertEqual(self.handle(user_id=2), ["replica_1"])
+        self.assertEqual(self.handle(), ["replica_1"])
+
+        cache.delete(STICKY_KEY.format(1))
+        self.assertEqual(self.handle(user_id=1), ["replica_1"])
+
+    def test_anonymous_writes_open_no_window(self):
+        self.handle(write=True)
+        self.assertEqual(self.handle(), ["replica_1"])
+
+    def test_use_primary_views_read_the_primary(self):
+        reads = []
+
+        @use_primary
+        def view(request):
+            reads.append(self.router.db_for_read(User))
+            return HttpResponse()
+
+        self.handle(view=view)
+        self.assertEqual(reads, [DEFAULT_DB_ALIAS])
+
+    def test_replicas_require_redis(self):
+        with override_settings(REDIS_URL=""):
+            with self.assertRaises(ImproperlyConfigured):
+                ReplicaStickinessMiddleware(lambda request: HttpResponse())
+
+
+class CursorPaginationTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.users = [create_user(f"user{n}") for n in range(5)]
+        self.auth = bearer(self.users[0])
+
+    def pages(self, url):
+        while url:
+            response = self.client.get(url, **self.auth)
+            self.assertEqual(response.status_code, 200)
+            body = response.json()
+            yield body
+            url = body["next"]
+
+    def test_pages_cover_every_user_newest_first(self):
+        pages = list(self.pages(f"{API}/users/?pagination=cursor&page_size=2"))
+        self.assertEqual([len(page["results"]) for page in pages], [2, 2, 1])
+        self.assertNotIn("count", pages[0])
+        usernames = [row["username"] for page in pages for row in page["results"]]
+        self.assertEqual(usernames, [user.username for user in reversed(self.users)])
+
+    def test_sign_ups_do_not_shift_later_pages(self):
+        pages = self.pages(f"{API}/users/?pagination=cursor&page_size=2")
+        seen = [row["username"] for row in next(pages)["results"]]
+        create_user("latecomer")
+        seen += [row["username"] for page in pages for row in page["results"]]
+        self.assertEqual(seen, [user.username for user in reversed(self.users)])
+
+    def test_filters_apply(self):
+        body = self.client.get(f"{API}/users/", {"pagination": "cursor", "username": "user3"}, **self.auth).json()
+        self.assertEqual([row["username"] for row in body["results"]], ["user3"])
+
+    def test_page_numbers_still_work(self):
+        body = self.client.get(f"{API}/users/", {"page": 2, "page_size": 2}, **self.auth).json()
+        self.assertEqual(body["count"], 5)
+        self.assertEqual(len(body["results"]), 2)
+
+
+@override_settings(USER_EXPORT_CHUNK_SIZE=2)
+class ExportTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.users = [create_user(f"user{n}") for n in range(5)]
+        self.staff = create_user("staff", is_staff=True)
+
+    def export(self, **params):
+        response = self.client.get(f"{API}/export/users/", params, **bearer(self.staff))
+        self.assertEqual(response.status_code, 200)
+        return response, b"".join(response.streaming_content).decode()
+
+    def test_ndjson_has_one_user_per_line_in_id_order(self):
+        response, content = self.export()
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([row["username"] for row in rows], [f"user{n}" for n in range(5)] + ["staff"])
+        self.assertEqual(rows[0], UserSerializer(self.users[0]).data)
+
+    def test_csv_has_a_header_and_values_as_stored(self):
+        User.objects.filter(pk=self.users[1].pk).update(
+            first_name="=HYPERLINK(\"http://x\")", last_name="-1", phone_number="+2348012345678")
+        response, content = self.export(output="csv")
+        self.assertEqual(response["Content-Type"], "text/csv; charset=utf-8")
+        rows = list(csv.reader(io.StringIO(content)))
+        self.assertEqual(rows[0], list(UserSerializer.Meta.fields))
+        self.assertEqual(len(rows), 7)
+        row = dict(zip(rows[0], rows[2]))
+        self.assertEqual(row["first_name"], "=HYPERLINK(\"http://x\")")
+        self.assertEqual(row["last_name"], "-1")
+        self.assertEqual(row["phone_number"], "+2348012345678")
+
+    def test_spreadsheet_csv_neutralizes_formulas(self):
+        User.objects.filter(pk=self.users[1].pk).update(first_name="=HYPERLINK(\"http://x\")", last_name="-1")
+        _, content = self.export(output="spreadsheet")
+        rows = list(csv.reader(io.StringIO(content)))
+        row = dict(zip(rows[0], rows[2]))
+        self.assertEqual(row["first_name"], "'=HYPERLINK(\"http://x\")")
+        self.assertEqual(row["last_name"], "'-1")
+        self.assertEqual(row["username"], "user1")
+
+    def test_filters_apply(self):
+        _, content = self.export(username="user2")
+        self.assertEqual([json.loads(line)["username"] for line in content.splitlines()], ["user2"])
+
+    def test_unknown_output_is_rejected(self):
+        response = self.client.get(f"{API}/export/users/", {"output": "xml"}, **bearer(self.staff))
+        self.assertEqual(response.status_code, 400)
+
+    def test_staff_only(self):
+        response = self.client.get(f"{API}/export/users/", **bearer(self.users[0]))
+        self.assertEqual(response.status_code, 403)
+
+
+class SearchTests(TestCase):
+
+    def setUp(self):
+        for username in ("ada", "adaeze", "bola"):
+            create_user(username)
+
+    def search(self, **params):
+        return sorted(UserFilter(params, queryset=User.objects.all()).qs.values_list("username", flat=True))
+
+    def test_substring_search_is_case_insensitive(self):
+        self.assertEqual(self.search(username="ADA"), ["ada", "adaeze"])
+        self.assertEqual(self.search(username="aez"), ["adaeze"])
+        self.assertEqual(self.search(email="bola@exam"), ["bola"])
+        self.assertEqual(self.search(username="xyz"), [])
+
+    def test_short_terms_fall_back_to_icontains(self):
+        self.assertEqual(self.search(username="da"), ["ada", "adaeze"])
+
+    def test_like_wildcards_match_literally(self):
+        self.assertEqual(self.search(username="a_a"), [])
+        self.assertEqual(self.search(username="a%a"), [])
+
+    def test_index_follows_renames(self):
+        user = User.objects.get(username="bola")
+        user.username = "bolatito"
+        user.save(update_fields=["username"])
+        self.assertEqual(self.search(username="tito"), ["bolatito"])
+
+    def test_postgres_lookup_wraps_the_term_once(self):
+        settings_dict = dict(connections[DEFAULT_DB_ALIAS].settings_dict,
+                             ENGINE="django.db.backends.postgresql", NAME="unused")
+        postgres = PostgresDatabaseWrapper(settings_dict, alias="postgres")
+        for term, param in (("ada", "%ada%"), ("a_a%", r"%a\_a\%%")):
+            with self.subTest(term=term):
+                query = User.objects.filter(username__trgm_icontains=term).query
+                sql, params = query.get_compiler(connection=postgres).as_sql()
+                self.assertIn('"accounts_user"."username" ILIKE %s', sql)
+                self.assertEqual(params, (param,))
+
+
+class EmailOutboxTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_user("ada")
+
+    def test_broker_outage_does_not_fail_the_request(self):
+        with mock.patch.object(drain_email_outbox, "apply_async", side_effect=OperationalError("broker down")), \
+                self.assertLogs("accounts.emails", "ERROR"), \
+                self.captureOnCommitCallbacks(execute=True) as callbacks:
+            response = self.post("/otp/request/", {"email": self.user.email})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(EmailOutbox.objects.get().status, EmailOutbox.STATUS_PENDING)
+        self.assertEqual(OTP.objects.count(), 1)
+
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.exceptions.HTTPError(f"{status} error", response=response)
+
+
+class EmailOutboxDrainTests(TestCase):
+
+    def queue(self, count=1, queue=EmailOutbox.QUEUE_OTP, **fields):
+        return [
+            EmailOutbox.objects.create(event="general_send_otp", email=f"user{n}@example.com", queue=queue, **fields)
+            for n in range(count)
+        ]
+
+    def drain(self, side_effect=None, queue=EmailOutbox.QUEUE_OTP):
+        with mock.patch("accounts.emails.post_email", side_effect=side_effect) as post:
+            return drain_email_outbox(queue), post
+
+    def test_sends_due_messages(self):
+        self.queue(3)
+        result, post = self.drain()
+        self.assertEqual(result, {"sent": 3, "failed": 0})
+        self.assertEqual(post.call_count, 3)
+        self.assertEqual(set(EmailOutbox.objects.values_list("status", "attempts")), {(EmailOutbox.STATUS_SENT, 1)})
+        self.assertEqual(self.drain()[0], {"sent": 0, "failed": 0})
+
+    def test_transient_failures_are_retried_after_a_backoff(self):
+        [message] = self.queue()
+        result, _ = self.drain(requests.exceptions.ConnectionError("reset"))
+        self.assertEqual(result, {"sent": 0, "failed": 1})
+        message.refresh_from_db()
+        self.assertEqual(message.status, EmailOutbox.STATUS_PENDING)
+        self.assertIn("reset", message.last_error)
+        self.assertGreater(message.next_attempt_at, timezone.now())
+
+        # Not due yet.
+        self.assertEqual(self.drain()[1].call_count, 0)
+
+        EmailOutbox.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(self.drain()[0], {"sent": 1, "failed": 0})
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts, message.last_error), (EmailOutbox.STATUS_SENT, 2, ""))
+
+    def test_server_errors_are_retried_but_client_errors_are_not(self):
+        retried, rejected = self.queue(2)
+        errors = {retried.email: http_error(503), rejected.email: http_error(400)}
+
+        def post_email(event, email, data):
+            raise errors[email]
+
+        self.drain(post_email)
+        retried.refresh_from_db()
+        rejected.refresh_from_db()
+        self.assertEqual(retried.status, EmailOutbox.STATUS_PENDING)
+        self.assertEqual(rejected.status, EmailOutbox.STATUS_FAILED)
+
+    @override_settings(EMAIL_OUTBOX_MAX_ATTEMPTS=2)
+    def test_gives_up_after_the_last_attempt(self):
+        [message] = self.queue()
+        for _ in range(2):
+            EmailOutbox.objects.update(next_attempt_at=timezone.now())
+            self.drain(requests.exceptions.Timeout("slow"))
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts), (EmailOutbox.STATUS_FAILED, 2))
+
+    def test_reclaims_messages_a_dead_worker_left_sending(self):
+        stale = timezone.now() - timedelta(seconds=settings.EMAIL_OUTBOX_CLAIM_TIMEOUT + 1)
+        self.queue(status=EmailOutbox.STATUS_SENDING, claimed_at=stale, attempts=1)
+        self.queue(status=EmailOutbox.STATUS_SENDING, claimed_at=timezone.now(), attempts=1)
+        self.assertEqual(self.drain()[0], {"sent": 1, "failed": 0})
+
+    def test_drains_only_its_queue(self):
+        self.queue(queue=EmailOutbox.QUEUE_BULK)
+        self.assertEqual(self.drain()[0], {"sent": 0, "failed": 0})
+        self.assertEqual(self.drain(queue=EmailOutbox.QUEUE_BULK)[0], {"sent": 1, "failed": 0})
+
+    @override_settings(EMAIL_OUTBOX_BATCH_SIZE=2, EMAIL_OUTBOX_MAX_BATCHES_PER_RUN=2)
+    def test_hands_a_backlog_over_to_a_fresh_task(self):
+        self.queue(5)
+        with mock.patch.object(drain_email_outbox, "apply_async") as apply_async:
+            self.assertEqual(self.drain()[0], {"sent": 4, "failed": 0})
+        apply_async.assert_called_once_with(args=[EmailOutbox.QUEUE_OTP], queue=EmailOutbox.QUEUE_OTP)
+
+
+class CircuitBreakerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.upstream = UpstreamClient("test", "http://upstream.invalid", failure_threshold=2, reset_timeout=30)
+        self.breaker = self.upstream.breaker
+        self.now = 1000.0
+        patcher = mock.patch("accounts.clients.time.monotonic", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def call(self, outcome):
+        """ One request whose upstream answers ``outcome`` (a status code or an exception). """
+        if isinstance(outcome, int):
+            response = requests.Response()
+            response.status_code = outcome
+            upstream = mock.Mock(return_value=response)
+        else:
+            upstream = mock.Mock(side_effect=outcome)
+        with mock.patch.object(self.upstream.session, "request", upstream):
+            try:
+                return self.upstream.get("/")
+            finally:
+                self.upstream_called = upstream.called
+
+    def test_opens_after_consecutive_failures(self):
+        self.call(503)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.call(requests.exceptions.ConnectionError("refused"))
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+        with self.assertRaises(CircuitOpenError):
+            self.call(200)
+        self.assertFalse(self.upstream_called)
+
+    def test_success_resets_the_failure_count(self):
+        self.call(503)
+        self.call(200)
+        self.call(429)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_client_errors_are_not_failures(self):
+        for _ in range(3):
+            self.call(404)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def open(self):
+        self.call(503)
+        self.call(503)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.now += 30
+
+    def test_half_opens_for_one_trial_after_the_timeout(self):
+        self.open()
+        self.breaker.before_call()
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        # Only the trial goes through.
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call()
+
+    def test_successful_trial_closes(self):
+        self.open()
+        self.call(200)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.call(200)
+
+    def test_failed_trial_reopens(self):
+        self.open()
+        self.call(500)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpenError):
+            self.call(200)
+
+    def test_trial_that_raises_unexpectedly_reopens(self):
+        self.open()
+        with self.assertRaises(ValueError):
+            self.call(ValueError("bug"))
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    async def test_cancelled_async_trial_reopens(self):
+        self.open()
+        upstream = AsyncUpstreamClient("test", "http://upstream.invalid", self.breaker)
+        with mock.patch.object(upstream.session, "request", side_effect=asyncio.CancelledError):
+            with self.assertRaises(asyncio.CancelledError):
+                await upstream.get("/")
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+
+class FastJSONRendererTests(TestCase):
+
+    def assertRendersLikeDRF(self, data, accepted_media_type=None):
+        self.assertEqual(FastJSONRenderer().render(data, accepted_media_type),
+                         JSONRenderer().render(data, accepted_media_type))
+
+    def test_matches_json_renderer_byte_for_byte(self):
+        samples = [
+            {"a": 1, "b": [True, False, None], "nested": {"empty": {}, "list": []}},
+            ["plain", "ünïcödé", "emoji 🎉", "quote \" backslash \\ newline \n tab \t", "\x00\x1f"],
+            {"separators": "\u2028 and \u2029", "html": "<script>&</script>"},
+            {"big": 2 ** 53, "negative": -1, "zero": 0},
+            {"date": date(1990, 1, 1), "time": datetime(2024, 5, 6, 7, 8, 9).time()},
+            {"naive": datetime(2024, 5, 6, 7, 8, 9, 123456)},
+            {"aware": timezone.make_aware(datetime(2024, 5, 6, 7, 8, 9, 123456), dt_timezone.utc)},
+            {"decimal": Decimal("12.50"), "uuid": uuid.UUID(int=1), "delta": timedelta(hours=1)},
+            {1: "non-string key"},
+            {"lazy": gettext_lazy("Invalid page.")},
+            "",
+            None,
+        ]
+        for data in samples:
+            with self.subTest(data=data):
+                self.assertRendersLikeDRF(data)
+
+    def test_indent_requests_match(self):
+        self.assertRendersLikeDRF({"a": [1, 2]}, "application/json; indent=2")
+
+    def test_user_rows_match_the_serializer(self):
+        create_user("ada")
+        create_user("bola", location=None)
+        queryset = User.objects.order_by("pk")
+        rows = represent_user_rows(list(user_values(queryset)))
+        serialized = UserSerializer(queryset, many=True).data
+        self.assertEqual(FastJSONRenderer().render(rows), JSONRenderer().render(serialized))
+
+
+class ProfileCacheTests(FakeRedisMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = create_user("ada")
+        self.auth = bearer(self.user)
+
+    def get(self, username="ada", **extra):
+        return self.client.get(f"{API}/users/{username}/", **self.auth, **extra)
+
+    def test_etag_round_trip(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+        for header in (etag, f"W/{etag}", f'"other", {etag}', "*"):
+            with self.subTest(header=header):
+                not_modified = self.get(HTTP_IF_NONE_MATCH=header)
+                self.assertEqual(not_modified.status_code, 304)
+                self.assertEqual(not_modified.content, b"")
+                self.assertEqual(not_modified["ETag"], etag)
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_saving_the_user_changes_the_etag(self):
+        etag = self.get()["ETag"]
+        self.user.first_name = "Augusta"
+        self.user.save()
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["first_name"], "Augusta")
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_hits_skip_the_database(self):
+        get_profile("ada")
+        with self.assertNumQueries(0):
+            self.assertEqual(get_profile("ada")["data"]["username"], "ada")
+
+    def test_unknown_usernames_are_cached_as_missing(self):
+        self.assertEqual(self.get("nobody").status_code, 404)
+        with self.assertNumQueries(0):
+            self.assertIsNone(get_profile("nobody")["data"])
+        create_user("nobody")
+        self.assertEqual(self.get("nobody").status_code, 200)
+
+    def test_fill_racing_a_save_is_not_served(self):
+        load = profile_cache._load
+
+        def load_then_save(username, generation=0):
+            entry = load(username, generation)
+            User.objects.get(username=username).save()  # bumps the generation
+            return entry
+
+        User.objects.filter(pk=self.user.pk).update(first_name="Augusta")
+        with mock.patch("accounts.profile_cache._load", side_effect=load_then_save):
+            self.assertEqual(get_profile("ada")["data"]["first_name"], "Augusta")
+        # The entry filled before the save carries an old generation.
+        self.assertIsNone(profile_cache._cached("ada"))
+
+    def test_rename_evicts_the_old_username(self):
+        get_profile("ada")
+        self.user.username = "augusta"
+        self.user.save()
+        self.assertIsNone(get_profile("ada")["data"])
+        self.assertEqual(get_profile("augusta")["data"]["username"], "augusta")
+
+    def test_deleting_the_user_evicts_it(self):
+        get_profile("ada")
+        with mock.patch("accounts.signals.schedule_rebuild"):
+            self.user.delete()
+        self.assertIsNone(get_profile("ada")["data"])
+
+    def test_reads_the_database_without_redis(self):
+        with override_settings(REDIS_URL=""):
+            get_profile("ada")
+            with self.assertNumQueries(1):
+                get_profile("ada")
+
+
+class MetricsTests(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        overrides = override_settings(METRICS_DIR=self.directory, METRICS_TOKEN="secret")
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        for patcher in (mock.patch("core.metrics.registry", metrics.Registry()),
+                        mock.patch("core.metrics._purge_stats", return_value=[])):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.host = socket.gethostname()
+
+    def write(self, filename, snapshot):
+        with open(os.path.join(self.directory, filename), "w") as f:
+            json.dump(snapshot, f)
+
+    def snapshot(self, seconds, latency):
+        registry = metrics.Registry()
+        registry.observe("db_query_duration_seconds_total", {"route": "users/"}, seconds)
+        registry.observe("http_request_duration_seconds", {"route": "users/"}, latency)
+        return registry.snapshot()
+
+    def totals(self):
+        merged = metrics.collect()
+        route = (("route", "users/"),)
+        return (merged[("db_query_duration_seconds_total", route)],
+                merged[("http_request_duration_seconds", route)])
+
+    def test_histogram_buckets(self):
+        registry = metrics.Registry()
+        for value in (0.001, 0.02, 0.02, 100):
+            registry.observe("http_request_duration_seconds", {"route": "r"}, value)
+        [[_, _, value]] = registry.snapshot()
+        self.assertEqual(value[:len(metrics.LATENCY_BUCKETS)], [1, 0, 2] + [0] * (len(metrics.LATENCY_BUCKETS) - 3))
+        self.assertEqual(value[-2:], [100.041, 4])
+
+    def test_collect_merges_every_process(self):
+        metrics.registry.observe("db_query_duration_seconds_total", {"route": "users/"}, 1.0)
+        self.write("otherhost-1.json", self.snapshot(2.0, 0.02))
+        self.write("otherhost-2.json", self.snapshot(4.0, 0.2) + [["unknown_metric", [], 1]])
+        self.write("otherhost-3.json.tmp", self.snapshot(100.0, 0.2))
+        with open(os.path.join(self.directory, "otherhost-4.json"), "w") as f:
+            f.write("{truncated")
+        seconds, histogram = self.totals()
+        self.assertEqual(seconds, 7.0)
+        self.assertEqual(histogram[-1], 2)
+        self.assertAlmostEqual(histogram[-2], 0.22)
+
+    def test_flush_writes_this_process(self):
+        metrics.registry.observe("db_query_duration_seconds_total", {"route": "users/"}, 1.5)
+        metrics.registry.flush()
+        self.assertEqual(os.listdir(self.directory), [f"{self.host}-{os.getpid()}.json"])
+
+    def test_exited_processes_are_folded_once(self):
+        self.write(f"{self.host}-999998.json", self.snapshot(1.0, 0.02))
+        self.write(f"{self.host}-999999.json", self.snapshot(2.0, 0.02))
+        self.write("otherhost-999999.json", self.snapshot(4.0, 0.02))
+        self.write(f"{self.host}-{os.getpid()}.json", [])
+
+        def kill(pid, signal):
+            if pid >= 999998:
+                raise ProcessLookupError
+
+        with mock.patch("core.metrics.os.kill", side_effect=kill):
+            for _ in range(3):
+                seconds, histogram = self.totals()
+                self.assertEqual((seconds, histogram[-1]), (7.0, 3))
+            self.assertEqual(
+                sorted(name for name in os.listdir(self.directory) if name.endswith(".json")),
+                sorted([metrics.EXITED_FILE, "otherhost-999999.json", f"{self.host}-{os.getpid()}.json"]))
+
+            # A later exit adds to the same file.
+            self.write(f"{self.host}-999998.json", self.snapshot(8.0, 0.02))
+            self.assertEqual(self.totals()[0], 15.0)
+
+    def test_render(self):
+        metrics.registry.observe("http_request_duration_seconds", {"route": "users/", "method": "GET"}, 0.02)
+        body = metrics.render()
+        self.assertIn("# TYPE http_request_duration_seconds histogram", body)
+        self.assertIn('http_request_duration_seconds_bucket{method="GET",route="users/",le="0.025"} 1', body)
+        self.assertIn('http_request_duration_seconds_bucket{method="GET",route="users/",le="0.01"} 0', body)
+        self.assertIn('http_request_duration_seconds_count{method="GET",route="users/"} 1', body)
+
+    def test_view_requires_the_token(self):
+        request = RequestFactory().get("/metrics")
+        self.assertEqual(metrics.metrics_view(request).status_code, 403)
+        authorized = RequestFactory().get("/metrics", HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(metrics.metrics_view(authorized).status_code, 200)
+        with override_settings(METRICS_TOKEN="", DEBUG=False), self.assertLogs("core.metrics", "WARNING"):
+            self.assertEqual(metrics.metrics_view(request).status_code, 403)
+        with override_settings(METRICS_TOKEN="", DEBUG=True):
+            self.assertEqual(metrics.metrics_view(request).status_code, 200)
@@ -0,0 +1,156 @@
+"""
+Token-bucket throttles for the OTP and login endpoints.
+
+Views opt in with a ``throttle_scope``; each throttle class looks up its
+rate as ``DEFAULT_THROTTLE_RATES["<scope>_<kind>"]`` using DRF's
+``"<count>/<period>"`` format. ``count`` is the bucket size (the burst a
+client may send) and the bucket refills at ``count`` tokens per period.
+
+Buckets live in Redis and are checked and updated by one Lua script, so a
+check is a single atomic round-trip shared by every process. Without
+Redis, or if Redis errors, buckets fall back to process memory.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from redis.exceptions import RedisError
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local refill_rate = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * refill_rate)
+
+local allowed = 0
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = (1 - tokens) / refill_rate
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / refill_rate) + 1)
+return {allowed, tostring(wait)}
+"""
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(rate):
+    """ ``"5/min"`` -> ``(5, 5 / 60)``: bucket size and tokens per second. """
+    num, period = rate.split('/')
+    capacity = int(num)
+    return capacity, capacity / PERIODS[period[0]]
+
+
+class LocalBuckets:
+    """ In-process fallback; bounded so unique idents can't grow it forever. """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key, capacity, refill_rate):
+        now = time.monotonic()
+        with self._lock:
+            tokens, ts = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - ts) * refill_rate)
+            if tokens >= 1:
+                tokens -= 1
+                allowed, wait = True, 0.0
+            else:
+                allowed, wait = False, (1 - tokens) / refill_rate
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return allowed, wait
+
+
+_local_buckets = LocalBuckets()
+_script = None
+
+
+def consume_token(scope, kind, ident):
+    """
+    Take a token from the ``<scope>_<kind>`` bucket for ``ident``.
+
+    Returns ``(allowed, wait_seconds)``. Scopes without a configured rate
+    are unthrottled.
+    """
+    global _script
+    rate = api_settings.DEFAULT_THROTTLE_RATES.get(f"{scope}_{kind}")
+    if not rate or ident is None:
+        return True, 0.0
+    capacity, refill_rate = parse_rate(rate)
+    key = f"throttle:{scope}:{kind}:{ident}"
+
+    redis = get_redis()
+    if redis is not None:
+        try:
+            if _script is None or _script.registered_client is not redis:
+                _script = redis.register_script(TOKEN_BUCKET_SCRIPT)
+            allowed, wait = _script(keys=[key], args=[capacity, refill_rate])
+            return bool(allowed), float(wait)
+        except RedisError:
+            logger.exception("Throttle store unavailable; using in-process buckets")
+    return _local_buckets.consume(key, capacity, refill_rate)
+
+
+def normalize_email_ident(email):
+    if not isinstance(email, str) or not email.strip():
+        return None
+    return email.strip().lower()
+
+
+class TokenBucketThrottle(BaseThrottle):
+    kind = None
+
+    def get_ident_value(self, request):
+        raise NotImplementedError
+
+    def allow_request(self, request, view):
+        scope = getattr(view, 'throttle_scope', None)
+        if not scope:
+            return True
+        allowed, self._wait = consume_token(scope, self.kind, self.get_ident_value(request))
+        return allowed
+
+    def wait(self):
+        return self._wait
+
+
+class IPTokenBucketThrottle(TokenBucketThrottle):
+    """
+    One bucket per client IP. ``REST_FRAMEWORK['NUM_PROXIES']`` must match
+    the proxy chain: unset, DRF keys on the raw X-Forwarded-For header,
+    which a client can change on every request.
+    """
+    kind = 'ip'
+
+    def get_ident_value(self, request):
+        return self.get_ident(request)
+
+
+class EmailTokenBucketThrottle(TokenBucketThrottle):
+    """ One bucket per target email, whichever IP the requests come from. """
+    kind = 'email'
+
+    def get_ident_value(self, request):
+        data = request.data
+        return normalize_email_ident(data.get('email') if hasattr(data, 'get') else None)
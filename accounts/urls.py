@@ -1,22 +1,47 @@
 from django.urls import path
+from core.db_router import use_primary
+from rest_framework_simplejwt.views import TokenRefreshView
+from .async_views import (
+    AsyncAvailabilityView, AsyncGeneralOTPVerifyView, AsyncGetLocationView, AsyncGetUserByUsernameView,
+    AsyncLoginView, AsyncLogoutView, AsyncOTPRequestView, AsyncOTPVerifyView, AsyncRegisterView,
+)
 from .views import (
-    RegisterView, OTPRequestView, OTPVerifyView, GeneralOTPVerifyView,
-    LoginView, LogoutView, GetLocationAPIView, GetUserByUsernameAPIView, GetAllUsersAPIView
+    RegisterView, AvailabilityView, OTPRequestView, OTPVerifyView, GeneralOTPVerifyView,
+    LoginView, LogoutView, GetLocationAPIView, GetUserByUsernameAPIView, GetAllUsersAPIView,
+    ExportUsersView
 )
+from .idempotency import idempotent
 
 urlpatterns = [
-    path('register/', RegisterView.as_view(), name='register'),
-    path('otp/request/', OTPRequestView.as_view(), name='otp-request'),
-    path('otp/verify/', OTPVerifyView.as_view(), name='otp-verify'),
-    path('otp/general-verify/', GeneralOTPVerifyView.as_view(),
+    path('register/', use_primary(idempotent('register')(RegisterView.as_view())), name='register'),
+    path('register/async/', use_primary(idempotent('register')(AsyncRegisterView.as_view())),
+         name='register-async'),
+    path('availability/', AvailabilityView.as_view(), name='availability'),
+    path('availability/async/', AsyncAvailabilityView.as_view(), name='availability-async'),
+    path('otp/request/', use_primary(idempotent('otp-request')(OTPRequestView.as_view())),
+         name='otp-request'),
+    path('otp/request/async/', use_primary(idempotent('otp-request')(AsyncOTPRequestView.as_view())),
+         name='otp-request-async'),
+    path('otp/verify/', use_primary(OTPVerifyView.as_view()), name='otp-verify'),
+    path('otp/verify/async/', use_primary(AsyncOTPVerifyView.as_view()), name='otp-verify-async'),
+    path('otp/general-verify/', use_primary(GeneralOTPVerifyView.as_view()),
          name='otp-general-verify'),
-    path('login/', LoginView.as_view(), name='login'),
+    path('otp/general-verify/async/', use_primary(AsyncGeneralOTPVerifyView.as_view()),
+         name='otp-general-verify-async'),
+    path('login/', use_primary(LoginView.as_view()), name='login'),
+    path('login/async/', use_primary(AsyncLoginView.as_view()), name='login-async'),
     path('logout/', LogoutView.as_view(), name='logout'),
+    path('logout/async/', AsyncLogoutView.as_view(), name='logout-async'),
+    path('token/refresh/', use_primary(TokenRefreshView.as_view()), name='token-refresh'),
     path('get-location/', GetLocationAPIView.as_view(), name='get-location'),
+    path('get-location/async/', AsyncGetLocationView.as_view(), name='get-location-async'),
 
         path('users/<str:username>/', GetUserByUsernameAPIView.as_view(),
              name='get-user-by-username'),
+        path('users/<str:username>/async/', AsyncGetUserByUsernameView.as_view(),
+             name='get-user-by-username-async'),
         path('users/', GetAllUsersAPIView.as_view(), name='get-all-users'),
+        path('export/users/', ExportUsersView.as_view(), name='export-users'),
 
 
 ]
@@ -1,26 +1,50 @@
 from django.contrib.auth import authenticate
+from django.db import transaction
 from django.utils.timezone import now
 import requests
 from rest_framework import status, generics, permissions
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from drf_spectacular.utils import extend_schema
+from drf_spectacular.utils import OpenApiParameter, extend_schema
 from rest_framework_simplejwt.tokens import RefreshToken
 
 from .models import User, OTP
 from .serializers import (
     RegistrationSerializer, OTPRequestSerializer, OTPVerificationSerializer,
-    GeneralOTPVerificationSerializer, LoginSerializer, LogoutSerializer
+    GeneralOTPVerificationSerializer, LoginSerializer, LogoutSerializer,
+    AvailabilitySerializer
 )
-from .emails import send_otp_email_task, send_welcome_email_task
+from .emails import queue_otp_email, queue_welcome_email
+from .geolocation import client_ip, lookup_location
+from .otp_store import get_otp_store
+from .availability import check_availability
+from .throttles import EmailTokenBucketThrottle, IPTokenBucketThrottle
+from .profile_cache import etag_matches, get_profile
+from .revocation import revoke_token
+from .authentication import get_model_user
+from redis.exceptions import RedisError
+import logging
 import django_filters
 from django_filters.rest_framework import DjangoFilterBackend
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import CursorPagination, PageNumberPagination
 from accounts.filters import UserFilter
 from rest_framework.generics import ListAPIView, RetrieveAPIView
-from .serializers import UserSerializer
-from django.shortcuts import get_object_or_404
+from .serializers import UserSerializer, represent_user_rows, user_values
+from .renderers import FastJSONRenderer
+from rest_framework.renderers import BrowsableAPIRenderer
+from django.http import Http404, StreamingHttpResponse
+from rest_framework.exceptions import ValidationError
+from .export import EXPORT_FORMATS, export_stream
+from .idempotency import HEADER as IDEMPOTENCY_HEADER
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_KEY_PARAMETER = OpenApiParameter(
+    IDEMPOTENCY_HEADER, str, OpenApiParameter.HEADER, required=False,
+    description="Unique per logical request (e.g. a UUID). Retries with the same key and body "
+                "get the first response back instead of running again; see accounts/idempotency.py.",
+)
 
 
 class RegisterView(generics.CreateAPIView):
@@ -28,42 +52,77 @@ class RegisterView(generics.CreateAPIView):
     serializer_class = RegistrationSerializer
     permission_classes = [permissions.AllowAny]
 
-    @extend_schema(request=RegistrationSerializer, responses={201: "User registered successfully"})
+    @extend_schema(
+        request=RegistrationSerializer,
+        parameters=[IDEMPOTENCY_KEY_PARAMETER],
+        responses={201: "User registered successfully"},
+    )
     def post(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         if serializer.is_valid():
-            user = serializer.save()
-            otp_instance = OTP.objects.create(user=user)
-            send_otp_email_task(user.email,user.first_name, otp_instance.code)
+            # Creates the user and issues and emails their OTP.
+            serializer.save()
             return Response({"message": "User registered successfully. Check your email for OTP."}, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class AvailabilityView(APIView):
+    """
+    Check whether an email and/or username can still be registered.
+
+    Answers from the availability Bloom filter where possible, so most
+    checks never touch the database.
+    """
+    permission_classes = [permissions.AllowAny]
+
+    @extend_schema(
+        summary="Check Email/Username Availability",
+        parameters=[AvailabilitySerializer],
+        responses={200: "Availability per requested field, e.g. {\"email\": true}"},
+    )
+    def get(self, request):
+        serializer = AvailabilitySerializer(data=request.query_params)
+        if serializer.is_valid():
+            return Response(check_availability(**serializer.validated_data), status=status.HTTP_200_OK)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
 class OTPRequestView(APIView):
     permission_classes = [permissions.AllowAny]
+    throttle_classes = [IPTokenBucketThrottle, EmailTokenBucketThrottle]
+    throttle_scope = "otp_request"
 
-    @extend_schema(request=OTPRequestSerializer, responses={200: "OTP sent successfully"})
+    @extend_schema(
+        request=OTPRequestSerializer,
+        parameters=[IDEMPOTENCY_KEY_PARAMETER],
+        responses={200: "OTP sent successfully"},
+    )
     def post(self, request):
         serializer = OTPRequestSerializer(data=request.data)
         if serializer.is_valid():
             user = serializer.validated_data["user"]
-            otp_instance = OTP.objects.create(user=user)
-            send_otp_email_task(user.email,user.first_name, otp_instance.code)
+            with transaction.atomic():
+                code = get_otp_store().issue(user)
+                queue_otp_email(user, code)
             return Response({"message": "OTP sent successfully."}, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
 class OTPVerifyView(APIView):
     permission_classes = [permissions.AllowAny]
+    throttle_classes = [IPTokenBucketThrottle, EmailTokenBucketThrottle]
+    throttle_scope = "otp_verify"
 
     @extend_schema(request=OTPVerificationSerializer, responses={200: "Account activated successfully"})
     def post(self, request):
         serializer = OTPVerificationSerializer(data=request.data)
         if serializer.is_valid():
             user = serializer.validated_data["user"]
-            user.is_active = True
-            user.save()
-            send_welcome_email_task(user.email, user.first_name)
+            with transaction.atomic():
+                if not user.is_active:
+                    user.is_active = True
+                    user.save(update_fields=["is_active"])
+                    queue_welcome_email(user)
 
             return Response({"message": "Account activated successfully."}, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -71,6 +130,8 @@ class OTPVerifyView(APIView):
 
 class GeneralOTPVerifyView(APIView):
     permission_classes = [permissions.AllowAny]
+    throttle_classes = [IPTokenBucketThrottle, EmailTokenBucketThrottle]
+    throttle_scope = "otp_verify"
 
     @extend_schema(request=GeneralOTPVerificationSerializer, responses={200: "OTP verified successfully"})
     def post(self, request):
@@ -82,17 +143,18 @@ class GeneralOTPVerifyView(APIView):
 
 class LoginView(APIView):
     permission_classes = [permissions.AllowAny]
+    throttle_classes = [IPTokenBucketThrottle, EmailTokenBucketThrottle]
+    throttle_scope = "login"
 
     @extend_schema(request=LoginSerializer, responses={200: "Login successful"})
     def post(self, request):
         serializer = LoginSerializer(data=request.data)
         if serializer.is_valid():
-            user = serializer.validated_data["user"]
-            refresh = RefreshToken.for_user(user)
+            # Tokens were already minted by the serializer; don't mint twice.
             return Response({
-                'user': UserSerializer(user).data,
-                "refresh": str(refresh),
-                "access": str(refresh.access_token),
+                'user': UserSerializer(serializer.validated_data["user"]).data,
+                "refresh": serializer.validated_data["refresh"],
+                "access": serializer.validated_data["access"],
             }, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -102,9 +164,17 @@ class LogoutView(APIView):
 
     @extend_schema(request=LogoutSerializer, responses={200: "Logout successful"})
     def post(self, request):
+        """ Revoke the access token used for this request and the session's refresh token. """
         serializer = LogoutSerializer(
             data=request.data, context={"request": request})
         if serializer.is_valid():
+            try:
+                for token in (request.auth, serializer.validated_data["refresh"]):
+                    revoke_token(token)
+            except RedisError:
+                logger.exception("Could not revoke tokens on logout")
+                return Response({"detail": "Logout is temporarily unavailable."},
+                                status=status.HTTP_503_SERVICE_UNAVAILABLE)
             return Response({"message": "Logout successful."}, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -128,67 +198,59 @@ class GetLocationAPIView(APIView):
     )
     def get(self, request):
         # Get the correct client IP
-        ip = request.META.get("HTTP_X_FORWARDED_FOR")
-        if ip:
-            ip = ip.split(",")[0]  # Get the first IP in case of multiple
-        else:
-            # Fallback to Google DNS IP
-            ip = request.META.get("REMOTE_ADDR", "8.8.8.8")
+        ip = client_ip(request)
 
         try:
-            # Fetch location data using ipinfo.io
-            response = requests.get(f"https://ipinfo.io/{ip}/json").json()
-            print("📍 API Response:", response)  # Debugging
-
-            if response.get("bogon", False) or "country" not in response:
-                return Response({"error": "Could not retrieve location"}, status=400)
-
-            # Extract lat/lon from 'loc' field
-            loc = response.get("loc", ",").split(",")
-            latitude, longitude = loc if len(loc) == 2 else ("", "")
-
-            location_data = {
-                "country": response.get("country", ""),
-                "region": response.get("region", ""),
-                "city": response.get("city", ""),
-                "lat": latitude,
-                "lon": longitude,
-                "ip": response.get("ip", ip),
-            }
-
-            if request.user.is_authenticated:
-                # Update user's location field
-                user = request.user
-                user.location = f"{location_data['city']}, {location_data['country']}"
-                user.save(update_fields=["location"])
-
-            return Response(location_data, status=200)
-
+            # Fetch location data using ipinfo.io (cached per IP)
+            location_data = lookup_location(ip)
         except requests.exceptions.RequestException as e:
             print(f"❌ Error fetching location: {e}")
             return Response({"error": "Location service unavailable"}, status=500)
 
+        if location_data is None:
+            return Response({"error": "Could not retrieve location"}, status=400)
+
+        if request.user.is_authenticated:
+            # Update user's location field, skipping the write when unchanged
+            user = get_model_user(request.user, fresh=True)
+            location = f"{location_data['city']}, {location_data['country']}"
+            if user.location != location:
+                user.location = location
+                user.save(update_fields=["location"])
+
+        return Response(location_data, status=200)
+
 class GetUserByUsernameAPIView(RetrieveAPIView):
     """
     API to fetch a user by their username.
 
     **Note:** Only authenticated users can access this endpoint.
+
+    Responses are cached per username and carry an `ETag`; send it back in
+    `If-None-Match` to get a `304 Not Modified` while the profile is unchanged.
     """
     permission_classes = [IsAuthenticated]
     serializer_class = UserSerializer
     queryset = User.objects.all()
     lookup_field = "username"
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
 
     @extend_schema(
         summary="Get User by Username",
         description="Retrieve user details using their username.",
-        responses={200: UserSerializer},
+        responses={200: UserSerializer, 304: None},
         tags=["Users"]
     )
     def get(self, request, username):
-        user = get_object_or_404(User, username=username)
-        serializer = self.get_serializer(user)
-        return Response(serializer.data)
+        profile = get_profile(username)
+        if profile["data"] is None:
+            raise Http404
+        if etag_matches(request.headers.get("If-None-Match"), profile["etag"]):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = Response(profile["data"])
+        response["ETag"] = profile["etag"]
+        return response
 
 
 class UserPagination(PageNumberPagination):
@@ -197,6 +259,22 @@ class UserPagination(PageNumberPagination):
     max_page_size = 50  # Maximum items per page
 
 
+class UserCursorPagination(CursorPagination):
+    """
+    Keyset pagination on ``-id``: no COUNT(*) or OFFSET, and pages stay
+    stable while users are being created.
+    """
+    ordering = "-id"
+    page_size = UserPagination.page_size
+    page_size_query_param = UserPagination.page_size_query_param
+    max_page_size = UserPagination.max_page_size
+
+
+def wants_cursor_pagination(request):
+    params = request.query_params
+    return params.get("pagination") == "cursor" or "cursor" in params
+
+
 class GetAllUsersAPIView(ListAPIView):
     """
     API to list all users with filtering and pagination.
@@ -210,7 +288,10 @@ class GetAllUsersAPIView(ListAPIView):
     
     **Pagination:**  
     - Default page size: 10  
-    - Customize with `?page=2&size=5`
+    - Customize with `?page=2&page_size=5`
+    - `?pagination=cursor` switches to cursor pagination: follow the
+      `next`/`previous` links, which carry an opaque `cursor`. No total
+      `count` is returned, and pages stay stable while users sign up.
     """
     permission_classes = [IsAuthenticated]
     serializer_class = UserSerializer
@@ -218,12 +299,75 @@ class GetAllUsersAPIView(ListAPIView):
     pagination_class = UserPagination
     filter_backends = [DjangoFilterBackend]
     filterset_class = UserFilter
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
+
+    @property
+    def paginator(self):
+        if not hasattr(self, "_paginator"):
+            if wants_cursor_pagination(self.request):
+                self._paginator = UserCursorPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
 
     @extend_schema(
         summary="Get All Users with Filters & Pagination",
         description="List all users with filtering options for username, email, gender, location, and phone_number.",
+        parameters=[
+            OpenApiParameter("pagination", str, enum=["page", "cursor"],
+                             description="`cursor` for keyset pagination (no total count)."),
+            OpenApiParameter("cursor", str, description="Opaque cursor from a `next`/`previous` link."),
+        ],
         responses={200: UserSerializer(many=True)},
         tags=["Users"]
     )
     def get(self, request, *args, **kwargs):
         return super().get(request, *args, **kwargs)
+
+    def list(self, request, *args, **kwargs):
+        # Same output as UserSerializer, read straight from .values() rows.
+        queryset = user_values(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(represent_user_rows(page))
+        return Response(represent_user_rows(list(queryset)))
+
+
+class ExportUsersView(APIView):
+    """
+    Stream every user matching the `UserFilter` parameters, for staff.
+
+    `?output=ndjson` (default) writes one JSON object per line with the same
+    fields as the user listing; `?output=csv` writes CSV with a header row,
+    values exactly as stored. `?output=spreadsheet` is that CSV made safe to
+    open in a spreadsheet: cells starting with `=`, `+`, `-` or `@` are
+    prefixed with `'` so they aren't evaluated as formulas.
+    Users are streamed in id order, a chunk of rows per query, so exports
+    of any size run in constant memory.
+    """
+    permission_classes = [IsAdminUser]
+
+    @extend_schema(
+        summary="Export Users",
+        description="Stream all users matching the filters as NDJSON or CSV. `spreadsheet` is CSV with formula-like cells prefixed with `'`.",
+        parameters=[
+            OpenApiParameter("output", str, enum=list(EXPORT_FORMATS), description="Export format (default `ndjson`)."),
+            OpenApiParameter("username", str), OpenApiParameter("email", str),
+            OpenApiParameter("gender", str, enum=[value for value, _ in User.GENDER_CHOICES]),
+            OpenApiParameter("location", str), OpenApiParameter("phone_number", str),
+        ],
+        responses={200: None},
+        tags=["Users"]
+    )
+    def get(self, request):
+        output = request.query_params.get("output", "ndjson")
+        if output not in EXPORT_FORMATS:
+            raise ValidationError({"output": [f"Choose one of: {', '.join(EXPORT_FORMATS)}."]})
+        filterset = UserFilter(request.query_params, queryset=User.objects.all(), request=request)
+        if not filterset.is_valid():
+            raise ValidationError(filterset.errors)
+
+        content_type, filename = EXPORT_FORMATS[output]
+        response = StreamingHttpResponse(export_stream(filterset.qs, output), content_type=content_type)
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
+        return response
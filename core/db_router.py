@@ -0,0 +1,279 @@
+"""
+Read replicas, from ``DATABASE_REPLICA_URLS`` (aliases ``replica_1``,
+``replica_2``, ...).
+
+``ReplicaRouter`` sends reads made while handling a request to a random
+healthy replica and everything else to ``default``; Celery tasks and
+management commands, which often act on rows they just wrote, always read
+the primary. Request reads stay on the primary:
+
+- inside a transaction on the primary (``select_for_update`` and
+  read-then-write code need the rows they are about to change);
+- for the rest of a request once it has written;
+- in views decorated with ``use_primary`` (sign-up, OTP and login flows,
+  where a client reads what it wrote a moment ago: verify right after
+  registering, log in right after verifying) and for authentication's
+  user lookups (``primary_reads``);
+- for ``DATABASE_REPLICA_STICKY_SECONDS`` after a user's last write, via a
+  cache entry keyed by user id that ``ReplicaStickinessMiddleware`` sets
+  and looks up from the bearer token, so clients read their own writes
+  without having to keep cookies. This needs a cache shared by every
+  worker, so replicas require ``REDIS_URL``.
+
+A background thread measures each replica's replay lag every
+``DATABASE_REPLICA_HEALTH_INTERVAL`` seconds; replicas that can't be
+reached or lag by more than ``DATABASE_REPLICA_MAX_LAG`` seconds get no
+reads until a later check finds them caught up. With no healthy replica,
+reads go to the primary.
+"""
+import functools
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections
+from redis.exceptions import RedisError
+from rest_framework_simplejwt.exceptions import TokenBackendError
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.state import token_backend
+
+logger = logging.getLogger(__name__)
+
+STICKY_KEY = "db:primary:user:{}"
+
+# Per-request state, shared with the threads an async view's ORM calls run
+# on (they get a copy of the context, but the same object).
+_request_state = ContextVar("replica_request_state", default=None)
+
+
+class _RequestState:
+
+    def __init__(self, pinned):
+        self.pinned = pinned
+        self.wrote = False
+
+
+def replica_aliases():
+    return [alias for alias in settings.DATABASES if alias.startswith("replica_")]
+
+
+def measure_lag(alias):
+    """ Seconds ``alias`` is behind the primary; ``0.0`` where that can't be measured. """
+    connection = connections[alias]
+    if connection.vendor != "postgresql":
+        connection.ensure_connection()
+        return 0.0
+    with connection.cursor() as cursor:
+        # Caught up when everything received has been replayed; otherwise
+        # the age of the last replayed transaction.
+        cursor.execute(
+            "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+            "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+        )
+        return float(cursor.fetchone()[0])
+
+
+class ReplicaHealth:
+    """ Which replicas may take reads, refreshed by a daemon thread. """
+
+    def __init__(self, aliases):
+        self.aliases = aliases
+        self.healthy = list(aliases)  # until the first check says otherwise
+        self.lag = {}
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def check(self):
+        healthy = []
+        for alias in self.aliases:
+            try:
+                lag = measure_lag(alias)
+            except Exception:
+                logger.exception("Replica %s is unreachable; sending its reads to the primary", alias)
+                self.lag[alias] = None
+                continue
+            finally:
+                connections[alias].close()
+            self.lag[alias] = lag
+            if lag > settings.DATABASE_REPLICA_MAX_LAG:
+                logger.warning("Replica %s is %.1fs behind; sending its reads elsewhere", alias, lag)
+            else:
+                healthy.append(alias)
+        self.healthy = healthy
+
+    def _run(self):
+        while True:
+            self.check()
+            time.sleep(settings.DATABASE_REPLICA_HEALTH_INTERVAL)
+
+    def ensure_running(self):
+        """ Start the checker in this process (again after a fork). """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name="replica-health", daemon=True).start()
+
+
+_health = None
+_health_lock = threading.Lock()
+
+
+def get_replica_health():
+    global _health
+    if _health is None:
+        with _health_lock:
+            if _health is None:
+                _health = ReplicaHealth(replica_aliases())
+    return _health
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        health = get_replica_health()
+        if not health.aliases:
+            return DEFAULT_DB_ALIAS
+        state = _request_state.get()
+        if state is None or state.pinned or state.wrote:
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        health.ensure_running()
+        healthy = health.healthy
+        return random.choice(healthy) if healthy else DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        state = _request_state.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+def pin_to_primary():
+    """ Read from the primary for the rest of the current request. """
+    state = _request_state.get()
+    if state is not None:
+        state.pinned = True
+
+
+@contextmanager
+def primary_reads():
+    """ Read from the primary inside the block. """
+    state = _request_state.get()
+    if state is None:
+        yield
+        return
+    pinned, state.pinned = state.pinned, True
+    try:
+        yield
+    finally:
+        state.pinned = pinned
+
+
+def use_primary(view):
+    """ Decorate a view (sync or async) so all its reads go to the primary. """
+    if iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def wrapped(request, *args, **kwargs):
+            pin_to_primary()
+            return await view(request, *args, **kwargs)
+    else:
+        @functools.wraps(view)
+        def wrapped(request, *args, **kwargs):
+            pin_to_primary()
+            return view(request, *args, **kwargs)
+    return wrapped
+
+
+def _bearer_user_id(request):
+    """
+    The user id in the request's bearer token, unverified: it only picks a
+    database, and authentication checks the token as usual.
+    """
+    scheme, _, raw = request.headers.get("Authorization", "").partition(" ")
+    if scheme not in jwt_settings.AUTH_HEADER_TYPES or not raw:
+        return None
+    try:
+        return token_backend.decode(raw.strip(), verify=False).get(jwt_settings.USER_ID_CLAIM)
+    except TokenBackendError:
+        return None
+
+
+class ReplicaStickinessMiddleware:
+    """
+    Keeps a user's reads on the primary for a while after they write. The
+    window is a cache entry per user id, found from the bearer token.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = bool(get_replica_health().aliases)
+        if self.enabled and not settings.REDIS_URL:
+            raise ImproperlyConfigured(
+                "REDIS_URL must be set to use read replicas: every worker must see "
+                "the read-your-writes window a write opens.")
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.enabled:
+            return self.get_response(request)
+        user_id = _bearer_user_id(request)
+        state = _RequestState(pinned=user_id is not None and self.is_sticky(user_id))
+        reset = _request_state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_state.reset(reset)
+        if state.wrote and user_id is not None:
+            self.stick(user_id)
+        return response
+
+    async def __acall__(self, request):
+        if not self.enabled:
+            return await self.get_response(request)
+        user_id = _bearer_user_id(request)
+        sticky = user_id is not None and await sync_to_async(self.is_sticky, thread_sensitive=False)(user_id)
+        state = _RequestState(pinned=sticky)
+        reset = _request_state.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_state.reset(reset)
+        if state.wrote and user_id is not None:
+            await sync_to_async(self.stick, thread_sensitive=False)(user_id)
+        return response
+
+    def is_sticky(self, user_id):
+        try:
+            return cache.get(STICKY_KEY.format(user_id)) is not None
+        except RedisError:
+            logger.exception("Could not read the primary-read window; reading from the primary")
+            return True
+
+    def stick(self, user_id):
+        try:
+            cache.set(STICKY_KEY.format(user_id), 1, settings.DATABASE_REPLICA_STICKY_SECONDS)
+        except RedisError:
+            logger.exception("Could not open the primary-read window for user %s", user_id)
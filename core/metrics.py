@@ -0,0 +1,368 @@
+"""
+Prometheus-style metrics: request latency per route, database queries per
+route and outbound upstream (Plunk, ipinfo) calls.
+
+Each process counts in memory. With ``METRICS_DIR`` set, it also writes its
+counters to ``METRICS_DIR/<host>-<pid>.json`` (at most every
+``METRICS_FLUSH_INTERVAL`` seconds, and on exit), and ``/metrics`` sums the
+files of every process, so gunicorn workers and Celery workers all show up
+whichever worker answers the scrape. A scrape folds the files of exited
+processes on its host into ``exited.json`` and deletes them, so counters
+never go backwards and restarts don't pile up files; entrypoints.sh empties
+the directory on deploy. Without ``METRICS_DIR``, ``/metrics`` only shows
+the answering process.
+
+``/metrics`` requires ``METRICS_TOKEN`` as a Bearer token; only with
+``DEBUG`` on is it served without one.
+"""
+import atexit
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from contextvars import ContextVar
+from datetime import datetime
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+EXITED_FILE = "exited.json"
+LOCK_FILE = ".lock"
+
+# name -> (type, help, buckets)
+METRICS = {
+    "http_request_duration_seconds": (
+        "histogram", "Time spent handling a request, by route.", LATENCY_BUCKETS),
+    "db_queries_per_request": (
+        "histogram", "Database queries run by a request, by route.", QUERY_COUNT_BUCKETS),
+    "db_query_duration_seconds_total": (
+        "counter", "Time spent in database queries, by route.", None),
+    "upstream_request_duration_seconds": (
+        "histogram", "Time spent calling an upstream service.", LATENCY_BUCKETS),
+}
+
+
+class Registry:
+    """
+    Counters and histograms keyed by ``(name, labels)``. A histogram is a
+    list of per-bucket counts followed by the sum and the count.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._flushed_at = 0.0
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if buckets is None:
+                self._values[key] = self._values.get(key, 0) + value
+                return
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    entry[i] += 1
+                    break
+            entry[-2] += value
+            entry[-1] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return [[name, list(labels), value if not isinstance(value, list) else list(value)]
+                    for (name, labels), value in self._values.items()]
+
+    def maybe_flush(self):
+        if settings.METRICS_DIR and time.monotonic() - self._flushed_at >= settings.METRICS_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """ Write this process's counters for ``/metrics`` to pick up. """
+        directory = settings.METRICS_DIR
+        if not directory:
+            return
+        self._flushed_at = time.monotonic()
+        try:
+            os.makedirs(directory, exist_ok=True)
+            _write(os.path.join(directory, _process_filename()), self.snapshot())
+        except OSError:
+            logger.exception("Could not write metrics to %s", directory)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+registry = Registry()
+atexit.register(registry.flush)
+
+
+def observe_upstream(name, outcome, seconds):
+    """ Record one call to upstream ``name``; used by ``accounts.clients``. """
+    registry.observe("upstream_request_duration_seconds", {"upstream": name, "outcome": outcome}, seconds)
+    registry.maybe_flush()
+
+
+def _process_filename():
+    return f"{socket.gethostname()}-{os.getpid()}.json"
+
+
+def _has_exited(filename):
+    """ Whether ``filename`` belongs to a process on this host that is gone. """
+    host, _, pid = filename[:-len(".json")].rpartition("-")
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write(path, snapshot):
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(snapshot, f)
+    os.replace(f"{path}.tmp", path)
+
+
+@contextlib.contextmanager
+def _locked(directory, operation):
+    """ Hold ``METRICS_DIR``'s lock file; folding is exclusive, reading shared. """
+    with open(os.path.join(directory, LOCK_FILE), "a") as lock:
+        fcntl.flock(lock, operation)
+        yield
+
+
+def _merge(snapshots):
+    merged = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot:
+            if name not in METRICS:
+                continue
+            key = (name, tuple(tuple(label) for label in labels))
+            current = merged.get(key)
+            if current is None:
+                merged[key] = list(value) if isinstance(value, list) else value
+            elif isinstance(value, list):
+                merged[key] = [a + b for a, b in zip(current, value)]
+            else:
+                merged[key] = current + value
+    return merged
+
+
+def _fold_exited(directory):
+    """
+    Add the counters of this host's exited processes to ``exited.json`` and
+    delete their files.
+    """
+    if not any(filename.endswith(".json") and _has_exited(filename) for filename in os.listdir(directory)):
+        return
+    with _locked(directory, fcntl.LOCK_EX):
+        exited_path = os.path.join(directory, EXITED_FILE)
+        snapshots = [_read(exited_path) or []]
+        folded = []
+        # Listed again under the lock: another scrape may have folded some.
+        for filename in os.listdir(directory):
+            if not filename.endswith(".json") or not _has_exited(filename):
+                continue
+            snapshot = _read(os.path.join(directory, filename))
+            if snapshot is not None:
+                snapshots.append(snapshot)
+                folded.append(filename)
+        if not folded:
+            return
+        _write(exited_path, [[name, list(labels), value] for (name, labels), value in _merge(snapshots).items()])
+        for filename in folded:
+            os.remove(os.path.join(directory, filename))
+
+
+def collect():
+    """ Every process's snapshot merged into ``{(name, labels): value}``. """
+    snapshots = [registry.snapshot()]
+    directory = settings.METRICS_DIR
+    if directory and os.path.isdir(directory):
+        try:
+            _fold_exited(directory)
+            own = _process_filename()
+            with _locked(directory, fcntl.LOCK_SH):
+                for filename in os.listdir(directory):
+                    if not filename.endswith(".json") or filename == own:
+                        continue
+                    snapshot = _read(os.path.join(directory, filename))
+                    if snapshot is not None:
+                        snapshots.append(snapshot)
+        except OSError:
+            logger.exception("Could not read metrics from %s", directory)
+    return _merge(snapshots)
+
+
+def _escape(value):
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _purge_stats():
+    from accounts.tasks import get_purge_stats
+
+    try:
+        stats = get_purge_stats()
+    except Exception:
+        logger.exception("Could not read OTP purge stats")
+        return []
+    last_run_at = stats["last_run_at"]
+    return [
+        ("otp_purge_rows_total", "counter", "Expired OTPs deleted by purge_expired_otps.", stats["rows_total"]),
+        ("otp_purge_runs_total", "counter", "purge_expired_otps runs.", stats["runs_total"]),
+        ("otp_purge_last_run_rows", "gauge", "OTPs deleted by the last purge run.", stats["last_run_rows"]),
+        ("otp_purge_last_run_timestamp_seconds", "gauge", "When the last purge run finished.",
+         datetime.fromisoformat(last_run_at).timestamp() if last_run_at else 0),
+    ]
+
+
+def render():
+    """ The merged metrics in the Prometheus text exposition format. """
+    merged = collect()
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        series = sorted((labels, value) for (metric, labels), value in merged.items() if metric == name)
+        if not series:
+            continue
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        for labels, value in series:
+            if kind != "histogram":
+                lines.append(f"{name}{_labels(labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets, value):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {value[-1]}")
+            lines.append(f"{name}_sum{_labels(labels)} {value[-2]}")
+            lines.append(f"{name}_count{_labels(labels)} {value[-1]}")
+    for name, kind, help_text, value in _purge_stats():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
+
+
+def metrics_view(request):
+    token = settings.METRICS_TOKEN
+    if not token and not settings.DEBUG:
+        logger.warning("METRICS_TOKEN is not set; refusing to serve /metrics")
+        return HttpResponseForbidden()
+    if token and not constant_time_compare(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return HttpResponseForbidden()
+    return HttpResponse(render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+class _QueryTimer:
+    """ Adds up the queries run while handling one request. """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+# Set by the middleware; context variables follow a request from an async
+# view into the threads its ORM calls run on.
+_query_timer = ContextVar("metrics_query_timer", default=None)
+
+
+def _time_query(execute, sql, params, many, context):
+    timer = _query_timer.get()
+    if timer is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timer.seconds += time.perf_counter() - started
+        timer.count += 1
+
+
+@receiver(connection_created)
+def _install_query_timer(connection, **kwargs):
+    # Every connection, in every thread, so async views are covered too.
+    # Inserted first: ``execute_wrapper()`` blocks pop from the end.
+    if _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, _time_query)
+
+
+class MetricsMiddleware:
+    """ Times each request and its database queries, labelled by URL route. """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        # Connections opened before this module was loaded missed the signal.
+        for connection in connections.all(initialized_only=True):
+            _install_query_timer(connection)
+        timer = _QueryTimer()
+        reset = _query_timer.set(timer)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _query_timer.reset(reset)
+        self.record(request, response, time.perf_counter() - started, timer)
+        return response
+
+    async def __acall__(self, request):
+        timer = _QueryTimer()
+        reset = _query_timer.set(timer)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _query_timer.reset(reset)
+        self.record(request, response, time.perf_counter() - started, timer)
+        return response
+
+    def record(self, request, response, elapsed, timer):
+        # For streaming responses (the user export) ``elapsed`` covers the
+        # view up to the first byte, not the streaming that follows.
+        # The route pattern, not the path, so usernames don't become labels.
+        match = request.resolver_match
+        labels = {"route": match.route if match else "unmatched", "method": request.method}
+        registry.observe("http_request_duration_seconds", {**labels, "status": response.status_code}, elapsed)
+        registry.observe("db_queries_per_request", labels, timer.count)
+        registry.observe("db_query_duration_seconds_total", labels, timer.seconds)
+        registry.maybe_flush()
@@ -0,0 +1,147 @@
+"""
+Prebuilt OpenAPI schema for ``/api/schema/``.
+
+``SpectacularAPIView`` generates the schema from scratch on every hit.
+Instead, ``manage.py build_schema`` writes it once per deploy to
+``OPENAPI_SCHEMA_PATH``, tagged with the code version, and each process
+renders it once (YAML and JSON, plain and gzipped) and serves those bytes
+with strong ETags. A file from another code version is ignored and the
+schema is generated in-process instead, so a stale file can't be served.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from pathlib import Path
+
+import drf_spectacular
+from django.apps import apps
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags
+from drf_spectacular.renderers import OpenApiJsonRenderer, OpenApiYamlRenderer
+from drf_spectacular.settings import spectacular_settings
+
+logger = logging.getLogger(__name__)
+
+_gzip_re = re.compile(r"\bgzip\b")
+
+
+def code_version():
+    """
+    ``CODE_VERSION`` when the deploy sets it (e.g. the git commit), else a
+    digest of the project's Python sources.
+    """
+    if settings.CODE_VERSION:
+        return settings.CODE_VERSION
+    digest = hashlib.sha1(drf_spectacular.__version__.encode())
+    roots = {Path(__file__).parent} | {
+        Path(app.path) for app in apps.get_app_configs() if Path(app.path).is_relative_to(settings.BASE_DIR)}
+    for root in sorted(roots):
+        for path in sorted(root.rglob("*.py")):
+            digest.update(str(path.relative_to(settings.BASE_DIR)).encode())
+            digest.update(path.read_bytes())
+    return digest.hexdigest()[:12]
+
+
+def generate_schema():
+    generator = spectacular_settings.DEFAULT_GENERATOR_CLASS()
+    return generator.get_schema(request=None, public=True)
+
+
+def write_schema(path=None):
+    """ Generate the schema and save it for the current code version. """
+    path = path or settings.OPENAPI_SCHEMA_PATH
+    version = code_version()
+    body = OpenApiJsonRenderer().render({"version": version, "schema": generate_schema()}, renderer_context={})
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(body)
+    os.replace(f"{path}.tmp", path)
+    return version
+
+
+def load_schema(path=None):
+    """ The saved schema if it matches the current code version, else a fresh one. """
+    path = path or settings.OPENAPI_SCHEMA_PATH
+    try:
+        with open(path, "rb") as f:
+            saved = json.load(f)
+        if saved.get("version") == code_version():
+            return saved["schema"]
+        logger.warning("%s was built for another code version; generating the schema", path)
+    except FileNotFoundError:
+        logger.warning("%s not found; run `manage.py build_schema` at deploy time", path)
+    except ValueError:
+        logger.exception("Could not read %s; generating the schema", path)
+    return generate_schema()
+
+
+class Representation:
+    """ One rendering of the schema, with its gzipped form and ETag. """
+
+    def __init__(self, body, content_type):
+        self.body = body
+        self.gzipped = gzip.compress(body, compresslevel=9, mtime=0)
+        self.content_type = content_type
+        digest = hashlib.sha1(body).hexdigest()
+        # Strong ETags name exact bytes, so the gzipped body gets its own.
+        self.etag = f'"{digest}"'
+        self.gzip_etag = f'"{digest}-gzip"'
+
+
+_representations = None
+_lock = threading.Lock()
+
+
+def get_representations():
+    global _representations
+    if _representations is None:
+        with _lock:
+            if _representations is None:
+                schema = load_schema()
+                _representations = {
+                    "yaml": Representation(OpenApiYamlRenderer().render(schema, renderer_context={}),
+                                           "application/vnd.oai.openapi; charset=utf-8"),
+                    "json": Representation(OpenApiJsonRenderer().render(schema, renderer_context={}),
+                                           "application/vnd.oai.openapi+json"),
+                }
+    return _representations
+
+
+@receiver(setting_changed)
+def _reset_schema(setting, **kwargs):
+    global _representations
+    if setting in ("CODE_VERSION", "OPENAPI_SCHEMA_PATH", "SPECTACULAR_SETTINGS"):
+        _representations = None
+
+
+def schema_view(request):
+    """
+    YAML by default like ``SpectacularAPIView``; JSON for ``?format=json``
+    or a JSON ``Accept`` header (Swagger UI sends one).
+    """
+    output = request.GET.get("format")
+    if output not in ("yaml", "json"):
+        output = "json" if "json" in request.headers.get("Accept", "") else "yaml"
+    representation = get_representations()[output]
+
+    use_gzip = bool(_gzip_re.search(request.headers.get("Accept-Encoding", "")))
+    etag = representation.gzip_etag if use_gzip else representation.etag
+    if {etag, "*"} & set(parse_etags(request.headers.get("If-None-Match", ""))):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(representation.gzipped if use_gzip else representation.body,
+                                content_type=representation.content_type)
+        if use_gzip:
+            response["Content-Encoding"] = "gzip"
+        response["Content-Disposition"] = f'inline; filename="schema.{output}"'
+    response["ETag"] = etag
+    response["Vary"] = "Accept, Accept-Encoding"
+    response["Cache-Control"] = "no-cache"
+    return response
@@ -15,6 +15,7 @@ from pathlib import Path
 import os
 import dotenv
 import dj_database_url
+from kombu import Queue
 
 dotenv.load_dotenv()
 
@@ -52,6 +53,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.metrics.MetricsMiddleware',
+    'core.db_router.ReplicaStickinessMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -100,6 +103,36 @@ DATABASES = {
     )
 }
 
+# Read replicas (comma-separated URLs), see core/db_router.py
+for n, url in enumerate(filter(None, os.getenv("DATABASE_REPLICA_URLS", "").split(",")), start=1):
+    DATABASES[f"replica_{n}"] = dj_database_url.parse(
+        url=url.strip(), conn_max_age=600, conn_health_checks=True
+    )
+    DATABASES[f"replica_{n}"]["TEST"] = {"MIRROR": "default"}
+
+DATABASE_ROUTERS = ['core.db_router.ReplicaRouter']
+# Seconds a client's reads stay on the primary after it writes
+DATABASE_REPLICA_STICKY_SECONDS = int(os.getenv("DATABASE_REPLICA_STICKY_SECONDS", 5))
+# Replicas further behind than this (seconds) get no reads
+DATABASE_REPLICA_MAX_LAG = float(os.getenv("DATABASE_REPLICA_MAX_LAG", 5))
+DATABASE_REPLICA_HEALTH_INTERVAL = int(os.getenv("DATABASE_REPLICA_HEALTH_INTERVAL", 10))
+
+
+# Password hashing
+# PBKDF2 work factor, tunable per deployment. Stored hashes with a different
+# count are transparently rehashed on the user's next successful login.
+PASSWORD_HASHER_ITERATIONS = int(os.getenv("PASSWORD_HASHER_ITERATIONS", 600000))
+# Threads hashing passwords for the async login view
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", os.cpu_count() or 1))
+
+PASSWORD_HASHERS = [
+    'accounts.hashers.ConfigurablePBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -145,13 +178,36 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
+# Authenticate API requests from signed token claims instead of loading the
+# user on every request (accounts/authentication.py). The full user, when a
+# view needs it, is cached per process for JWT_CLAIMS_USER_CACHE_TTL seconds.
+JWT_STATELESS_AUTH = os.getenv("JWT_STATELESS_AUTH", "false").lower() == "true"
+JWT_CLAIMS_USER_CACHE_TTL = int(os.getenv("JWT_CLAIMS_USER_CACHE_TTL", 30))
+JWT_CLAIMS_USER_CACHE_SIZE = 10000
+
 REST_FRAMEWORK = {
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'accounts.authentication.ClaimsJWTAuthentication' if JWT_STATELESS_AUTH
+        else 'accounts.authentication.RevocationAwareJWTAuthentication',
     ),
     "DEFAULT_PAGINATION_CLASS": "rest_framework.pagination.PageNumberPagination",
     "PAGE_SIZE": 10,  # Set default pagination size
+    # Reverse proxies in front of the app (load balancer, Vercel's edge).
+    # Client IPs for throttling and geolocation are read from the
+    # X-Forwarded-For entry the outermost of them appended, never from
+    # entries the client could have sent; 0 uses REMOTE_ADDR.
+    "NUM_PROXIES": int(os.getenv("NUM_PROXIES", 1)),
+    # Token buckets (accounts/throttles.py): "<burst>/<period>", refilled at
+    # <burst> tokens per period, keyed "<throttle_scope>_<ip|email>".
+    "DEFAULT_THROTTLE_RATES": {
+        "otp_request_ip": "10/min",
+        "otp_request_email": "3/min",
+        "otp_verify_ip": "20/min",
+        "otp_verify_email": "5/min",
+        "login_ip": "20/min",
+        "login_email": "10/min",
+    },
 }
 
 SPECTACULAR_SETTINGS = {
@@ -161,16 +217,181 @@ SPECTACULAR_SETTINGS = {
     'SERVE_INCLUDE_SCHEMA': False,
 }
 
+# Prebuilt schema served at /api/schema/ (see core/schema.py). Set
+# CODE_VERSION to the deployed commit; otherwise a digest of the sources is used.
+CODE_VERSION = os.getenv("CODE_VERSION", "")
+OPENAPI_SCHEMA_PATH = os.getenv("OPENAPI_SCHEMA_PATH", str(BASE_DIR / "openapi-schema.json"))
+
 # Celery Configuration
-CELERY_BROKER_URL = 'redis://localhost:6379/0'
+CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", 'redis://localhost:6379/0')
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
-CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
+CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", 'redis://localhost:6379/0')
+CELERY_IMPORTS = ['accounts.emails']
+
+# Email tasks are split across two queues so a burst of welcome mail can never
+# delay an OTP: `otp` is small and latency-sensitive, `bulk` is best-effort.
+# Run one worker pool per queue (see command.md) so each gets its own
+# concurrency, set through CELERY_OTP_WORKER_CONCURRENCY and
+# CELERY_BULK_WORKER_CONCURRENCY.
+CELERY_TASK_DEFAULT_QUEUE = 'default'
+CELERY_TASK_QUEUES = (
+    Queue('default', routing_key='default'),
+    Queue('otp', routing_key='otp'),
+    Queue('bulk', routing_key='bulk'),
+)
+CELERY_TASK_ROUTES = {
+    'accounts.emails.send_otp_email_task': {'queue': 'otp', 'routing_key': 'otp'},
+    'accounts.emails.send_welcome_email_task': {'queue': 'bulk', 'routing_key': 'bulk'},
+}
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    # A worker consuming several queues drains them in the order given to -Q,
+    # so the bulk pool's `-Q bulk,default` (command.md) serves welcome mail
+    # before default tasks; OTP mail has a pool of its own.
+    'queue_order_strategy': 'priority',
+    'visibility_timeout': 60 * 60,
+}
+CELERY_TASK_ACKS_LATE = True
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
+CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
+CELERY_BEAT_SCHEDULE = {
+    # Safety net for drains whose on-commit kick was lost, and for retries.
+    'drain-otp-outbox': {
+        'task': 'accounts.emails.drain_email_outbox',
+        'schedule': 15.0,
+        'args': ('otp',),
+        'options': {'queue': 'otp', 'expires': 15},
+    },
+    'drain-bulk-outbox': {
+        'task': 'accounts.emails.drain_email_outbox',
+        'schedule': 60.0,
+        'args': ('bulk',),
+        'options': {'queue': 'bulk', 'expires': 60},
+    },
+    # Drops deleted users from the availability filter and recreates it if lost.
+    'rebuild-availability-filter': {
+        'task': 'accounts.tasks.rebuild_availability_filter',
+        'schedule': 6 * 60 * 60.0,
+    },
+    'purge-expired-otps': {
+        'task': 'accounts.tasks.purge_expired_otps',
+        'schedule': 10 * 60.0,
+        'options': {'expires': 10 * 60},
+    },
+}
+
+# Email outbox (see accounts.emails.drain_email_outbox)
+EMAIL_OUTBOX_BATCH_SIZE = int(os.getenv("EMAIL_OUTBOX_BATCH_SIZE", 100))
+EMAIL_OUTBOX_CONCURRENCY = int(os.getenv("EMAIL_OUTBOX_CONCURRENCY", 8))
+EMAIL_OUTBOX_MAX_BATCHES_PER_RUN = 20
+EMAIL_OUTBOX_MAX_ATTEMPTS = 8
+EMAIL_OUTBOX_MAX_BACKOFF = 60 * 60  # seconds
+EMAIL_OUTBOX_CLAIM_TIMEOUT = 5 * 60  # seconds
+
+# Cache
+# Redis when REDIS_URL is set, otherwise a per-process in-memory cache.
+REDIS_URL = os.getenv("REDIS_URL", "")
+
+if REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
+# IP geolocation (see accounts/geolocation.py). Set GEOLOCATION_BACKEND to
+# accounts.geolocation.IPRangeDatabaseBackend to resolve offline from the
+# file built by `manage.py build_ip_database`.
+GEOLOCATION_BACKEND = os.getenv(
+    "GEOLOCATION_BACKEND", "accounts.geolocation.IPInfoBackend")
+GEOLOCATION_DATABASE_PATH = os.getenv("GEOLOCATION_DATABASE_PATH", "")
+
+# ipinfo lookup caching, in seconds
+GEOLOCATION_CACHE_TTL = 24 * 60 * 60
+GEOLOCATION_NEGATIVE_CACHE_TTL = 60 * 60
+GEOLOCATION_LOCAL_CACHE_TTL = 5 * 60
+GEOLOCATION_LOCAL_CACHE_SIZE = 10000
+
+# One-time passwords (see accounts/otp_store.py)
+OTP_STORE = os.getenv("OTP_STORE", "accounts.otp_store.DatabaseOTPStore")
+OTP_TTL = int(os.getenv("OTP_TTL", 10 * 60))  # seconds
+OTP_PURGE_BATCH_SIZE = int(os.getenv("OTP_PURGE_BATCH_SIZE", 5000))
+OTP_PURGE_MAX_BATCHES = 200  # per run; the next run picks up the rest
+OTP_PURGE_BATCH_PAUSE = 0.05  # seconds between batches
+
+# Idempotency-Key handling for register and otp/request (see accounts/idempotency.py).
+# Requires REDIS_URL; without it, or with IDEMPOTENCY_ENABLED=false, the header is ignored.
+IDEMPOTENCY_ENABLED = os.getenv("IDEMPOTENCY_ENABLED", "true").lower() == "true"
+IDEMPOTENCY_KEY_TTL = int(os.getenv("IDEMPOTENCY_KEY_TTL", 24 * 60 * 60))  # seconds a response is replayed
+IDEMPOTENCY_IN_FLIGHT_TIMEOUT = 30  # seconds a request holds its key before it expires
+IDEMPOTENCY_WAIT_TIMEOUT = 5  # seconds a duplicate waits for the in-flight response before a 409
+
+# Username/email availability Bloom filter (see accounts/availability.py)
+AVAILABILITY_BLOOM_CAPACITY = int(os.getenv("AVAILABILITY_BLOOM_CAPACITY", 5_000_000))
+AVAILABILITY_BLOOM_ERROR_RATE = 0.001
+# Seconds of recently added users replayed into a rebuilt filter; covers
+# users whose transactions hadn't committed when the rebuild scanned.
+AVAILABILITY_BLOOM_RECENT_WINDOW = 10 * 60
+
+# JWT revocation list (see accounts/revocation.py). Other processes see a
+# revocation within JWT_REVOCATION_SYNC_INTERVAL seconds. Requires REDIS_URL, so
+# it is on by default only when REDIS_URL is set (accounts.E001 flags it being
+# turned on without one); disabled, logout and refresh rotation revoke nothing.
+JWT_REVOCATION_ENABLED = os.getenv("JWT_REVOCATION_ENABLED", "true" if REDIS_URL else "false").lower() == "true"
+JWT_REVOCATION_BLOOM_CAPACITY = int(os.getenv("JWT_REVOCATION_BLOOM_CAPACITY", 100_000))
+JWT_REVOCATION_BLOOM_ERROR_RATE = 0.001
+JWT_REVOCATION_SYNC_INTERVAL = float(os.getenv("JWT_REVOCATION_SYNC_INTERVAL", 1))
+
+# Cached user profiles for GET users/<username>/ (see accounts/profile_cache.py)
+USER_PROFILE_CACHE_TTL = int(os.getenv("USER_PROFILE_CACHE_TTL", 5 * 60))  # seconds
+USER_PROFILE_FILL_TIMEOUT = 5  # seconds a miss may hold the fill lock
+
+# Rows fetched and encoded per round-trip by the streaming user export
+USER_EXPORT_CHUNK_SIZE = int(os.getenv("USER_EXPORT_CHUNK_SIZE", 2000))
+
+# Prometheus metrics (see core/metrics.py). Set METRICS_DIR to a directory
+# shared by every worker process on the host so /metrics covers all of them.
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", 5))  # seconds
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")  # Bearer token for /metrics; without it, served only in DEBUG
+
+# Outbound HTTP upstreams (see accounts/clients.py). Point BASE_URL at a
+# local stand-in server to run without reaching the real services.
+UPSTREAM_SERVICES = {
+    "plunk": {
+        "BASE_URL": os.getenv("PLUNK_BASE_URL", "https://api.useplunk.com/v1"),
+        "CONNECT_TIMEOUT": 3.05,
+        "READ_TIMEOUT": 10,
+        "POOL_SIZE": 10,
+        "FAILURE_THRESHOLD": 5,
+        "RESET_TIMEOUT": 30,
+    },
+    "ipinfo": {
+        "BASE_URL": os.getenv("IPINFO_BASE_URL", "https://ipinfo.io"),
+        "CONNECT_TIMEOUT": 2,
+        "READ_TIMEOUT": 3,
+        "POOL_SIZE": 20,
+        "FAILURE_THRESHOLD": 5,
+        "RESET_TIMEOUT": 15,
+    },
+}
 
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=15),  # Change as needed
     "REFRESH_TOKEN_LIFETIME": timedelta(days=7),  # Refresh token lasts longer
     "ROTATE_REFRESH_TOKENS": True,
+    # Rotated refresh tokens are revoked through accounts.revocation, not
+    # simplejwt's token_blacklist app.
     "BLACKLIST_AFTER_ROTATION": True,
+    "TOKEN_REFRESH_SERIALIZER": "accounts.serializers.RevocableTokenRefreshSerializer",
+    "TOKEN_USER_CLASS": "accounts.authentication.ClaimsUser",
     # "AUTH_HEADER_TYPES": ("Bearer",),
 }
\ No newline at end of file
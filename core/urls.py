@@ -17,7 +17,10 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 # from rest_framework.routers import DefaultRouter
-from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView, SpectacularRedocView
+from drf_spectacular.views import SpectacularSwaggerView, SpectacularRedocView
+
+from core.metrics import metrics_view
+from core.schema import schema_view
 
 # router = DefaultRouter()
 BASE_URL = "api/v1/"
@@ -25,8 +28,9 @@ BASE_URL = "api/v1/"
 urlpatterns = [
     path('chief_admin/', admin.site.urls),
     path('api/v1/', include('accounts.urls')),
+    path('metrics', metrics_view, name='metrics'),
 
-    path('api/schema/', SpectacularAPIView.as_view(), name='schema'),
+    path('api/schema/', schema_view, name='schema'),
     path('', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger-ui'),
     path('api/schema/redoc/', SpectacularRedocView.as_view(url_name='schema'), name='redoc'),
 ]
@@ -6,5 +6,13 @@ python manage.py migrate --noinput
 echo "Collecting static files..."
 python manage.py collectstatic --noinput
 
+echo "Building the OpenAPI schema..."
+python manage.py build_schema
+
+if [ -n "$METRICS_DIR" ]; then
+    echo "Clearing metrics from previous workers..."
+    mkdir -p "$METRICS_DIR" && rm -f "$METRICS_DIR"/*.json
+fi
+
 echo "Starting Gunicorn server..."
 gunicorn core.wsgi:application --bind 0.0.0.0:8000